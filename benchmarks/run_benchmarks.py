@@ -0,0 +1,446 @@
+"""
+Benchmark suite for the adapters, transforms and metrics of pershombox.
+
+Usage
+-----
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --compare results.json
+
+If DIPHA or hera are not configured, the stand-ins in benchmarks/standins are used (see
+benchmarks/standins/_recording.py). Timings obtained with stand-ins measure the Python side of
+pershombox plus process startup, not the backend computation. Which backend was used is recorded
+in the 'meta' section of the results.
+"""
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import warnings
+import subprocess
+
+import numpy
+
+
+_benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+_repo_dir = os.path.dirname(_benchmarks_dir)
+_standins_dir = os.path.join(_benchmarks_dir, 'standins')
+
+sys.path.insert(0, _repo_dir)
+sys.path.insert(0, _benchmarks_dir)
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    import pershombox
+
+from pershombox._software_backends import resource_handler
+from pershombox._software_backends.resource_handler import Backends
+from pershombox._software_backends.dipha_adapter import _ImageDataFile, _PersistenceDiagramFile
+
+import shapes
+
+
+# region backend selection
+
+
+_standin_executables = {
+    Backends.dipha: os.path.join(_standins_dir, 'dipha'),
+    Backends.hera_wasserstein_dist: os.path.join(_standins_dir, 'hera')
+}
+
+
+_selected_backends = {}
+
+
+def _configured_backends():
+    return {b for b in Backends if b.value not in dict(resource_handler.get_backend_cfg_errors())}
+
+
+def select_backends(mode: str)->dict:
+    """
+    mode: 'auto' uses stand-ins only for missing backends, 'always' forces stand-ins, 'never' uses
+    whatever is configured.
+    """
+    configured = _configured_backends()
+    selected = {}
+
+    for backend, standin in _standin_executables.items():
+        use_standin = mode == 'always' or (mode == 'auto' and backend not in configured)
+
+        if use_standin:
+            resource_handler.init_backend(backend, standin)
+            selected[backend.value] = 'standin'
+        else:
+            selected[backend.value] = 'real' if backend in configured else 'missing'
+
+    _selected_backends.update(selected)
+    return selected
+
+
+def _npht_2d_kwargs()->dict:
+    """
+    The synthetic diagrams of the DIPHA stand-in cannot be split into tiles, hence no packing with it.
+    """
+    if _selected_backends.get(Backends.dipha.value) == 'standin':
+        return {'max_cells_per_call': 1}
+
+    return {}
+
+
+# endregion
+
+
+# region timing
+
+
+def _time(fn, repeat: int)->[float]:
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    return times
+
+
+def _summary(times: [float], **extra)->dict:
+    summary = {'times': times,
+               'min': min(times),
+               'median': float(numpy.median(times))}
+    summary.update(extra)
+    return summary
+
+
+# endregion
+
+
+# region cases
+
+
+def bench_import_time(args):
+    code = 'import time, warnings; warnings.simplefilter("ignore"); ' \
+           't = time.perf_counter(); import pershombox; print(time.perf_counter() - t)'
+
+    times = []
+    for _ in range(args.repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=_repo_dir)
+        times.append(float(out.decode().strip().splitlines()[-1]))
+
+    return _summary(times)
+
+
+def bench_image_file_write(args):
+    results = {}
+    for name, img in [('2d', shapes.annulus_2d(args.size_2d)), ('3d', shapes.torus_3d(args.size_3d))]:
+        img = img.astype(float)
+
+        def write():
+            with io.BytesIO() as f:
+                _ImageDataFile(img).write_to_binary_file(f)
+
+        times = _time(write, args.repeat)
+        results[name] = _summary(times, voxels=int(img.size), voxels_per_second=img.size / min(times))
+
+    return results
+
+
+def bench_diagram_parse(args):
+    rng = numpy.random.RandomState(0)
+    number_of_points = args.diagram_points
+    births = rng.rand(number_of_points)
+    points = [(int(d), float(b), float(b + p))
+              for d, b, p in zip(rng.randint(0, 3, number_of_points), births, rng.rand(number_of_points))]
+
+    with io.BytesIO() as f:
+        _PersistenceDiagramFile(points).write_to_binary_file(f)
+        content = f.getvalue()
+
+    def parse():
+        _PersistenceDiagramFile.load_from_binary_file(io.BytesIO(content))
+
+    times = _time(parse, args.repeat)
+    return _summary(times, points=number_of_points, points_per_second=number_of_points / min(times))
+
+
+def bench_npht_2d(args):
+    shape = shapes.annulus_2d(args.size_2d)
+    times = _time(lambda: pershombox.calculate_discrete_NPHT_2d(shape, args.directions_2d, **_npht_2d_kwargs()),
+                  args.repeat)
+    return _summary(times, size=args.size_2d, directions=args.directions_2d)
+
+
+def bench_npht_3d(args):
+    shape = shapes.torus_3d(args.size_3d)
+    times = _time(lambda: pershombox.calculate_discrete_NPHT_3d_Lebedev26(shape), args.repeat)
+    return _summary(times, size=args.size_3d)
+
+
+def bench_npht_3d_dimensions(args):
+    """
+    calculate_discrete_NPHT_3d_Lebedev26 restricted to the homology dimensions needed, e.g., by
+    distances with included_dimensions=(0,).
+    """
+    shape = shapes.torus_3d(args.size_3d)
+    results = {}
+
+    for dimensions in [(0,), (0, 1), (0, 1, 2)]:
+        times = _time(lambda: pershombox.calculate_discrete_NPHT_3d_Lebedev26(shape, dimensions=dimensions),
+                      args.repeat)
+        results['dimensions_' + ''.join(str(d) for d in dimensions)] = _summary(times, size=args.size_3d)
+
+    return results
+
+
+def bench_distance_2d(args):
+    t_1 = pershombox.calculate_discrete_NPHT_2d(shapes.annulus_2d(args.size_2d), args.directions_2d,
+                                                **_npht_2d_kwargs())
+    t_2 = pershombox.calculate_discrete_NPHT_2d(shapes.perturbed(shapes.annulus_2d(args.size_2d), 1),
+                                                args.directions_2d, **_npht_2d_kwargs())
+
+    times = _time(lambda: pershombox.distance_npht2D(t_1, t_2, minimize_over_rotations=args.rotations),
+                  args.repeat)
+    return _summary(times, size=args.size_2d, directions=args.directions_2d, rotations=args.rotations)
+
+
+def bench_distance_3d(args):
+    t_1 = pershombox.calculate_discrete_NPHT_3d_Lebedev26(shapes.torus_3d(args.size_3d))
+    t_2 = pershombox.calculate_discrete_NPHT_3d_Lebedev26(shapes.perturbed(shapes.torus_3d(args.size_3d), 1))
+
+    times = _time(lambda: pershombox.distance_npht3D_lebedev_26(t_1, t_2, minimize_over_rotations=args.rotations),
+                  args.repeat)
+    return _summary(times, size=args.size_3d, rotations=args.rotations)
+
+
+def bench_metric_error(args):
+    """
+    Deviation of the in-process metrics from the exact (hera) npht distance on perturbed test shapes.
+    Only meaningful if hera is not replaced by a stand-in.
+    """
+    base = shapes.annulus_2d(args.size_2d)
+    transforms = [pershombox.calculate_discrete_NPHT_2d(shapes.perturbed(base, seed, 0.05 * seed), args.directions_2d,
+                                                        **_npht_2d_kwargs())
+                  for seed in range(args.metric_shapes)]
+
+    pairs = [(i, j) for i in range(len(transforms)) for j in range(i + 1, len(transforms))]
+    results = {}
+
+    for metric, kwargs in [('wasserstein', dict(wasserstein_degree=1)),
+                           ('sliced_wasserstein', dict(metric='sliced_wasserstein'))]:
+        start = time.perf_counter()
+        values = [pershombox.distance_npht2D(transforms[i], transforms[j],
+                                             minimize_over_rotations=args.rotations, **kwargs)
+                  for i, j in pairs]
+        results[metric] = {'values': values, 'seconds': time.perf_counter() - start}
+
+    exact = numpy.array(results['wasserstein']['values'])
+    approximation = numpy.array(results['sliced_wasserstein']['values'])
+    ratio = approximation / numpy.where(exact > 0, exact, numpy.nan)
+
+    from scipy.stats import spearmanr
+
+    return {'metrics': results,
+            'ratio_mean': float(numpy.nanmean(ratio)),
+            'ratio_relative_std': float(numpy.nanstd(ratio) / numpy.nanmean(ratio)),
+            'rank_correlation': float(spearmanr(exact, approximation)[0]),
+            'hera': _selected_backends.get('hera_wasserstein_dist')}
+
+
+def _diagram_deviation(dgm_1, dgm_2)->float:
+    """
+    Largest difference of the sorted points, inf if the numbers of points differ.
+    """
+    a = numpy.array(sorted(map(tuple, dgm_1)), dtype=numpy.float64).reshape(-1, 2)
+    b = numpy.array(sorted(map(tuple, dgm_2)), dtype=numpy.float64).reshape(-1, 2)
+
+    if a.shape != b.shape:
+        return float('inf')
+
+    finite = numpy.isfinite(a) & numpy.isfinite(b)
+    if (numpy.isfinite(a) != numpy.isfinite(b)).any():
+        return float('inf')
+
+    return float(numpy.abs(a[finite] - b[finite]).max(initial=0))
+
+
+def bench_perseus_agreement(args):
+    """
+    Agreement of the Perseus cubical backend (sparse format) with DIPHA on the npht of the test shapes,
+    and the running times of both. Only meaningful if neither backend is replaced by a stand-in.
+    """
+    if Backends.perseus not in _configured_backends():
+        return {'perseus': 'missing'}
+
+    transforms = [('npht_2d', lambda backend: pershombox.calculate_discrete_NPHT_2d(
+                       shapes.annulus_2d(args.size_2d), args.directions_2d, backend=backend, **_npht_2d_kwargs())),
+                  ('npht_3d', lambda backend: list(pershombox.calculate_discrete_NPHT_3d_Lebedev26(
+                       shapes.torus_3d(args.size_3d), backend=backend).values()))]
+
+    results = {'dipha': _selected_backends.get('dipha')}
+    for name, transform in transforms:
+        start = time.perf_counter()
+        dipha = transform('dipha')
+        dipha_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        perseus = transform('perseus')
+        perseus_seconds = time.perf_counter() - start
+
+        deviation = max(_diagram_deviation(a, b)
+                        for dgms_1, dgms_2 in zip(dipha, perseus) for a, b in zip(dgms_1, dgms_2))
+
+        results[name] = {'max_deviation': deviation,
+                         'agree': deviation <= 1e-9,
+                         'dipha_seconds': dipha_seconds,
+                         'perseus_seconds': perseus_seconds}
+
+    return results
+
+
+def bench_tile_packing(args):
+    """
+    calculate_discrete_NPHT_2d with all directions packed into one DIPHA call vs. one call per direction:
+    running times and the largest deviation of the diagrams, which has to be 0. Only meaningful if DIPHA is
+    not replaced by a stand-in (its synthetic output depends on the layout).
+    """
+    results = {'dipha': _selected_backends.get('dipha')}
+    if results['dipha'] == 'standin':
+        return results
+
+    for seed in range(args.metric_shapes):
+        shape = shapes.perturbed(shapes.annulus_2d(args.size_2d), seed, 0.05 * seed)
+
+        start = time.perf_counter()
+        single = pershombox.calculate_discrete_NPHT_2d(shape, args.directions_2d, max_cells_per_call=1)
+        single_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        packed = pershombox.calculate_discrete_NPHT_2d(shape, args.directions_2d)
+        packed_seconds = time.perf_counter() - start
+
+        deviation = max(_diagram_deviation(a, b)
+                        for dgms_1, dgms_2 in zip(single, packed) for a, b in zip(dgms_1, dgms_2))
+
+        results['shape_{}'.format(seed)] = {'max_deviation': deviation,
+                                            'exact': deviation == 0,
+                                            'single_seconds': single_seconds,
+                                            'packed_seconds': packed_seconds}
+
+    return results
+
+
+cases = {
+    'import_time': bench_import_time,
+    'image_file_write': bench_image_file_write,
+    'diagram_parse': bench_diagram_parse,
+    'npht_2d': bench_npht_2d,
+    'npht_3d': bench_npht_3d,
+    'npht_3d_dimensions': bench_npht_3d_dimensions,
+    'distance_2d': bench_distance_2d,
+    'distance_3d': bench_distance_3d,
+    'metric_error': bench_metric_error,
+    'perseus_agreement': bench_perseus_agreement,
+    'tile_packing': bench_tile_packing
+}
+
+
+# endregion
+
+
+# region comparison
+
+
+def _medians(results: dict, prefix='')->dict:
+    medians = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+
+        if 'median' in value:
+            medians[prefix + key] = value['median']
+        else:
+            medians.update(_medians(value, prefix + key + '.'))
+
+    return medians
+
+
+def compare(baseline: dict, current: dict, tolerance: float)->[str]:
+    """
+    Returns the cases whose median time grew by more than tolerance (relative) w.r.t. baseline.
+    """
+    old, new = _medians(baseline['results']), _medians(current['results'])
+
+    if baseline['meta']['backends'] != current['meta']['backends']:
+        print('Warning: baseline was recorded with backends {}.'.format(baseline['meta']['backends']))
+
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key] / old[key] if old[key] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  <-- regression'
+            regressions.append(key)
+
+        print('{:<28} {:>10.4f}s -> {:>10.4f}s  x{:.2f}{}'.format(key, old[key], new[key], ratio, flag))
+
+    return regressions
+
+
+# endregion
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', choices=sorted(cases.keys()), default=list(cases.keys()))
+    parser.add_argument('--size-2d', type=int, default=64, help='edge length of the 2D shapes')
+    parser.add_argument('--size-3d', type=int, default=24, help='edge length of the 3D shapes')
+    parser.add_argument('--directions-2d', type=int, default=32)
+    parser.add_argument('--diagram-points', type=int, default=100000)
+    parser.add_argument('--metric-shapes', type=int, default=4, help='number of test shapes of metric_error')
+    parser.add_argument('--rotations', action='store_true', help='minimize over rotations in distance cases')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--standins', choices=['auto', 'always', 'never'], default='auto')
+    parser.add_argument('--output', help='write machine readable results (json) to this file')
+    parser.add_argument('--compare', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slow down of the median tolerated by --compare')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    meta = {'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'backends': select_backends(args.standins),
+            'parameters': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}}
+
+    results = {}
+    for name in args.cases:
+        print('running {} ...'.format(name))
+        results[name] = cases[name](args)
+
+    report = {'meta': meta, 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if len(compare(baseline, report, args.tolerance)) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+Synthetic binary shapes of configurable size for the benchmarks.
+"""
+import numpy
+
+
+def annulus_2d(size: int, holes: int=2)->numpy.ndarray:
+    """
+    Disk of diameter ~size with a ring shaped gap and a few small holes.
+    """
+    x, y = numpy.mgrid[:size, :size]
+    c = (size - 1) / 2
+    r = numpy.sqrt((x - c) ** 2 + (y - c) ** 2)
+
+    shape = (r < 0.45 * size) & ~((r > 0.25 * size) & (r < 0.3 * size))
+
+    for k in range(holes):
+        t = 2 * numpy.pi * k / max(holes, 1)
+        hx, hy = c + 0.37 * size * numpy.cos(t), c + 0.37 * size * numpy.sin(t)
+        shape &= (x - hx) ** 2 + (y - hy) ** 2 > (0.04 * size) ** 2
+
+    return shape
+
+
+def torus_3d(size: int)->numpy.ndarray:
+    """
+    Solid torus with a ball attached to it, filling a size x size x size volume.
+    """
+    x, y, z = numpy.mgrid[:size, :size, :size]
+    c = (size - 1) / 2
+    x, y, z = x - c, y - c, z - c
+
+    big_r, small_r = 0.3 * size, 0.12 * size
+    torus = (numpy.sqrt(x ** 2 + y ** 2) - big_r) ** 2 + z ** 2 < small_r ** 2
+    ball = (x - big_r) ** 2 + y ** 2 + (z - 0.15 * size) ** 2 < (0.15 * size) ** 2
+
+    return torus | ball
+
+
+def perturbed(shape: numpy.ndarray, seed: int, flip_fraction: float=0.01)->numpy.ndarray:
+    """
+    Copy of shape with a fraction of its boundary voxels flipped. Gives a second, similar shape
+    for the distance benchmarks.
+    """
+    rng = numpy.random.RandomState(seed)
+    shape = shape.copy()
+    boundary = shape ^ numpy.roll(shape, 1, axis=0)
+    idx = numpy.flatnonzero(boundary)
+
+    if len(idx) > 0:
+        flip = rng.choice(idx, size=max(1, int(flip_fraction * len(idx))), replace=False)
+        shape.flat[flip] = ~shape.flat[flip]
+
+    return shape
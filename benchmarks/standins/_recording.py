@@ -0,0 +1,92 @@
+"""
+Shared code of the stand-in backend executables.
+
+A stand-in answers a backend call by replaying the output a real backend produced for the very same
+input. Recordings are keyed by a hash over the tool name, the relevant command line flags and the
+content of the input files.
+
+    PERSHOMBOX_RECORDINGS            directory of the recordings (default: benchmarks/recordings).
+    PERSHOMBOX_STANDIN_RECORD_FROM   path of the real executable. If set, the stand-in forwards the call
+                                     to it and records the output instead of replaying.
+
+If no recording exists a cheap synthetic output is produced, such that the benchmarks still exercise
+serialization and parsing with plausible amounts of data.
+
+Only the standard library is used, the stand-ins are executed by whatever python3 is on the PATH.
+"""
+import os
+import sys
+import shutil
+import hashlib
+import subprocess
+
+
+_default_recordings_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'recordings')
+
+
+def recordings_dir():
+    return os.environ.get('PERSHOMBOX_RECORDINGS', _default_recordings_dir)
+
+
+def real_executable():
+    return os.environ.get('PERSHOMBOX_STANDIN_RECORD_FROM', '')
+
+
+def _key_hash(tool: str, flags: [str]):
+    h = hashlib.sha1()
+    h.update(tool.encode())
+    for flag in flags:
+        h.update(b'\0' + str(flag).encode())
+
+    return h
+
+
+def recording_key(tool: str, flags: [str], input_file_paths: [str])->str:
+    h = _key_hash(tool, flags)
+
+    for path in input_file_paths:
+        h.update(b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+
+    return '{}-{}'.format(tool, h.hexdigest())
+
+
+def recording_key_of_contents(tool: str, flags: [str], contents: [bytes])->str:
+    """
+    Same key as recording_key for input files with the given contents. For inputs which can only be read
+    once, e.g., named pipes.
+    """
+    h = _key_hash(tool, flags)
+
+    for content in contents:
+        h.update(b'\0')
+        h.update(content)
+
+    return '{}-{}'.format(tool, h.hexdigest())
+
+
+def recording_path(key: str)->str:
+    return os.path.join(recordings_dir(), key)
+
+
+def store_recording(key: str, source_path: str):
+    os.makedirs(recordings_dir(), exist_ok=True)
+    shutil.copyfile(source_path, recording_path(key))
+
+
+def store_recording_bytes(key: str, content: bytes):
+    os.makedirs(recordings_dir(), exist_ok=True)
+    with open(recording_path(key), 'wb') as f:
+        f.write(content)
+
+
+def forward_to_real_executable(args: [str], capture_stdout=False):
+    p = subprocess.run([real_executable(), *args],
+                       stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    if p.returncode != 0:
+        sys.exit(p.returncode)
+
+    return p.stdout
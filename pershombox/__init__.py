@@ -1,13 +1,42 @@
 from .toplex import toplex_persistence_diagrams
+from .toplex import toplex_persistence_diagrams_batch
 from ._software_backends.dipha_adapter import persistence_diagrams_of_filtrated_cubical_complex \
     as cubical_complex_persistence_diagrams
+from .cubical_backends import cubical_persistence_diagrams
+from .cubical_backends import cubical_persistence_diagrams_batch
+from .cubical_backends import CubicalAutotuner
 
 from .pht import calculate_discrete_NPHT_2d
 from .pht import calculate_discrete_NPHT_3d_Lebedev26
+from .pht import calculate_discrete_NPHT_mesh
+from .pht import calculate_discrete_NPHT_mesh_Lebedev26
+from .pht import principal_axes
+from .dgm_util import DiagramCompaction
 
 from .pht_metric import distance_npht2D
 from .pht_metric import distance_npht3D_lebedev_26
 
+from .pipeline import npht_directory
+from .pipeline import iter_npht_store
+from .pipeline import npht_store_files
+
+from .distance_matrix import DistanceMatrixJob
+from .shared_store import SharedDiagramStore
+
+from .vectorization import persistence_images
+from .vectorization import persistence_landscapes
+from .vectorization import export_padded_diagrams
+from .vectorization import load_padded_diagrams
+
+from .npht_index import NPHTIndex2D
+from .npht_index import NPHTIndex3DLebedev26
+
+from .npht_knn import ExactNPHTSearch2D
+from .npht_knn import ExactNPHTSearch3DLebedev26
+
 from ._software_backends.resource_handler import get_backend_cfg_errors
+from ._software_backends import instrumentation
 
 from ._software_backends.hera_adapter import wasserstein_distance
+from .dgm_metric import sliced_wasserstein_distance
+from .dgm_metric import bottleneck_distance
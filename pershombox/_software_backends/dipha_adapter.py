@@ -6,14 +6,16 @@ Hints for compilation of DIPHA
 install openmpi-bin    (not lib-openmpi-dev)
 }
 """
-import io, os, struct
+import io, os, re, sys, struct
 import numpy
+import shutil
 import functools
 import subprocess
 
 from subprocess import DEVNULL
 from tempfile import TemporaryDirectory
 from .resource_handler import get_path, Backends
+from . import instrumentation
 
 
 __stdout = DEVNULL
@@ -27,6 +29,24 @@ def _get_dipha_path():
     return get_path(Backends.dipha)
 
 
+# Launcher for runs with mpi_processes > 1, e.g., set to 'mpirun' or an absolute path.
+__mpiexec = 'mpiexec'
+
+
+def _get_mpiexec_path():
+    path = shutil.which(__mpiexec)
+    if path is None:
+        raise DiphaAdapterException('{} not found, it is needed for mpi_processes > 1.'.format(__mpiexec))
+
+    return path
+
+
+def mpi_available()->bool:
+    return shutil.which(__mpiexec) is not None
+
+
+# DIPHA reads and writes its files with MPI-IO at explicit offsets, so unlike hera (see named_pipes) its
+# input and output have to be regular files.
 __tmp_dir_fact = TemporaryDirectory
 
 
@@ -64,7 +84,104 @@ def _unpack_from_file(f: io.BufferedReader, type):
     return _unpack(read_bytes, type)[0]
 
 
-def _run_dipha(input_file, output_file, limit_dimensions: int=None, dual: bool=False, benchmark: bool=False):
+class DiphaBenchmarkResult:
+    """
+    DIPHA's own --benchmark report together with the resource usage of the DIPHA process.
+
+    Attributes:
+        summary: dict. The 'key: value' part of the report, e.g.
+            summary['Overall running time in seconds'] = 0.1
+            summary['Individual peak mem in GB of per rank'] = [0.2, 0.2]
+
+        stages: list of dicts, one per line of the detailed per-rank report, with keys
+            'rank', 'time' (s), 'prior_mem' (MB), 'peak_mem' (MB), 'bytes_recv' (MB), 'call'.
+
+        peak_rss: int or None. Peak resident set size of the child process in bytes.
+
+        user_time, system_time: float or None. CPU time of the child process in seconds.
+
+        raw_output: str. Unparsed stdout of DIPHA.
+    """
+    _detail_line = re.compile(r'^\s*([\d.]+)s\s+(\d+) MB\s+(\d+) MB\s+(\d+) MB\s+(.*)$')
+    _rank_line = re.compile(r'^\s*Detailed information for rank (\d+):\s*$')
+
+    def __init__(self, raw_output: str, rusage=None):
+        self.raw_output = raw_output
+        self.summary, self.stages = self._parse(raw_output)
+
+        self.peak_rss = None
+        self.user_time = None
+        self.system_time = None
+
+        if rusage is not None:
+            # ru_maxrss is given in kilobytes on Linux and in bytes on macOS
+            self.peak_rss = int(rusage.ru_maxrss) * (1 if sys.platform == 'darwin' else 1024)
+            self.user_time = rusage.ru_utime
+            self.system_time = rusage.ru_stime
+
+    @classmethod
+    def _parse(cls, raw_output):
+        summary = {}
+        stages = []
+        rank = None
+        key = None
+
+        for line in raw_output.splitlines():
+            stripped = line.strip()
+
+            if stripped == '':
+                continue
+
+            m = cls._rank_line.match(line)
+            if m is not None:
+                rank = int(m.group(1))
+                key = None
+                continue
+
+            m = cls._detail_line.match(line)
+            if m is not None:
+                stages.append({'rank': rank,
+                               'time': float(m.group(1)),
+                               'prior_mem': int(m.group(2)),
+                               'peak_mem': int(m.group(3)),
+                               'bytes_recv': int(m.group(4)),
+                               'call': m.group(5).strip()})
+                continue
+
+            if stripped.endswith(':'):
+                key = stripped[:-1].strip()
+                continue
+
+            if key is not None:
+                summary[key] = cls._parse_value(stripped)
+                key = None
+
+        return summary, stages
+
+    @staticmethod
+    def _parse_value(text):
+        try:
+            values = [float(v) for v in text.split()]
+        except ValueError:
+            return text
+
+        return values[0] if len(values) == 1 else values
+
+    def __repr__(self):
+        return '{}(peak_rss={}, user_time={}, system_time={}, summary={})'.format(
+            type(self).__name__, self.peak_rss, self.user_time, self.system_time, self.summary)
+
+
+def _run_dipha(input_file, output_file, limit_dimensions: int=None, dual: bool=False, benchmark: bool=False,
+               mpi_processes: int=None):
+    """
+    Runs DIPHA. If benchmark is True DIPHA's report is captured and returned as DiphaBenchmarkResult,
+    otherwise None is returned. With mpi_processes > 1 DIPHA is started by mpiexec.
+    """
+    command = [_get_dipha_path()]
+    if mpi_processes is not None and int(mpi_processes) > 1:
+        command = [_get_mpiexec_path(), '-n', str(int(mpi_processes))] + command
+
     args = []
 
     if limit_dimensions is not None:
@@ -79,8 +196,32 @@ def _run_dipha(input_file, output_file, limit_dimensions: int=None, dual: bool=F
 
     args += [input_file, output_file]
 
-    p = subprocess.Popen([_get_dipha_path(),  *args], stdout=__stdout, stderr=__stderr)
-    p.wait()
+    if not benchmark:
+        with instrumentation.stage(Backends.dipha.value, 'spawn'):
+            p = subprocess.Popen([*command, *args], stdout=__stdout, stderr=__stderr)
+
+        with instrumentation.stage(Backends.dipha.value, 'compute'):
+            p.wait()
+
+        return None
+
+    with instrumentation.stage(Backends.dipha.value, 'spawn'):
+        p = subprocess.Popen([*command, *args], stdout=subprocess.PIPE, stderr=__stderr)
+
+    with instrumentation.stage(Backends.dipha.value, 'compute'):
+        raw_output = p.stdout.read()
+        p.stdout.close()
+
+        rusage = None
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(p.pid, 0)
+            # The child is reaped, with returncode set Popen does not wait for it again.
+            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        p.wait()
+
+    return DiphaBenchmarkResult(raw_output.decode(errors='replace'), rusage)
+
 
 # endregion
 
@@ -188,6 +329,52 @@ class _DistanceMatrixFile(_DIPHAFile):
         raise NotImplementedError()
 
 
+class _SparseDistanceMatrixFile(_DIPHAFile):
+    """
+    Sparse distance matrix, pairs which are not listed are at infinite distance.
+
+    Layout after the header (magic number, file type, number of points):
+        number of neighbors of each point           int64 x number_of_points
+        neighbor indices, grouped by point          int64 x number_of_entries
+        distances, same order as the indices        float64 x number_of_entries
+    """
+    _file_type_number = 8
+
+    def __init__(self, number_of_points: int, edges_i: numpy.array, edges_j: numpy.array, distances: numpy.array):
+        """
+        :param number_of_points:
+        :param edges_i, edges_j, distances: Each edge {i, j} with its distance listed once.
+        """
+        super().__init__()
+        self._number_of_points = int(number_of_points)
+        self._edges_i = numpy.asarray(edges_i, dtype=numpy.int64)
+        self._edges_j = numpy.asarray(edges_j, dtype=numpy.int64)
+        self._distances = numpy.asarray(distances, dtype=numpy.float64)
+
+    def write_to_binary_file(self, f):
+        # Write header
+        super(_SparseDistanceMatrixFile, self).write_to_binary_file(f)  # Base class part
+
+        f.write(_pack(self._file_type_number, int))
+        f.write(_pack(self._number_of_points, int))
+
+        # Each edge is stored in the rows of both of its points
+        rows = numpy.concatenate([self._edges_i, self._edges_j])
+        columns = numpy.concatenate([self._edges_j, self._edges_i])
+        values = numpy.concatenate([self._distances, self._distances])
+
+        order = numpy.lexsort((columns, rows))
+        number_of_neighbors = numpy.bincount(rows, minlength=self._number_of_points)
+
+        f.write(number_of_neighbors.astype('<i8').tobytes())
+        f.write(columns[order].astype('<i8').tobytes())
+        f.write(values[order].astype('<f8').tobytes())
+
+    @staticmethod
+    def load_from_binary_file(f):
+        raise NotImplementedError()
+
+
 class _PersistenceDiagramFile(_DIPHAFile):
     """
 
@@ -233,6 +420,68 @@ class _PersistenceDiagramFile(_DIPHAFile):
 # endregion
 
 
+# region Vietoris-Rips helpers
+
+
+def _split_VR_diagram(diagram: _PersistenceDiagramFile, upper_dimension: int)->[[tuple]]:
+    tmp = {}
+    for i in range(upper_dimension):
+        tmp[i] = []
+
+    for dimension, birth, death in diagram.points:
+        if dimension < 0:
+            dimension = -dimension - 1
+            death = float('inf')
+
+        tmp[dimension].append((birth, death))
+
+    return [tmp[key] for key in tmp.keys()]
+
+
+def _neighbors_within_threshold_kdtree(point_cloud, threshold):
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(point_cloud)
+    pairs = tree.query_pairs(threshold, output_type='ndarray')
+
+    if len(pairs) == 0:
+        return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.int64), numpy.empty(0)
+
+    edges_i, edges_j = pairs[:, 0], pairs[:, 1]
+    distances = numpy.linalg.norm(point_cloud[edges_i] - point_cloud[edges_j], axis=1)
+
+    return edges_i, edges_j, distances
+
+
+def _neighbors_within_threshold_blocks(point_cloud, threshold, block_size):
+    from scipy.spatial.distance import cdist
+
+    block_size = int(block_size)
+    if block_size < 1:
+        raise ValueError('Value range of parameter block_size is [1, inf) given was {}'.format(block_size))
+
+    edges_i, edges_j, distances = [], [], []
+
+    for start in range(0, len(point_cloud), block_size):
+        # Only j > i is needed, so the block is compared to the points from start on.
+        block = cdist(point_cloud[start:start + block_size], point_cloud[start:])
+
+        i, j = numpy.nonzero(block <= threshold)
+        upper = j > i
+
+        edges_i.append(i[upper] + start)
+        edges_j.append(j[upper] + start)
+        distances.append(block[i[upper], j[upper]])
+
+    if len(edges_i) == 0:
+        return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.int64), numpy.empty(0)
+
+    return numpy.concatenate(edges_i), numpy.concatenate(edges_j), numpy.concatenate(distances)
+
+
+# endregion
+
+
 # region public functional interface
 
 
@@ -240,7 +489,9 @@ def persistence_diagrams_of_filtrated_cubical_complex(filtrated_cubical_complex:
                                                       limit_dimensions: int=None,
                                                       dual: bool=False,
                                                       benchmark: bool=False,
-                                                      set_inf_to_max_filt_val=False)->[[tuple]]:
+                                                      set_inf_to_max_filt_val=False,
+                                                      benchmark_callback=None,
+                                                      mpi_processes: int=None)->[[tuple]]:
     """
     Calculates the persistence diagram for a cubical complex.
 
@@ -251,6 +502,12 @@ def persistence_diagrams_of_filtrated_cubical_complex(filtrated_cubical_complex:
     where f is the filtration and x_i are the coordinates of the vertex with respect to the canonical basis in the
     positive quadrant on the unit spaced grid.
 
+    :param benchmark: If True DIPHA's benchmark report and the resource usage of the DIPHA process are captured.
+
+    :param benchmark_callback: Called with the DiphaBenchmarkResult if benchmark is True.
+
+    :param mpi_processes: If > 1 DIPHA runs on this many MPI processes (started by mpiexec).
+
     :return:
     List with the points of the persistence diagram of dimension k at position k.
     """
@@ -262,17 +519,23 @@ def persistence_diagrams_of_filtrated_cubical_complex(filtrated_cubical_complex:
         image_data_file_path = os.path.join(tmp_dir, "image_data")
         persistence_diagram_file_path = os.path.join(tmp_dir, "persistence_diagram")
 
-        with open(image_data_file_path, "bw") as f:
-            _ImageDataFile(filtrated_cubical_complex).write_to_binary_file(f)
+        with instrumentation.stage(Backends.dipha.value, 'serialize'):
+            with open(image_data_file_path, "bw") as f:
+                _ImageDataFile(filtrated_cubical_complex).write_to_binary_file(f)
+
+        benchmark_result = _run_dipha(image_data_file_path,
+                                      persistence_diagram_file_path,
+                                      limit_dimensions,
+                                      dual,
+                                      benchmark,
+                                      mpi_processes)
 
-        _run_dipha(image_data_file_path,
-                   persistence_diagram_file_path,
-                   limit_dimensions,
-                   dual,
-                   benchmark)
+        if benchmark_callback is not None and benchmark_result is not None:
+            benchmark_callback(benchmark_result)
 
-        with open(persistence_diagram_file_path, "rb") as f:
-            diagram = _PersistenceDiagramFile.load_from_binary_file(f)
+        with instrumentation.stage(Backends.dipha.value, 'parse'):
+            with open(persistence_diagram_file_path, "rb") as f:
+                diagram = _PersistenceDiagramFile.load_from_binary_file(f)
 
         tmp = {}
         for i in range(dimension):
@@ -292,37 +555,98 @@ def persistence_diagrams_of_filtrated_cubical_complex(filtrated_cubical_complex:
 def persistence_diagrams_of_VR_complex_from_distance_matrix(distance_matrix: numpy.array,
                                                             upper_dimension: int,
                                                             dual: bool = False,
-                                                            benchmark: bool = False) -> [[tuple]]:
+                                                            benchmark: bool = False,
+                                                            benchmark_callback=None) -> [[tuple]]:
     distance_matrix = numpy.array(distance_matrix)
 
     with __tmp_dir_fact() as tmp_dir:
         distance_matrix_file_path = os.path.join(tmp_dir, "distance_matrix")
         persistence_diagram_file_path = os.path.join(tmp_dir, "persistence_diagram")
 
-        with open(distance_matrix_file_path, "bw") as f:
-            _DistanceMatrixFile(distance_matrix).write_to_binary_file(f)
+        with instrumentation.stage(Backends.dipha.value, 'serialize'):
+            with open(distance_matrix_file_path, "bw") as f:
+                _DistanceMatrixFile(distance_matrix).write_to_binary_file(f)
 
-        _run_dipha(distance_matrix_file_path,
-                   persistence_diagram_file_path,
-                   upper_dimension,
-                   dual,
-                   benchmark)
+        benchmark_result = _run_dipha(distance_matrix_file_path,
+                                      persistence_diagram_file_path,
+                                      upper_dimension,
+                                      dual,
+                                      benchmark)
 
-        with open(persistence_diagram_file_path, "rb") as f:
-            diagram = _PersistenceDiagramFile.load_from_binary_file(f)
+        if benchmark_callback is not None and benchmark_result is not None:
+            benchmark_callback(benchmark_result)
 
-        tmp = {}
-        for i in range(upper_dimension):
-            tmp[i] = []
+        with instrumentation.stage(Backends.dipha.value, 'parse'):
+            with open(persistence_diagram_file_path, "rb") as f:
+                diagram = _PersistenceDiagramFile.load_from_binary_file(f)
 
-        for dimension, birth, death in diagram.points:
-            if dimension < 0:
-                dimension = -dimension - 1
-                death = float('inf')
+        return _split_VR_diagram(diagram, upper_dimension)
 
-            tmp[dimension].append((birth, death))
 
-        return [tmp[key] for key in tmp.keys()]
+def persistence_diagrams_of_VR_complex_from_point_cloud(point_cloud: numpy.array,
+                                                        threshold: float,
+                                                        upper_dimension: int,
+                                                        neighbor_search: str='kdtree',
+                                                        block_size: int=1024,
+                                                        dual: bool = False,
+                                                        benchmark: bool = False,
+                                                        benchmark_callback=None) -> [[tuple]]:
+    """
+    Calculates the persistence diagrams of the Vietoris-Rips complex of point_cloud (euclidean distance)
+    truncated at threshold. Only pairs with distance <= threshold are written to DIPHA's sparse distance matrix
+    format, hence memory and disk usage scale with the number of such pairs and not with n^2.
+
+    :param point_cloud: n x d array, one point per row.
+
+    :param threshold: Maximal edge length.
+
+    :param upper_dimension: Passed to DIPHA as --upper_dim. Diagrams of dimension 0, ..., upper_dimension - 1
+    are returned.
+
+    :param neighbor_search: 'kdtree' uses scipy.spatial.cKDTree. 'blocks' computes the distances of
+    block_size points to all others at a time, i.e., needs O(block_size * n) memory.
+
+    :return:
+    List with the points of the persistence diagram of dimension k at position k.
+    """
+    point_cloud = numpy.asarray(point_cloud, dtype=numpy.float64)
+    if point_cloud.ndim != 2:
+        raise ValueError('point_cloud is expected to be a n x d array.')
+
+    threshold = float(threshold)
+    if threshold < 0:
+        raise ValueError('Value range of parameter threshold is [0, inf) given was {}'.format(threshold))
+
+    if neighbor_search == 'kdtree':
+        edges_i, edges_j, distances = _neighbors_within_threshold_kdtree(point_cloud, threshold)
+    elif neighbor_search == 'blocks':
+        edges_i, edges_j, distances = _neighbors_within_threshold_blocks(point_cloud, threshold, block_size)
+    else:
+        raise ValueError("neighbor_search is expected to be 'kdtree' or 'blocks' given was {}".format(
+            neighbor_search))
+
+    with __tmp_dir_fact() as tmp_dir:
+        distance_matrix_file_path = os.path.join(tmp_dir, "sparse_distance_matrix")
+        persistence_diagram_file_path = os.path.join(tmp_dir, "persistence_diagram")
+
+        with instrumentation.stage(Backends.dipha.value, 'serialize'):
+            with open(distance_matrix_file_path, "bw") as f:
+                _SparseDistanceMatrixFile(len(point_cloud), edges_i, edges_j, distances).write_to_binary_file(f)
+
+        benchmark_result = _run_dipha(distance_matrix_file_path,
+                                      persistence_diagram_file_path,
+                                      upper_dimension,
+                                      dual,
+                                      benchmark)
+
+        if benchmark_callback is not None and benchmark_result is not None:
+            benchmark_callback(benchmark_result)
+
+        with instrumentation.stage(Backends.dipha.value, 'parse'):
+            with open(persistence_diagram_file_path, "rb") as f:
+                diagram = _PersistenceDiagramFile.load_from_binary_file(f)
+
+        return _split_VR_diagram(diagram, upper_dimension)
 
 
 # endregion
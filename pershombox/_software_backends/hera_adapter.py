@@ -1,19 +1,116 @@
+import io
 import numpy
 import os
-from subprocess import check_output
+import threading
+from subprocess import Popen, PIPE, CalledProcessError
 from subprocess import DEVNULL
 from .resource_handler import get_path, Backends
+from . import instrumentation
+from . import named_pipes
 from tempfile import TemporaryDirectory
 
 
 __stdout = DEVNULL
 __stderr = DEVNULL
 
+# hera reads each diagram file once and sequentially, so the diagrams are streamed through named pipes.
+# Switched off for the rest of the session if hera fails on pipes but succeeds on files.
+__use_named_pipes = named_pipes.is_supported()
+
 
 def _get_hera_wasserstein_dist_path():
     return get_path(Backends.hera_wasserstein_dist)
 
 
+def _serialize_diagram(dgm)->bytes:
+    with io.BytesIO() as f:
+        numpy.savetxt(f, numpy.array(dgm), delimiter=' ')
+        return f.getvalue()
+
+
+def _to_diagonal(points: numpy.ndarray, internal_norm: float)->numpy.ndarray:
+    """
+    Distance of each point to the diagonal w.r.t. the internal_norm.
+    """
+    half_persistence = (points[:, 1] - points[:, 0]) / 2
+    if internal_norm == numpy.inf:
+        return half_persistence
+
+    return half_persistence * 2 ** (1 / internal_norm)
+
+
+def _closed_form_distance(dgm_1, dgm_2, degree: float, internal_norm: float)->float:
+    """
+    Wasserstein distance of trivial pairs of diagrams (identical, one of them empty, both single points),
+    None for all other pairs. Each answered pair is counted as a skipped backend call.
+    """
+    backend = Backends.hera_wasserstein_dist.value
+    a = numpy.asarray(dgm_1, dtype=numpy.float64).reshape(-1, 2)
+    b = numpy.asarray(dgm_2, dtype=numpy.float64).reshape(-1, 2)
+
+    if len(a) == len(b):
+        # identical as multisets
+        if numpy.array_equal(a[numpy.lexsort(a.T[::-1])], b[numpy.lexsort(b.T[::-1])]):
+            instrumentation.count(backend, 'skipped_identical')
+            return 0.0
+
+    if len(a) == 0 or len(b) == 0:
+        to_diagonal = _to_diagonal(a if len(b) == 0 else b, internal_norm)
+        instrumentation.count(backend, 'skipped_empty')
+        return float((to_diagonal ** degree).sum() ** (1 / degree))
+
+    if len(a) == 1 and len(b) == 1 and numpy.isfinite(a).all() and numpy.isfinite(b).all():
+        # Either both points are matched to each other or both to the diagonal.
+        direct = numpy.linalg.norm(a[0] - b[0], ord=internal_norm)
+        to_diagonal = numpy.concatenate([_to_diagonal(a, internal_norm), _to_diagonal(b, internal_norm)])
+        via_diagonal = (to_diagonal ** degree).sum() ** (1 / degree)
+
+        instrumentation.count(backend, 'skipped_single_point')
+        return float(min(direct, via_diagonal))
+
+    return None
+
+
+def _run_hera(dgm_file_paths: [str], args: [str])->(int, bytes, list):
+    cmd = [_get_hera_wasserstein_dist_path(), *dgm_file_paths, *args]
+
+    with instrumentation.stage(Backends.hera_wasserstein_dist.value, 'spawn'):
+        p = Popen(cmd, stdout=PIPE, stderr=__stderr)
+
+    with instrumentation.stage(Backends.hera_wasserstein_dist.value, 'compute'):
+        out, _ = p.communicate()
+
+    return p.returncode, out, cmd
+
+
+def _run_hera_on_named_pipes(tmp_dir: str, contents: [bytes], args: [str])->float:
+    """
+    Returns None if hera could not consume the diagrams through named pipes.
+    """
+    stopped = threading.Event()
+    paths = [os.path.join(tmp_dir, 'dgm_1_pipe'), os.path.join(tmp_dir, 'dgm_2_pipe')]
+    writers = [named_pipes.FifoWriter(path, data, stopped) for path, data in zip(paths, contents)]
+
+    for w in writers:
+        w.start()
+
+    try:
+        returncode, out, _ = _run_hera(paths, args)
+    finally:
+        stopped.set()
+        for w in writers:
+            w.join()
+
+    if returncode != 0 or not all(w.delivered for w in writers):
+        return None
+
+    with instrumentation.stage(Backends.hera_wasserstein_dist.value, 'parse'):
+        try:
+            return float(out.rstrip())
+        except ValueError:
+            return None
+
+
 def wasserstein_distance(dgm_1: [[]], dgm_2: [[]], degree: float=2.0, internal_norm='inf', relative_error: float=0.01)->float:
     """
     Calculates wasserstein_distance distance of two persistence diagrams.
@@ -29,6 +126,8 @@ def wasserstein_distance(dgm_1: [[]], dgm_2: [[]], degree: float=2.0, internal_n
     Returns
     -------
 
+    Trivial pairs are answered in-process without calling hera: identical diagrams (distance 0),
+    an empty diagram (all points are matched to the diagonal) and two single finite points.
     """
 
     # region parameter checking
@@ -53,20 +152,44 @@ def wasserstein_distance(dgm_1: [[]], dgm_2: [[]], degree: float=2.0, internal_n
 
     #endregion
 
+    distance = _closed_form_distance(dgm_1, dgm_2, float(degree),
+                                     numpy.inf if internal_norm == 'inf' else float(internal_norm))
+    if distance is not None:
+        return distance
+
+    args = [degree, relative_error, internal_norm]
+
+    global __use_named_pipes
+
     with TemporaryDirectory() as tmp_dir:
+        with instrumentation.stage(Backends.hera_wasserstein_dist.value, 'serialize'):
+            contents = [_serialize_diagram(dgm_1), _serialize_diagram(dgm_2)]
+
+        streamed = __use_named_pipes
+        if streamed:
+            distance = _run_hera_on_named_pipes(tmp_dir, contents, args)
+            if distance is not None:
+                return distance
+
         dgm_1_file_path = os.path.join(tmp_dir, 'dgm_1')
         dgm_2_file_path = os.path.join(tmp_dir, 'dgm_2')
 
-        numpy.savetxt(dgm_1_file_path, numpy.array(dgm_1), delimiter=' ')
-        numpy.savetxt(dgm_2_file_path, numpy.array(dgm_2), delimiter=' ')
+        with instrumentation.stage(Backends.hera_wasserstein_dist.value, 'serialize'):
+            for path, data in zip([dgm_1_file_path, dgm_2_file_path], contents):
+                with open(path, 'wb') as f:
+                    f.write(data)
+
+        returncode, out, cmd = _run_hera([dgm_1_file_path, dgm_2_file_path], args)
+
+        if returncode != 0:
+            raise CalledProcessError(returncode, cmd, output=out)
 
-        cmd = [_get_hera_wasserstein_dist_path(),
-               dgm_1_file_path,
-               dgm_2_file_path,
-               degree,
-               relative_error,
-               internal_norm]
+        with instrumentation.stage(Backends.hera_wasserstein_dist.value, 'parse'):
+            distance = float(out.rstrip())
 
-        out = check_output(cmd)
+        if streamed:
+            # hera fails on pipes only, e.g., a build which seeks in its input files.
+            __use_named_pipes = False
+            instrumentation.count(Backends.hera_wasserstein_dist.value, 'named_pipe_fallback')
 
-        return float(out.rstrip())
+        return distance
@@ -0,0 +1,243 @@
+"""
+Per-stage timing and call counting for the software backends and the persistent homology transforms.
+
+Recording is disabled by default, then stage(...) returns a shared no-op context manager and
+count(...) returns immediately.
+
+Example:
+
+    from pershombox import instrumentation
+
+    with instrumentation.recording():
+        distance_npht2D(t_1, t_2)
+        stats = instrumentation.snapshot()
+
+    stats['hera_wasserstein_dist']['compute']
+    -> {'count': 64, 'total': 0.41, 'mean': 0.0064, 'min': 0.0051, 'max': 0.011}
+
+Stages used inside pershombox:
+
+    dipha, hera_wasserstein_dist, perseus:
+        serialize   writing the input files
+        spawn       starting the subprocess
+        compute     waiting for the subprocess
+        parse       reading the output
+
+    hera_wasserstein_dist:
+        named_pipe_fallback   count, hera failed on named pipes and files are used from then on
+        skipped_identical, skipped_empty, skipped_single_point
+                              counts of pairs answered in closed form without calling hera
+
+    pht_2d, pht_3d, pht_mesh:
+        filtration  computing the filtrated complex of one direction
+        direction   one complete iteration over a direction (pht_3d, pht_mesh)
+        persistence the (packed) backend calls of all directions (pht_2d)
+
+    cubical_tiles (see cubical_backends.cubical_persistence_diagrams_batch):
+        pack, unpack          building a packed complex and splitting its diagrams
+        tiles                 count of complexes packed into shared calls
+        fallback              count of packed complexes recalculated by one call each (TileUnpackingError)
+
+    npht_distance (coarse_relative_error and pre_alignment_top_k of the npht distances):
+        candidates_refined, candidates_pruned
+                    counts of rotations recalculated with the fine relative error and pruned ones
+        pre_alignment_used, pre_alignment_fallback
+                    counts of distances searched over the best aligned rotations and over all rotations
+
+    compaction (see DiagramCompaction):
+        points      count of points before compaction
+        removed     count of points dropped
+
+    cubical_autotune (see cubical_backends):
+        <configuration name>  count of calls run with this configuration
+
+    distance_matrix:
+        pack        packing the collection into a SharedDiagramStore for the workers
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+
+__enabled = False
+__lock = threading.Lock()
+
+# (backend, stage) -> [count, total, min, max]
+__stats = {}
+__callbacks = []
+
+
+class _NoOpStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_no_op_stage = _NoOpStage()
+
+
+class _Stage:
+    __slots__ = ('backend', 'name', '_start')
+
+    def __init__(self, backend: str, name: str):
+        self.backend = backend
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record(self.backend, self.name, time.perf_counter() - self._start)
+        return False
+
+
+def _update(backend, name, duration, n):
+    with __lock:
+        entry = __stats.get((backend, name))
+        if entry is None:
+            __stats[(backend, name)] = [n, duration, duration, duration]
+        else:
+            entry[0] += n
+            entry[1] += duration
+            entry[2] = min(entry[2], duration)
+            entry[3] = max(entry[3], duration)
+
+        callbacks = list(__callbacks)
+
+    for callback in callbacks:
+        callback(backend, name, duration)
+
+
+# region public interface
+
+
+def is_enabled()->bool:
+    return __enabled
+
+
+def enable():
+    global __enabled
+    __enabled = True
+
+
+def disable():
+    global __enabled
+    __enabled = False
+
+
+def reset():
+    with __lock:
+        __stats.clear()
+
+
+def stage(backend: str, name: str):
+    """
+    Context manager timing the enclosed block as stage name of backend.
+    """
+    if not __enabled:
+        return _no_op_stage
+
+    return _Stage(backend, name)
+
+
+def record(backend: str, name: str, duration: float):
+    """
+    Records one call of stage name of backend which took duration seconds.
+    """
+    if __enabled:
+        _update(backend, name, duration, 1)
+
+
+def count(backend: str, name: str, n: int=1):
+    """
+    Increments the counter name of backend by n without timing anything.
+    """
+    if __enabled:
+        _update(backend, name, 0.0, n)
+
+
+def add_callback(callback):
+    """
+    callback(backend, stage, duration) is called after each recorded stage or count.
+    """
+    with __lock:
+        __callbacks.append(callback)
+
+
+def remove_callback(callback):
+    with __lock:
+        __callbacks.remove(callback)
+
+
+@contextmanager
+def recording(callback=None, reset_stats: bool=True):
+    """
+    Enables recording for the enclosed block and restores the previous state afterwards.
+
+    :param callback: optional, registered via add_callback for the enclosed block.
+    :param reset_stats: if True the statistics are reset when entering the block.
+    """
+    was_enabled = is_enabled()
+
+    if reset_stats:
+        reset()
+
+    if callback is not None:
+        add_callback(callback)
+
+    enable()
+    try:
+        yield
+
+    finally:
+        if not was_enabled:
+            disable()
+
+        if callback is not None:
+            remove_callback(callback)
+
+
+def merge(stats: dict):
+    """
+    Adds statistics as returned by snapshot, e.g., recorded in a worker process, to the current statistics.
+    Callbacks are not called.
+    """
+    with __lock:
+        for backend, stages in stats.items():
+            for name, s in stages.items():
+                entry = __stats.get((backend, name))
+                if entry is None:
+                    __stats[(backend, name)] = [s['count'], s['total'], s['min'], s['max']]
+                else:
+                    entry[0] += s['count']
+                    entry[1] += s['total']
+                    entry[2] = min(entry[2], s['min'])
+                    entry[3] = max(entry[3], s['max'])
+
+
+def snapshot()->dict:
+    """
+    Aggregated statistics.
+
+    :return: snapshot()[backend][stage] = {'count', 'total', 'mean', 'min', 'max'} (durations in seconds).
+    """
+    with __lock:
+        items = [(k, list(v)) for k, v in __stats.items()]
+
+    return_value = {}
+    for (backend, name), (n, total, minimum, maximum) in sorted(items):
+        return_value.setdefault(backend, {})[name] = {'count': n,
+                                                      'total': total,
+                                                      'mean': total / n if n > 0 else 0.0,
+                                                      'min': minimum,
+                                                      'max': maximum}
+
+    return return_value
+
+
+# endregion
@@ -0,0 +1,77 @@
+"""
+Feeding backend inputs through named pipes (os.mkfifo) instead of temporary files.
+
+A writer thread opens the pipe as soon as the backend opens it for reading and streams the serialized input,
+so the data never hits the disk. A pipe can only be read once and front to back, hence this is only used for
+tools which open each input exactly once and read it sequentially (hera). DIPHA reads and writes its files
+with MPI-IO at explicit offsets and keeps using regular files.
+
+If a tool does seek, it fails on the pipe (ESPIPE) or closes it early. The adapters detect this
+(see FifoWriter.delivered) and fall back to regular files.
+"""
+import os
+import time
+import errno
+import threading
+
+
+def is_supported()->bool:
+    return hasattr(os, 'mkfifo')
+
+
+class FifoWriter(threading.Thread):
+    def __init__(self, path: str, data: bytes, stopped: threading.Event):
+        """
+        Creates the named pipe path. After start, data is written to it once a reader opened it.
+
+        :param stopped: set by the caller when the reading process terminated. The writer gives up waiting
+            for a reader then.
+        """
+        super().__init__(daemon=True)
+        os.mkfifo(path)
+
+        self.path = path
+        self.data = data
+        self.stopped = stopped
+
+        self.delivered = False
+        self.error = None
+
+    def _open(self):
+        delay = 1e-4
+        while True:
+            try:
+                # Non-blocking, fails with ENXIO as long as there is no reader.
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as ex:
+                if ex.errno != errno.ENXIO:
+                    raise
+
+                if self.stopped.is_set():
+                    return None
+
+                time.sleep(delay)
+                delay = min(2 * delay, 0.01)
+                continue
+
+            os.set_blocking(fd, True)
+            return fd
+
+    def run(self):
+        try:
+            fd = self._open()
+            if fd is None:
+                return
+
+            try:
+                view = memoryview(self.data)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+
+            self.delivered = True
+
+        except OSError as ex:
+            # e.g. BrokenPipeError, the reader closed the pipe before reading everything
+            self.error = ex
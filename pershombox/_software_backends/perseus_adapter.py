@@ -1,9 +1,11 @@
+import io
 import os
 import numpy
-from subprocess import call
+from subprocess import Popen
 from tempfile import TemporaryDirectory
 from subprocess import DEVNULL
 from .resource_handler import get_path, Backends
+from . import instrumentation
 
 
 __stdout = DEVNULL
@@ -14,44 +16,162 @@ def _get_perseus_path():
     return get_path(Backends.perseus)
 
 
-def _call_perseus(complex_type, complex_file_string):
+def _call_perseus(complex_type, complex_file_string, scratch_dir: str=None):
+    """
+    :param scratch_dir: directory in which the temporary directory of this call is created,
+        defaults to the system's temporary directory.
+    """
     def get_dim_from_dgm_file(name):
         x = name.split('.txt')[0]
         x = x.split('_')[1]
         return int(x)
 
-    with TemporaryDirectory() as tmp_dir:
+    with TemporaryDirectory(dir=scratch_dir) as tmp_dir:
         comp_file_path = os.path.join(tmp_dir, 'complex.txt')
         perseus_path = _get_perseus_path()
 
-        with open(comp_file_path, 'w') as comp_file:
-            comp_file.write(complex_file_string)
+        with instrumentation.stage(Backends.perseus.value, 'serialize'):
+            with open(comp_file_path, 'w') as comp_file:
+                comp_file.write(complex_file_string)
 
-        call([perseus_path, complex_type, comp_file_path, tmp_dir + '/'], stdout=__stdout, stderr=__stderr)
+        with instrumentation.stage(Backends.perseus.value, 'spawn'):
+            p = Popen([perseus_path, complex_type, comp_file_path, tmp_dir + '/'], stdout=__stdout, stderr=__stderr)
 
-        # dgm file names are assumed to be like output_0.txt
-        diagram_files = [name for name in os.listdir(tmp_dir) if name.startswith('_') and name != '_betti.txt']
+        with instrumentation.stage(Backends.perseus.value, 'compute'):
+            p.wait()
 
-        dgms = {}
-        for name in diagram_files:
-            dim = get_dim_from_dgm_file(name)
-            dgm_file_path = os.path.join(tmp_dir, name)
+        with instrumentation.stage(Backends.perseus.value, 'parse'):
+            # dgm file names are assumed to be like output_0.txt
+            diagram_files = [name for name in os.listdir(tmp_dir) if name.startswith('_') and name != '_betti.txt']
 
-            if os.stat(dgm_file_path).st_size == 0:
-                dgms[dim] = []
+            dgms = {}
+            for name in diagram_files:
+                dim = get_dim_from_dgm_file(name)
+                dgm_file_path = os.path.join(tmp_dir, name)
 
-            else:
-                dgm = numpy.loadtxt(dgm_file_path)
+                if os.stat(dgm_file_path).st_size == 0:
+                    dgms[dim] = []
 
-                if dgm.ndim == 2:
-                    dgms[dim] = dgm.tolist()
-                elif dgm.ndim == 1:
-                    dgms[dim] = [dgm.tolist()]
                 else:
-                    raise ValueError('Oddly shaped array read from dgm_file_path.')
+                    dgm = numpy.loadtxt(dgm_file_path)
+
+                    if dgm.ndim == 2:
+                        dgms[dim] = dgm.tolist()
+                    elif dgm.ndim == 1:
+                        dgms[dim] = [dgm.tolist()]
+                    else:
+                        raise ValueError('Oddly shaped array read from dgm_file_path.')
 
         return dgms
 
 
 class PerseusAdapterException(Exception):
     pass
+
+
+# region cubical complexes
+
+
+def _vertex_construction_cells(filtrated_cubical_complex: numpy.ndarray)->numpy.ndarray:
+    """
+    The values are on the vertices, each cube gets the maximum of its vertices (as DIPHA). Returns the
+    (2 n_1 - 1) x ... x (2 n_d - 1) array of the values of all cubes, indexed by twice their barycenter.
+
+    As top-dimensional cubes of a complex where faces get the minimum of their cofaces (Perseus), this
+    array gives a filtration with the same persistence diagrams.
+    """
+    cells = filtrated_cubical_complex
+    for axis in range(cells.ndim):
+        n = cells.shape[axis]
+        shape = list(cells.shape)
+        shape[axis] = 2 * n - 1
+
+        expanded = numpy.empty(shape, dtype=cells.dtype)
+        even = [slice(None)] * cells.ndim
+        odd = [slice(None)] * cells.ndim
+        even[axis] = slice(0, None, 2)
+        odd[axis] = slice(1, None, 2)
+
+        expanded[tuple(even)] = cells
+        expanded[tuple(odd)] = numpy.maximum(cells.take(range(n - 1), axis=axis), cells.take(range(1, n), axis=axis))
+        cells = expanded
+
+    return cells
+
+
+def _sparse_cubical_toplex_string(cells: numpy.ndarray)->(str, numpy.ndarray):
+    """
+    Perseus' sparse cubical toplex format (scubtop): the dimension, then one line per present top-dimensional
+    cube with the coordinates of its anchor vertex followed by its (integer) birth time. Cubes with value inf
+    are not present. Birth times are the ranks 1, 2, ... of the values, the second return value maps
+    rank - 1 to the value.
+    """
+    coordinates = numpy.argwhere(numpy.isfinite(cells))
+    values, ranks = numpy.unique(cells[tuple(coordinates.T)], return_inverse=True)
+
+    with io.StringIO() as f:
+        f.write('{}\n'.format(cells.ndim))
+        numpy.savetxt(f, numpy.column_stack([coordinates, ranks + 1]), fmt='%d')
+        return f.getvalue(), values
+
+
+def persistence_diagrams_of_filtrated_cubical_complex(filtrated_cubical_complex: numpy.array,
+                                                      limit_dimensions: int=None,
+                                                      set_inf_to_max_filt_val=False,
+                                                      construction: str='vertex',
+                                                      scratch_dir: str=None)->[[tuple]]:
+    """
+    Calculates the persistence diagrams of a cubical complex by Perseus. Only the cells with finite
+    filtration value are written (sparse format), cells with value inf are not part of the complex.
+
+    :param filtrated_cubical_complex: as for dipha_adapter.persistence_diagrams_of_filtrated_cubical_complex.
+
+    :param limit_dimensions: diagrams of dimension >= limit_dimensions are returned empty (Perseus calculates
+        all dimensions).
+
+    :param construction: 'vertex' -> values on the vertices, cubes get the maximum of their vertices.
+        This is the complex of DIPHA, hence the diagrams agree with the DIPHA backend. The complex is written
+        on the doubled grid, i.e., with 2^d times as many cubes as finite values.
+        'top_cell' -> values on the top-dimensional cubes, faces get the minimum of their cofaces. The
+        finite values are written as they are.
+
+    :param scratch_dir: see _call_perseus.
+
+    :return:
+    List with the points of the persistence diagram of dimension k at position k.
+    """
+    filtrated_cubical_complex = numpy.asarray(filtrated_cubical_complex, dtype=numpy.float64)
+    dimension = filtrated_cubical_complex.ndim
+
+    if construction == 'vertex':
+        cells = _vertex_construction_cells(filtrated_cubical_complex)
+    elif construction == 'top_cell':
+        cells = filtrated_cubical_complex
+    else:
+        raise ValueError("construction is expected to be 'vertex' or 'top_cell' given was {}".format(construction))
+
+    if not numpy.isfinite(cells).any():
+        return [[] for _ in range(dimension)]
+
+    complex_string, values = _sparse_cubical_toplex_string(cells)
+    dgms = _call_perseus('scubtop', complex_string, scratch_dir=scratch_dir)
+
+    # rank -> value, Perseus' death time -1 of essential classes -> last entry
+    lookup = numpy.concatenate([values, [values[-1] if set_inf_to_max_filt_val else float('inf')]])
+
+    return_value = []
+    for dim in range(dimension):
+        if limit_dimensions is not None and dim >= limit_dimensions:
+            return_value.append([])
+            continue
+
+        points = numpy.asarray(dgms.get(dim, []), dtype=numpy.float64).reshape(-1, 2)
+        indices = numpy.rint(points).astype(numpy.int64) - 1
+        indices[indices < 0] = len(values)
+
+        return_value.append([tuple(p) for p in lookup[indices].tolist()])
+
+    return return_value
+
+
+# endregion
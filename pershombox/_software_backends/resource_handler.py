@@ -39,8 +39,12 @@ class SoftwareBackendError(Exception):
     pass
 
 
-def init_backend(backend: Backends):
-    path = parser.get('paths', backend.value)
+def init_backend(backend: Backends, path: str=None):
+    """
+    Locates the executable of backend. If path is None the entry of software_backends.cfg is used.
+    """
+    if path is None:
+        path = parser.get('paths', backend.value)
 
     if path == '':
         path = __fall_backs[backend]
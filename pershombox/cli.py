@@ -0,0 +1,275 @@
+"""
+Command line front-end, run as
+
+    python -m pershombox <command> ...
+
+Commands:
+
+    cubical INPUT_DIR OUTPUT_DIR            persistence diagrams of filtrated cubical complexes (.npy)
+    npht2d INPUT_DIR OUTPUT_DIR             calculate_discrete_NPHT_2d of binary images (.npy)
+    npht3d INPUT_DIR OUTPUT_DIR             calculate_discrete_NPHT_3d_Lebedev26 of binary volumes (.npy)
+    distance-matrix STORE_DIR JOB_DIR       all-pairs distances of the transforms in STORE_DIR (output of npht2d/npht3d)
+    calibrate                               benchmark the cubical backends for --backend auto
+
+Results are stored as described in pipeline.npht_directory and distance_matrix.DistanceMatrixJob, runs are
+resumable. All commands use a process pool with --jobs workers (default: all cores) and print the per-stage
+throughput at the end.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from ._software_backends import instrumentation
+
+
+_backends = ('dipha', 'dipha_dual', 'dipha_mpi<k>', 'dipha_dual_mpi<k>', 'perseus', 'auto')
+
+
+def _backend(name: str)->str:
+    from .cubical_backends import CubicalConfiguration
+
+    if name != 'auto':
+        try:
+            CubicalConfiguration.from_name(name)
+        except ValueError:
+            raise argparse.ArgumentTypeError('expected one of {}, given was {}'.format(', '.join(_backends), name))
+
+    return name
+
+
+def _configuration(name: str)->str:
+    """
+    Like _backend without 'auto', which is no configuration to calibrate.
+    """
+    if name == 'auto':
+        raise argparse.ArgumentTypeError('auto is no configuration, expected one of {}'.format(
+            ', '.join(b for b in _backends if b != 'auto')))
+
+    return _backend(name)
+
+
+def _set_scratch_dir(path: str):
+    """
+    Temporary files (backend input/output) of this process and its workers go to path.
+    """
+    os.makedirs(path, exist_ok=True)
+    os.environ['TMPDIR'] = os.path.abspath(path)
+    tempfile.tempdir = os.path.abspath(path)
+
+
+def _progress(verbose: bool):
+    def callback(relative_path, status):
+        if verbose or status == 'failed':
+            print('{:<9} {}'.format(status, relative_path), file=sys.stderr)
+
+    return callback
+
+
+def _print_throughput(stats: dict, wall_time: float, file=sys.stdout):
+    print('{:<36} {:>9} {:>11} {:>10} {:>10}'.format('stage', 'count', 'total [s]', 'mean [ms]', 'per second'),
+          file=file)
+
+    for backend, stages in stats.items():
+        for name, s in stages.items():
+            print('{:<36} {:>9} {:>11.3f} {:>10.3f} {:>10.1f}'.format(
+                backend + '.' + name, s['count'], s['total'], 1000 * s['mean'],
+                s['count'] / wall_time if wall_time > 0 else float('inf')), file=file)
+
+    print('wall time {:.3f}s'.format(wall_time), file=file)
+
+
+# region commands
+
+
+def _run_directory(args, transform, **transform_kwargs)->int:
+    from .pipeline import npht_directory
+
+    summary = npht_directory(args.input_dir, args.output_dir,
+                             transform=transform,
+                             workers=args.jobs,
+                             progress_callback=_progress(args.verbose),
+                             **transform_kwargs)
+
+    instrumentation.count('cli', 'computed', summary['computed'])
+    instrumentation.count('cli', 'skipped', summary['skipped'])
+    instrumentation.count('cli', 'failed', len(summary['failed']))
+
+    for relative_path, error in summary['failed']:
+        print('failed {}: {}'.format(relative_path, error), file=sys.stderr)
+
+    return 1 if len(summary['failed']) > 0 else 0
+
+
+def command_cubical(args)->int:
+    return _run_directory(args, 'cubical', backend=args.backend, dual=args.dual,
+                          set_inf_to_max_filt_val=args.set_inf_to_max_filt_val)
+
+
+def _compaction(args):
+    from .dgm_util import DiagramCompaction
+
+    if args.min_persistence is None and args.grid is None:
+        return None
+
+    return DiagramCompaction(min_persistence=args.min_persistence or 0.0, grid=args.grid)
+
+
+def command_npht2d(args)->int:
+    return _run_directory(args, '2d', number_of_directions=args.directions, compaction=_compaction(args),
+                          dimensions=args.dimensions, backend=args.backend,
+                          max_cells_per_call=args.max_cells_per_call)
+
+
+def command_npht3d(args)->int:
+    return _run_directory(args, 'lebedev26', compaction=_compaction(args), dimensions=args.dimensions,
+                          backend=args.backend, with_principal_axes=args.principal_axes)
+
+
+def command_distance_matrix(args)->int:
+    from .pipeline import npht_store_files
+    from .distance_matrix import DistanceMatrixJob, _job_file_name
+
+    store_files = [os.path.abspath(p) for p in npht_store_files(args.store_dir)]
+
+    if os.path.isfile(os.path.join(args.job_dir, _job_file_name)):
+        job = DistanceMatrixJob(args.job_dir)
+        known = set(job.collection)
+        job.append([p for p in store_files if p not in known])
+    else:
+        distance_kwargs = {'minimize_over_rotations': not args.no_rotations,
+                           'metric': args.metric}
+        if args.dimensions is not None:
+            distance_kwargs['included_dimensions'] = args.dimensions
+        if args.pre_alignment_top_k is not None:
+            distance_kwargs['pre_alignment_top_k'] = args.pre_alignment_top_k
+
+        job = DistanceMatrixJob.create(args.job_dir, store_files,
+                                       distance=args.transform,
+                                       block_size=args.block_size,
+                                       **distance_kwargs)
+
+    k, number_of_machines = (int(x) for x in args.machine.split('/'))
+    job.run(workers=args.jobs, machine=(k, number_of_machines))
+    instrumentation.count('cli', 'shards', len(job.shards()))
+
+    pending = job.pending_shards()
+    if len(pending) > 0:
+        print('{} shards pending on other machines, merge once they are done.'.format(len(pending)),
+              file=sys.stderr)
+        return 0
+
+    job.merge()
+    print('distance matrix of {} transforms written to {}'.format(len(job), job.job_dir), file=sys.stderr)
+    return 0
+
+
+def command_calibrate(args)->int:
+    from .cubical_backends import calibrate, candidate_configurations, default_model_path
+
+    configurations = args.configurations or candidate_configurations(args.max_mpi_processes)
+
+    def progress(measurement):
+        if args.verbose:
+            print('{configuration:<24} ndim {ndim} {number_of_cells:>9} cells {foreground_fraction:.2f} '
+                  'foreground {time:.4f}s'.format(**measurement), file=sys.stderr)
+
+    model = calibrate(configurations=configurations, repeats=args.repeats, progress_callback=progress)
+
+    path = args.model or default_model_path()
+    model.save(path)
+    print('cost model of {} written to {}'.format(', '.join(sorted(model.coefficients)), path), file=sys.stderr)
+    return 0
+
+
+# endregion
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pershombox', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes, default: os.cpu_count(), 0 runs in-process')
+    common.add_argument('--backend', type=_backend, default='dipha',
+                        help='software backend for the persistence computations, one of {}. auto picks the '
+                             'fastest by the model of the calibrate command'.format(', '.join(_backends)))
+    common.add_argument('--scratch-dir', default=None,
+                        help='directory for temporary backend files, e.g., a node local ssd or tmpfs')
+    common.add_argument('--verbose', '-v', action='store_true', help='report every input')
+
+    compaction = argparse.ArgumentParser(add_help=False)
+    compaction.add_argument('--min-persistence', type=float, default=None,
+                            help='drop points with death - birth <= this value (see DiagramCompaction)')
+    compaction.add_argument('--grid', type=float, default=None, help='round birth and death to this grid')
+    compaction.add_argument('--dimensions', type=int, nargs='+', default=None,
+                            help='homology dimensions to calculate, default: all')
+
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('cubical', parents=[common], help='persistence diagrams of cubical complexes')
+    p.add_argument('input_dir')
+    p.add_argument('output_dir')
+    p.add_argument('--dual', action='store_true', help='use the dual algorithm of DIPHA')
+    p.add_argument('--set-inf-to-max-filt-val', action='store_true')
+    p.set_defaults(run=command_cubical)
+
+    p = commands.add_parser('npht2d', parents=[common, compaction], help='NPHT of binary images')
+    p.add_argument('input_dir')
+    p.add_argument('output_dir')
+    p.add_argument('--directions', type=int, default=32)
+    p.add_argument('--max-cells-per-call', type=int, default=None,
+                   help='directions are packed into backend calls of at most this many cells, 1 disables packing')
+    p.set_defaults(run=command_npht2d)
+
+    p = commands.add_parser('npht3d', parents=[common, compaction],
+                            help='NPHT of binary volumes (Lebedev 26 directions)')
+    p.add_argument('input_dir')
+    p.add_argument('output_dir')
+    p.add_argument('--principal-axes', action='store_true',
+                   help='store the principal axes of each volume, see distance-matrix --pre-alignment-top-k')
+    p.set_defaults(run=command_npht3d)
+
+    p = commands.add_parser('distance-matrix', parents=[common], help='all-pairs NPHT distance matrix')
+    p.add_argument('store_dir', help='output directory of npht2d/npht3d')
+    p.add_argument('job_dir')
+    p.add_argument('--transform', choices=['2d', 'lebedev26'], required=True)
+    p.add_argument('--block-size', type=int, default=32)
+    p.add_argument('--machine', default='0/1', help='k/K, compute the shards of machine k out of K')
+    p.add_argument('--metric', choices=['wasserstein', 'sliced_wasserstein', 'bottleneck'], default='wasserstein')
+    p.add_argument('--dimensions', type=int, nargs='+', default=None, help='included homology dimensions')
+    p.add_argument('--no-rotations', action='store_true', help='do not minimize over rotations')
+    p.add_argument('--pre-alignment-top-k', type=int, default=None,
+                   help='lebedev26: only search the k rotations aligning the principal axes best (npht3d '
+                        '--principal-axes), falls back to all rotations if the axes are ambiguous')
+    p.set_defaults(run=command_distance_matrix)
+
+    p = commands.add_parser('calibrate', parents=[common], help='calibrate the cost model of --backend auto')
+    p.add_argument('--model', default=None,
+                   help='output file, default: $PERSHOMBOX_CUBICAL_AUTOTUNE_MODEL or ~/.cache/pershombox/')
+    p.add_argument('--configurations', type=_configuration, nargs='+', default=None,
+                   help='configurations to measure, default: dipha(_dual) on 1, 2, 4, ... MPI processes '
+                        'and perseus')
+    p.add_argument('--max-mpi-processes', type=int, default=None)
+    p.add_argument('--repeats', type=int, default=2)
+    p.set_defaults(run=command_calibrate)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None)->int:
+    args = parse_args(argv)
+
+    if args.scratch_dir is not None:
+        _set_scratch_dir(args.scratch_dir)
+
+    start = time.perf_counter()
+    with instrumentation.recording():
+        return_code = args.run(args)
+        stats = instrumentation.snapshot()
+
+    _print_throughput(stats, time.perf_counter() - start)
+    return return_code
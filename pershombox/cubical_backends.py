@@ -0,0 +1,576 @@
+"""
+Choice of the software backend (and its flags) for the persistence diagrams of filtrated cubical complexes.
+
+Backends are given by name:
+
+    'dipha'                 DIPHA, one process
+    'dipha_dual'            DIPHA with --dual
+    'dipha_mpi<k>'          DIPHA on k MPI processes (mpiexec), e.g., 'dipha_mpi4'
+    'dipha_dual_mpi<k>'     both
+    'perseus'               Perseus on the sparse cubical toplex format, only cells with finite value are written
+    'auto'                  the configuration with the least predicted running time, see CubicalAutotuner
+
+The fastest configuration depends on the machine and on the complex (number of cells, dimension, fraction of
+finite values). calibrate runs a short benchmark on the local machine and fits a cost model per configuration,
+
+    log(time) = a + b * log(number_of_cells) + c * foreground_fraction     (per dimension of the complex)
+
+which is stored as json (default_model_path) and used by backend='auto'. Passing any other backend name
+overrides the choice. Decisions are reported by CubicalAutotuner.report and counted by instrumentation
+(stage 'cubical_autotune', one counter per chosen configuration).
+
+Example:
+
+    calibrate().save()                                          # once per machine
+    dgms = cubical_persistence_diagrams(filtrated_complex, backend='auto')
+"""
+import os
+import re
+import json
+import time
+import platform
+import warnings
+from collections import namedtuple, deque, Counter
+
+import numpy
+
+from ._software_backends.dipha_adapter import persistence_diagrams_of_filtrated_cubical_complex, mpi_available
+from ._software_backends import perseus_adapter
+from ._software_backends.resource_handler import get_backend_cfg_errors, Backends
+from ._software_backends import instrumentation
+
+
+_model_path_environment_variable = 'PERSHOMBOX_CUBICAL_AUTOTUNE_MODEL'
+_configuration_name = re.compile(r'^(?:dipha(_dual)?(?:_mpi(\d+))?|(perseus))$')
+
+
+def default_model_path()->str:
+    """
+    $PERSHOMBOX_CUBICAL_AUTOTUNE_MODEL, or ~/.cache/pershombox/cubical_autotune.json.
+    """
+    path = os.environ.get(_model_path_environment_variable)
+    if path:
+        return path
+
+    return os.path.join(os.path.expanduser('~'), '.cache', 'pershombox', 'cubical_autotune.json')
+
+
+# region configurations
+
+
+class CubicalConfiguration(namedtuple('CubicalConfiguration', ['backend', 'dual', 'mpi_processes'])):
+    @property
+    def name(self)->str:
+        if self.backend == Backends.perseus.value:
+            return self.backend
+
+        return self.backend + ('_dual' if self.dual else '') + \
+            ('_mpi{}'.format(self.mpi_processes) if self.mpi_processes > 1 else '')
+
+    @classmethod
+    def from_name(cls, name: str):
+        m = _configuration_name.match(name)
+        if m is None or (m.group(2) is not None and int(m.group(2)) < 1):
+            raise ValueError("backend is expected to be 'auto', 'perseus' or of the form dipha[_dual][_mpi<k>] "
+                             "given was {}".format(name))
+
+        if m.group(3) is not None:
+            return cls(Backends.perseus.value, dual=False, mpi_processes=1)
+
+        return cls(Backends.dipha.value, dual=m.group(1) is not None,
+                   mpi_processes=1 if m.group(2) is None else int(m.group(2)))
+
+    def __call__(self, filtrated_cubical_complex, limit_dimensions: int=None, set_inf_to_max_filt_val=False):
+        if self.backend == Backends.perseus.value:
+            return perseus_adapter.persistence_diagrams_of_filtrated_cubical_complex(
+                filtrated_cubical_complex,
+                limit_dimensions=limit_dimensions,
+                set_inf_to_max_filt_val=set_inf_to_max_filt_val)
+
+        return persistence_diagrams_of_filtrated_cubical_complex(filtrated_cubical_complex,
+                                                                 limit_dimensions=limit_dimensions,
+                                                                 dual=self.dual,
+                                                                 set_inf_to_max_filt_val=set_inf_to_max_filt_val,
+                                                                 mpi_processes=self.mpi_processes)
+
+
+def candidate_configurations(max_mpi_processes: int=None)->[CubicalConfiguration]:
+    """
+    DIPHA with and without --dual, on 1, 2, 4, ... <= max_mpi_processes MPI processes if mpiexec is available,
+    and Perseus if it is available.
+
+    :param max_mpi_processes: defaults to os.cpu_count().
+    """
+    if max_mpi_processes is None:
+        max_mpi_processes = os.cpu_count() or 1
+
+    processes = [1]
+    if mpi_available():
+        while 2 * processes[-1] <= max_mpi_processes:
+            processes.append(2 * processes[-1])
+
+    configurations = [CubicalConfiguration(Backends.dipha.value, dual, k) for k in processes for dual in (False, True)]
+
+    if Backends.perseus.value not in [b for b, _ in get_backend_cfg_errors()]:
+        configurations.append(CubicalConfiguration.from_name(Backends.perseus.value))
+
+    return configurations
+
+
+# endregion
+
+
+# region cost model
+
+
+def _features(filtrated_cubical_complex: numpy.ndarray)->(int, int, float):
+    """
+    (number_of_cells, ndim, foreground_fraction), the foreground are the cells with finite value.
+    """
+    return (int(filtrated_cubical_complex.size),
+            int(filtrated_cubical_complex.ndim),
+            float(numpy.isfinite(filtrated_cubical_complex).mean()) if filtrated_cubical_complex.size > 0 else 0.0)
+
+
+def _design_matrix(number_of_cells, foreground_fraction)->numpy.ndarray:
+    number_of_cells = numpy.maximum(numpy.atleast_1d(numpy.asarray(number_of_cells, dtype=numpy.float64)), 1)
+    foreground_fraction = numpy.atleast_1d(numpy.asarray(foreground_fraction, dtype=numpy.float64))
+
+    return numpy.stack([numpy.ones_like(number_of_cells), numpy.log(number_of_cells), foreground_fraction], axis=1)
+
+
+class CubicalCostModel:
+    def __init__(self, coefficients: dict, machine: dict=None, measurements: list=None):
+        """
+        Use calibrate or CubicalCostModel.load.
+
+        :param coefficients: coefficients[configuration name][str(ndim)] = [a, b, c], see module documentation.
+        :param machine: description of the calibrated machine.
+        :param measurements: the calibration measurements, dicts with keys 'configuration', 'number_of_cells',
+            'ndim', 'foreground_fraction', 'time'.
+        """
+        self.coefficients = coefficients
+        self.machine = machine or {}
+        self.measurements = measurements or []
+
+    @classmethod
+    def fit(cls, measurements: list, machine: dict=None):
+        coefficients = {}
+        groups = {}
+        for m in measurements:
+            groups.setdefault((m['configuration'], m['ndim']), []).append(m)
+
+        for (name, ndim), group in groups.items():
+            x = _design_matrix([m['number_of_cells'] for m in group], [m['foreground_fraction'] for m in group])
+            y = numpy.log([max(m['time'], 1e-6) for m in group])
+
+            if numpy.linalg.matrix_rank(x) < x.shape[1]:
+                # too few distinct calibration points, constant cost
+                c = [float(y.mean()), 0.0, 0.0]
+            else:
+                c = numpy.linalg.lstsq(x, y, rcond=None)[0].tolist()
+
+            coefficients.setdefault(name, {})[str(ndim)] = c
+
+        return cls(coefficients, machine, measurements)
+
+    def predict(self, number_of_cells: int, ndim: int, foreground_fraction: float)->dict:
+        """
+        Predicted running time in seconds of each calibrated configuration (for ndim).
+        """
+        x = _design_matrix(number_of_cells, foreground_fraction)[0]
+
+        return {name: float(numpy.exp(x @ per_ndim[str(ndim)]))
+                for name, per_ndim in self.coefficients.items() if str(ndim) in per_ndim}
+
+    def save(self, path: str=None):
+        """
+        :param path: defaults to default_model_path().
+        """
+        if path is None:
+            path = default_model_path()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'coefficients': self.coefficients,
+                       'machine': self.machine,
+                       'measurements': self.measurements}, f, indent=1)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str=None):
+        if path is None:
+            path = default_model_path()
+
+        with open(path) as f:
+            state = json.load(f)
+
+        return cls(state['coefficients'], state.get('machine'), state.get('measurements'))
+
+
+def _calibration_complex(side: int, ndim: int, foreground_fraction: float, rng)->numpy.ndarray:
+    """
+    Smooth random blob(s) covering foreground_fraction of the grid, filtrated by height, background inf.
+    """
+    from scipy.ndimage import gaussian_filter
+
+    noise = gaussian_filter(rng.rand(*([side] * ndim)), sigma=max(side / 8, 1))
+    foreground = noise >= numpy.quantile(noise, 1 - foreground_fraction)
+
+    height = numpy.indices(foreground.shape)[0] / side
+    return numpy.where(foreground, height, float('inf'))
+
+
+def calibrate(sides: dict=None,
+              foreground_fractions: tuple=(0.05, 0.3, 0.8),
+              configurations: list=None,
+              repeats: int=2,
+              seed: int=0,
+              progress_callback=None)->CubicalCostModel:
+    """
+    Measures every configuration on synthetic filtrated complexes and fits the cost model.
+
+    :param sides: {ndim: side lengths}, defaults to {2: (64, 128, 256), 3: (16, 32, 48)}.
+    :param foreground_fractions: fractions of cells with finite filtration value.
+    :param configurations: defaults to candidate_configurations().
+    :param repeats: the fastest of repeats runs is taken.
+    :param progress_callback: called with each measurement (dict).
+    :return: CubicalCostModel, not saved yet.
+    """
+    if sides is None:
+        sides = {2: (64, 128, 256), 3: (16, 32, 48)}
+
+    if configurations is None:
+        configurations = candidate_configurations()
+
+    configurations = [CubicalConfiguration.from_name(c) if isinstance(c, str) else c for c in configurations]
+    rng = numpy.random.RandomState(seed)
+
+    measurements = []
+    for ndim, sides_of_ndim in sides.items():
+        for side in sides_of_ndim:
+            for fraction in foreground_fractions:
+                filtrated_complex = _calibration_complex(side, ndim, fraction, rng)
+                number_of_cells, _, foreground_fraction = _features(filtrated_complex)
+
+                for configuration in configurations:
+                    times = []
+                    for _ in range(max(int(repeats), 1)):
+                        start = time.perf_counter()
+                        configuration(filtrated_complex)
+                        times.append(time.perf_counter() - start)
+
+                    measurement = {'configuration': configuration.name,
+                                   'number_of_cells': number_of_cells,
+                                   'ndim': ndim,
+                                   'foreground_fraction': foreground_fraction,
+                                   'time': min(times)}
+                    measurements.append(measurement)
+
+                    if progress_callback is not None:
+                        progress_callback(measurement)
+
+    machine = {'node': platform.node(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+    return CubicalCostModel.fit(measurements, machine)
+
+
+# endregion
+
+
+class CubicalAutotuner:
+    def __init__(self, model: CubicalCostModel=None, override: str=None, maximal_number_of_decisions: int=1000):
+        """
+        Runs each complex with the configuration of least predicted running time.
+
+        :param model: if None, no model -> plain 'dipha'.
+        :param override: configuration name used for every call instead of the model's choice.
+        :param maximal_number_of_decisions: the last decisions kept for report.
+        """
+        self.model = model
+        self.override = None if override is None else CubicalConfiguration.from_name(override)
+        self.decisions = deque(maxlen=maximal_number_of_decisions)
+        self._chosen = Counter()
+
+    def choose(self, filtrated_cubical_complex: numpy.ndarray, dual: bool=False)->(CubicalConfiguration, dict):
+        """
+        :param dual: if True only the dual configurations (DIPHA with --dual) are considered, an override with
+            DIPHA is run with --dual.
+        :return: (configuration, decision), decision is a dict with keys 'number_of_cells', 'ndim',
+            'foreground_fraction', 'predicted' (seconds by configuration name), 'chosen' and 'reason'
+            ('override', 'model' or 'no model').
+        """
+        number_of_cells, ndim, foreground_fraction = _features(filtrated_cubical_complex)
+        predicted = {} if self.model is None else self.model.predict(number_of_cells, ndim, foreground_fraction)
+
+        if dual:
+            predicted = {name: t for name, t in predicted.items() if CubicalConfiguration.from_name(name).dual}
+
+        if self.override is not None:
+            configuration, reason = self.override, 'override'
+            if dual and configuration.backend == Backends.dipha.value:
+                configuration = configuration._replace(dual=True)
+        elif len(predicted) > 0:
+            configuration, reason = CubicalConfiguration.from_name(min(predicted, key=predicted.get)), 'model'
+        else:
+            configuration, reason = CubicalConfiguration.from_name('dipha_dual' if dual else 'dipha'), 'no model'
+
+        decision = {'number_of_cells': number_of_cells,
+                    'ndim': ndim,
+                    'foreground_fraction': foreground_fraction,
+                    'predicted': predicted,
+                    'chosen': configuration.name,
+                    'reason': reason}
+
+        return configuration, decision
+
+    def __call__(self, filtrated_cubical_complex, limit_dimensions: int=None, set_inf_to_max_filt_val=False,
+                 dual: bool=False):
+        filtrated_cubical_complex = numpy.asarray(filtrated_cubical_complex, dtype=numpy.float64)
+        configuration, decision = self.choose(filtrated_cubical_complex, dual=dual)
+
+        self.decisions.append(decision)
+        self._chosen[configuration.name] += 1
+        instrumentation.count('cubical_autotune', configuration.name)
+
+        return configuration(filtrated_cubical_complex, limit_dimensions=limit_dimensions,
+                             set_inf_to_max_filt_val=set_inf_to_max_filt_val)
+
+    def report(self)->str:
+        """
+        Number of calls per chosen configuration and the last decision.
+        """
+        lines = ['{:<24} {:>9}'.format('configuration', 'calls')]
+        lines += ['{:<24} {:>9}'.format(name, n) for name, n in self._chosen.most_common()]
+
+        if len(self.decisions) > 0:
+            d = self.decisions[-1]
+            lines.append('last: {} cells, ndim {}, foreground {:.3f} -> {} ({})'.format(
+                d['number_of_cells'], d['ndim'], d['foreground_fraction'], d['chosen'], d['reason']))
+            lines += ['    predicted {:<24} {:.4f}s'.format(name, t)
+                      for name, t in sorted(d['predicted'].items(), key=lambda item: item[1])]
+
+        return '\n'.join(lines)
+
+
+__default_autotuner = None
+
+# (path, modification time) of the model of __default_autotuner
+__default_model_key = None
+
+
+def default_autotuner()->CubicalAutotuner:
+    """
+    The autotuner of backend='auto', with the model of default_model_path() if it exists. The model is reloaded
+    if default_model_path() or the file changed, e.g., after calibrate().save() in the same process.
+    """
+    global __default_autotuner, __default_model_key
+
+    path = default_model_path()
+    key = (path, os.stat(path).st_mtime_ns) if os.path.isfile(path) else (path, None)
+
+    if __default_autotuner is None:
+        __default_autotuner = CubicalAutotuner()
+
+    if key != __default_model_key:
+        __default_autotuner.model = None if key[1] is None else CubicalCostModel.load(path)
+        __default_model_key = key
+
+    return __default_autotuner
+
+
+def cubical_persistence_diagrams(filtrated_cubical_complex: numpy.array,
+                                 limit_dimensions: int=None,
+                                 backend: str='dipha',
+                                 set_inf_to_max_filt_val=False,
+                                 dual: bool=False)->[[tuple]]:
+    """
+    persistence_diagrams_of_filtrated_cubical_complex with the backend chosen by name, see module documentation.
+
+    :param backend: 'auto' or a configuration name. A CubicalAutotuner may be passed as well.
+    :param dual: for backend='dipha', same as backend='dipha_dual'. Ignored by Perseus. For 'auto' (or a
+        CubicalAutotuner) only the dual configurations are considered.
+    """
+    if isinstance(backend, CubicalAutotuner):
+        tuner = backend
+    elif backend == 'auto':
+        tuner = default_autotuner()
+    else:
+        configuration = CubicalConfiguration.from_name(backend)
+        if dual and configuration.backend == Backends.dipha.value:
+            configuration = configuration._replace(dual=True)
+
+        return configuration(filtrated_cubical_complex, limit_dimensions=limit_dimensions,
+                             set_inf_to_max_filt_val=set_inf_to_max_filt_val)
+
+    return tuner(filtrated_cubical_complex, limit_dimensions=limit_dimensions,
+                 set_inf_to_max_filt_val=set_inf_to_max_filt_val, dual=dual)
+
+
+# region tile packing
+
+
+# Default bound of the number of cells of one packed complex.
+_default_max_cells_per_call = 2 ** 20
+
+
+def _packed_shape(shapes: [tuple])->[int]:
+    """
+    Shape of the complex _pack_tiles lays out from complexes of the given shapes.
+    """
+    extent = [max(shape[axis] for shape in shapes) for axis in range(1, len(shapes[0]))]
+    length = sum(shape[0] for shape in shapes) + len(shapes) - 1
+
+    return [length] + extent
+
+
+def _pack_tiles(filtrated_complexes: [numpy.ndarray])->(numpy.ndarray, numpy.ndarray, [numpy.ndarray]):
+    """
+    Lays out the complexes along the first axis, separated by layers of inf. The finite values of complex k are
+    replaced by their ranks plus offsets[k], hence each complex occupies its own range of filtration values.
+
+    :return: (packed complex, offsets, values), values[k][r] is the value of rank r of complex k.
+    """
+    packed = numpy.full(_packed_shape([c.shape for c in filtrated_complexes]), float('inf'))
+    offsets = numpy.empty(len(filtrated_complexes), dtype=numpy.int64)
+    values = []
+
+    start, offset = 0, 0
+    for k, c in enumerate(filtrated_complexes):
+        finite = numpy.isfinite(c)
+        tile_values, ranks = numpy.unique(c[finite], return_inverse=True)
+
+        tile = numpy.full(c.shape, float('inf'))
+        tile[finite] = ranks + offset
+
+        packed[(slice(start, start + c.shape[0]),) + tuple(slice(0, n) for n in c.shape[1:])] = tile
+        offsets[k] = offset
+        values.append(tile_values)
+
+        start += c.shape[0] + 1
+        offset += len(tile_values)
+
+    return packed, offsets, values
+
+
+class TileUnpackingError(ValueError):
+    """
+    The diagrams of a packed complex are no diagrams of its tiles, see _unpack_tiles.
+    """
+    pass
+
+
+def _tile_indices(ranks: numpy.ndarray, offset: int, number_of_values: int)->numpy.ndarray:
+    indices = numpy.rint(ranks).astype(numpy.int64) - offset
+
+    if (indices != ranks - offset).any() or (indices < 0).any() or (indices >= number_of_values).any():
+        raise TileUnpackingError('Backend returned a point which is not in the rank range [{}, {}) of its tile.'
+                                 .format(offset, offset + number_of_values))
+
+    return indices
+
+
+def _unpack_tiles(dgms: [[tuple]], offsets: numpy.ndarray, values: [numpy.ndarray])->[[[tuple]]]:
+    """
+    Splits the diagrams of a packed complex by birth. Points born at inf (cells of the separating layers)
+    are dropped. Classes of different tiles only meet at inf, so all finite deaths lie in the tile of the birth.
+    A point outside of the rank range of its tile raises TileUnpackingError.
+    """
+    return_value = [[[] for _ in dgms] for _ in offsets]
+
+    for dim, dgm in enumerate(dgms):
+        points = numpy.asarray(dgm, dtype=numpy.float64).reshape(-1, 2)
+        points = points[numpy.isfinite(points[:, 0])]
+
+        tiles = numpy.searchsorted(offsets, points[:, 0], side='right') - 1
+        for k in numpy.unique(tiles):
+            tile_points = points[tiles == k]
+            births = values[k][_tile_indices(tile_points[:, 0], offsets[k], len(values[k]))]
+
+            finite = numpy.isfinite(tile_points[:, 1])
+            deaths = numpy.full(len(tile_points), float('inf'))
+            deaths[finite] = values[k][_tile_indices(tile_points[finite, 1], offsets[k], len(values[k]))]
+
+            return_value[k][dim] = list(zip(births.tolist(), deaths.tolist()))
+
+    return return_value
+
+
+def cubical_persistence_diagrams_batch(filtrated_complexes: [numpy.array],
+                                       limit_dimensions: int=None,
+                                       backend: str='dipha',
+                                       max_cells_per_call: int=None)->[[[tuple]]]:
+    """
+    cubical_persistence_diagrams of each complex, with several complexes packed into one backend call.
+
+    The complexes are laid out as tiles of one complex, separated by cells of value inf, and the values of each
+    tile are replaced by their ranks, shifted to a range of its own. The diagrams are split by birth and the
+    ranks are mapped back, hence the result equals one call per complex (up to the order of the points and
+    points born at inf, which are dropped). This saves the process start up of the backend for small complexes.
+
+    :param filtrated_complexes: complexes of the same dimension.
+    :param limit_dimensions: see cubical_persistence_diagrams.
+    :param backend: see cubical_persistence_diagrams.
+    :param max_cells_per_call: consecutive complexes are packed as long as the packed complex (including the
+        separating layers and the padding of the tiles to the largest extent) has at most this many cells,
+        defaults to 2^20. 1 disables packing.
+    :return: list, return_value[i] diagrams of filtrated_complexes[i].
+
+    If the diagrams of a packed call cannot be split into its tiles (TileUnpackingError, e.g., the synthetic
+    output of a stand-in backend), its complexes are calculated by one call each.
+    """
+    filtrated_complexes = [numpy.asarray(c, dtype=numpy.float64) for c in filtrated_complexes]
+    if max_cells_per_call is None:
+        max_cells_per_call = _default_max_cells_per_call
+
+    if len({c.ndim for c in filtrated_complexes}) > 1:
+        raise ValueError('All complexes are expected to have the same dimension.')
+
+    groups, group = [], []
+    for c in filtrated_complexes:
+        # Without finite cells the diagrams consist of points born at inf only, they are not dropped.
+        alone = not numpy.isfinite(c).any()
+
+        if len(group) > 0 and \
+                (alone or numpy.prod(_packed_shape([g.shape for g in group] + [c.shape])) > max_cells_per_call):
+            groups.append(group)
+            group = []
+
+        group.append(c)
+
+        if alone:
+            groups.append(group)
+            group = []
+
+    if len(group) > 0:
+        groups.append(group)
+
+    return_value = []
+    for group in groups:
+        if len(group) == 1:
+            return_value.append(cubical_persistence_diagrams(group[0], limit_dimensions=limit_dimensions,
+                                                             backend=backend))
+            continue
+
+        with instrumentation.stage('cubical_tiles', 'pack'):
+            packed, offsets, values = _pack_tiles(group)
+
+        instrumentation.count('cubical_tiles', 'tiles', len(group))
+        dgms = cubical_persistence_diagrams(packed, limit_dimensions=limit_dimensions, backend=backend)
+
+        try:
+            with instrumentation.stage('cubical_tiles', 'unpack'):
+                return_value += _unpack_tiles(dgms, offsets, values)
+
+        except TileUnpackingError as ex:
+            warnings.warn('{} Falling back to one call per complex.'.format(ex), RuntimeWarning)
+            instrumentation.count('cubical_tiles', 'fallback', len(group))
+
+            return_value += [cubical_persistence_diagrams(c, limit_dimensions=limit_dimensions, backend=backend)
+                             for c in group]
+
+    return return_value
+
+
+# endregion
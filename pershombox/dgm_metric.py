@@ -0,0 +1,276 @@
+"""
+Metrics on persistence diagrams which are computed in-process, i.e., without a software backend.
+"""
+import numpy
+
+
+# region sliced wasserstein
+
+
+def _slice_directions(number_of_slices: int)->numpy.ndarray:
+    theta = numpy.linspace(-numpy.pi / 2, numpy.pi / 2, int(number_of_slices), endpoint=False)
+    return numpy.stack([numpy.cos(theta), numpy.sin(theta)])
+
+
+def _as_point_array(dgm)->numpy.ndarray:
+    return numpy.asarray(dgm, dtype=numpy.float64).reshape(-1, 2)
+
+
+def sliced_wasserstein_distances(pairs: [tuple], number_of_slices: int=50)->numpy.ndarray:
+    """
+    Sliced Wasserstein distance of each pair of persistence diagrams in pairs. All pairs are processed
+    in one batch.
+
+    Parameters
+    ----------
+    pairs: list of (dgm_1, dgm_2).
+
+    number_of_slices: int. Number of equidistant directions in [-pi/2, pi/2) the diagrams are projected on.
+
+    Returns
+    -------
+        numpy.ndarray. One distance per pair.
+    """
+    if number_of_slices < 1:
+        raise ValueError("""Value range of parameter number_of_slices is [1, inf) given was {}""".format(
+            number_of_slices))
+
+    if len(pairs) == 0:
+        return numpy.empty(0)
+
+    directions = _slice_directions(number_of_slices)
+    on_diagonal = directions.sum(axis=0) / 2
+
+    pairs = [(_as_point_array(a), _as_point_array(b)) for a, b in pairs]
+    if not all(numpy.isfinite(a).all() and numpy.isfinite(b).all() for a, b in pairs):
+        raise ValueError('Diagrams contain essential points. Use de_essentialize first.')
+
+    size = max(len(a) + len(b) for a, b in pairs)
+
+    # Each diagram is augmented by the diagonal projections of the points of the other one. Pairs are padded to a
+    # common size by projections equal to 0 on both sides, which does not change the 1D Wasserstein distance.
+    projected_1 = numpy.zeros((len(pairs), size, number_of_slices))
+    projected_2 = numpy.zeros((len(pairs), size, number_of_slices))
+
+    for k, (a, b) in enumerate(pairs):
+        n, m = len(a), len(b)
+        projected_1[k, :n] = a @ directions
+        projected_1[k, n:n + m] = b.sum(axis=1)[:, None] * on_diagonal[None, :]
+        projected_2[k, :m] = b @ directions
+        projected_2[k, m:n + m] = a.sum(axis=1)[:, None] * on_diagonal[None, :]
+
+    projected_1.sort(axis=1)
+    projected_2.sort(axis=1)
+
+    return numpy.abs(projected_1 - projected_2).sum(axis=1).mean(axis=1)
+
+
+def sliced_wasserstein_distance(dgm_1: [[]], dgm_2: [[]], number_of_slices: int=50)->float:
+    """
+    Approximates the sliced Wasserstein distance of two persistence diagrams, see
+
+        M. Carriere, M. Cuturi and S. Oudot. Sliced Wasserstein Kernel for Persistence Diagrams. ICML, 2017.
+
+    The integral over the directions is replaced by the mean over number_of_slices equidistant directions.
+
+    The sliced Wasserstein distance is not an approximation of the Wasserstein distance with bounded relative error,
+    but metrically equivalent to the 1-Wasserstein distance (see above). Its values are on a different scale,
+    nearest neighbor rankings are mostly preserved.
+
+    Parameters
+    ----------
+    dgm_1
+    dgm_2
+    number_of_slices
+
+    Returns
+    -------
+        float.
+    """
+    return float(sliced_wasserstein_distances([(dgm_1, dgm_2)], number_of_slices)[0])
+
+
+# endregion
+
+
+# region bottleneck
+
+
+def _maximum_matching(adjacency: [[int]], number_of_right_vertices: int)->int:
+    """
+    Size of a maximum matching of a bipartite graph, Hopcroft-Karp.
+
+    :param adjacency: adjacency[i] lists the right vertices adjacent to left vertex i.
+    """
+    number_of_left_vertices = len(adjacency)
+    match_left = [-1] * number_of_left_vertices
+    match_right = [-1] * number_of_right_vertices
+    infinity = number_of_left_vertices + 1
+
+    def bfs(layer):
+        queue = []
+        for u in range(number_of_left_vertices):
+            if match_left[u] == -1:
+                layer[u] = 0
+                queue.append(u)
+            else:
+                layer[u] = infinity
+
+        found = False
+        for u in queue:
+            for v in adjacency[u]:
+                w = match_right[v]
+                if w == -1:
+                    found = True
+                elif layer[w] == infinity:
+                    layer[w] = layer[u] + 1
+                    queue.append(w)
+
+        return found
+
+    def dfs(root, layer, next_edge):
+        # iterative augmenting path search along the bfs layers
+        path = [root]
+        while len(path) > 0:
+            u = path[-1]
+
+            if next_edge[u] == len(adjacency[u]):
+                layer[u] = infinity
+                path.pop()
+                continue
+
+            v = adjacency[u][next_edge[u]]
+            next_edge[u] += 1
+            w = match_right[v]
+
+            if w == -1:
+                # augment along path
+                for left in reversed(path):
+                    previous = match_left[left]
+                    match_left[left] = v
+                    match_right[v] = left
+                    v = previous
+                return True
+
+            if layer[w] == layer[u] + 1:
+                path.append(w)
+
+        return False
+
+    size = 0
+    layer = [0] * number_of_left_vertices
+    while bfs(layer):
+        next_edge = [0] * number_of_left_vertices
+        for u in range(number_of_left_vertices):
+            if match_left[u] == -1 and dfs(u, layer, next_edge):
+                size += 1
+
+    return size
+
+
+def _covers(forced: numpy.ndarray, points: numpy.ndarray, tree, r: float)->bool:
+    """
+    True if there is a matching of the forced points into the points of tree with l_inf distance <= r.
+    """
+    if len(forced) == 0:
+        return True
+
+    if tree is None:
+        return False
+
+    adjacency = tree.query_ball_point(points[forced], r, p=numpy.inf)
+    if any(len(a) == 0 for a in adjacency):
+        return False
+
+    return _maximum_matching(list(adjacency), tree.n) == len(forced)
+
+
+def _finite_bottleneck_distance(a: numpy.ndarray, b: numpy.ndarray)->float:
+    from scipy.spatial import cKDTree
+
+    if len(a) + len(b) == 0:
+        return 0.0
+
+    to_diagonal_a = (a[:, 1] - a[:, 0]) / 2
+    to_diagonal_b = (b[:, 1] - b[:, 0]) / 2
+
+    # Matching everything to the diagonal is always possible.
+    upper_bound = max(to_diagonal_a.max(initial=0), to_diagonal_b.max(initial=0))
+
+    tree_a = cKDTree(a) if len(a) > 0 else None
+    tree_b = cKDTree(b) if len(b) > 0 else None
+
+    # Only pairs within upper_bound are candidates, the kd-trees enumerate them without the dense n x m array.
+    pairwise = numpy.empty(0)
+    if tree_a is not None and tree_b is not None:
+        pairwise = tree_a.sparse_distance_matrix(tree_b, upper_bound, p=numpy.inf, output_type='ndarray')['v']
+
+    candidates = numpy.unique(numpy.concatenate([[0.0], to_diagonal_a, to_diagonal_b, pairwise]))
+    candidates = candidates[candidates <= upper_bound]
+
+    def feasible(r):
+        # Points farther than r from the diagonal have to be matched to the other diagram. By the
+        # Mendelsohn-Dulmage theorem a matching covering both forced sets exists iff each forced set can be
+        # covered on its own. Remaining points are matched to the diagonal.
+        forced_a = numpy.flatnonzero(to_diagonal_a > r)
+        forced_b = numpy.flatnonzero(to_diagonal_b > r)
+
+        return _covers(forced_a, a, tree_b, r) and _covers(forced_b, b, tree_a, r)
+
+    lo, hi = 0, len(candidates) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if feasible(candidates[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return float(candidates[lo])
+
+
+def bottleneck_distance(dgm_1: [[]], dgm_2: [[]], maximal_filtration_value: float=None)->float:
+    """
+    Calculates the bottleneck distance (l_inf internal norm) of two persistence diagrams in-process.
+
+    The optimal value is searched by binary search over all candidate distances, for each candidate a
+    Hopcroft-Karp matching on the points within range (found by a kd-tree) decides feasibility.
+
+    The bottleneck distance is a lower bound of the Wasserstein distance of any degree and internal norm.
+
+    Parameters
+    ----------
+    dgm_1
+    dgm_2
+    maximal_filtration_value: If given, essential points are de-essentialized with it, see
+        dgm_util.de_essentialize. Otherwise essential points are matched among each other (by birth) and the
+        distance is inf if their numbers differ.
+
+    Returns
+    -------
+        float.
+    """
+    a = numpy.asarray(dgm_1, dtype=numpy.float64).reshape(-1, 2)
+    b = numpy.asarray(dgm_2, dtype=numpy.float64).reshape(-1, 2)
+
+    if maximal_filtration_value is not None:
+        a = a.copy()
+        b = b.copy()
+        a[a[:, 1] == numpy.inf, 1] = maximal_filtration_value
+        b[b[:, 1] == numpy.inf, 1] = maximal_filtration_value
+
+    essential_a = a[:, 1] == numpy.inf
+    essential_b = b[:, 1] == numpy.inf
+
+    if essential_a.sum() != essential_b.sum():
+        return float('inf')
+
+    essential_distance = 0.0
+    if essential_a.any():
+        births_a = numpy.sort(a[essential_a, 0])
+        births_b = numpy.sort(b[essential_b, 0])
+        essential_distance = float(numpy.abs(births_a - births_b).max())
+
+    return max(essential_distance, _finite_bottleneck_distance(a[~essential_a], b[~essential_b]))
+
+
+# endregion
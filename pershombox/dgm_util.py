@@ -1,3 +1,8 @@
+import numpy
+
+from ._software_backends import instrumentation
+
+
 def de_essentialize(persistence_diagram: [[]], maximal_filtration_value: float)->[[]]:
     """
     Replaces all essental classes with points dying at  maximal_filtration_value.
@@ -18,3 +23,67 @@ def de_essentialize(persistence_diagram: [[]], maximal_filtration_value: float)-
                                [(p[0], maximal_filtration_value) for p in dgm if p[1] == float('inf')]
 
         return de_essentialized_dgm
+
+
+class DiagramCompaction:
+    def __init__(self, min_persistence: float=0.0, grid: float=None, dtype=None):
+        """
+        Post-processing of the persistence diagrams of a transform, see calculate_discrete_NPHT_2d.
+
+        Each diagram is optionally rounded to a grid, then all points with death - birth <= min_persistence
+        are dropped and the remaining points are stored as one (n x 2) numpy array.
+        Dropping points with zero persistence (the default) does not change Wasserstein distances.
+
+        :param min_persistence: points with persistence <= min_persistence are dropped.
+        :param grid: if given, birth and death values are rounded to multiples of grid before pruning.
+        :param dtype: dtype of the arrays, defaults to float64. float32 halves the memory.
+        """
+        min_persistence = float(min_persistence)
+        if min_persistence < 0:
+            raise ValueError('Value range of parameter min_persistence is [0, inf) given was {}'.format(
+                min_persistence))
+
+        if grid is not None and grid <= 0:
+            raise ValueError('Value range of parameter grid is (0, inf) given was {}'.format(grid))
+
+        self.min_persistence = min_persistence
+        self.grid = grid
+        self.dtype = numpy.dtype(dtype if dtype is not None else numpy.float64)
+
+        self.statistics = []
+        self._current = None
+
+    def __call__(self, persistence_diagram: [[]], dimension: int=None):
+        points = numpy.asarray(persistence_diagram, dtype=numpy.float64).reshape(-1, 2)
+
+        if self.grid is not None:
+            points = numpy.round(points / self.grid) * self.grid
+
+        keep = points[:, 1] - points[:, 0] > self.min_persistence
+        compacted = numpy.ascontiguousarray(points[keep], dtype=self.dtype)
+
+        removed = len(points) - len(compacted)
+        instrumentation.count('compaction', 'points', len(points))
+        instrumentation.count('compaction', 'removed', removed)
+
+        if self._current is not None:
+            self._current['points'] += len(points)
+            self._current['removed'] += removed
+
+            if dimension is not None:
+                per_dimension = self._current['removed_per_dimension']
+                per_dimension[dimension] = per_dimension.get(dimension, 0) + removed
+
+        return compacted
+
+    def begin_transform(self):
+        self._current = {'points': 0, 'removed': 0, 'removed_per_dimension': {}}
+
+    def end_transform(self)->dict:
+        """
+        Appends the statistics of the transform started by begin_transform to self.statistics
+        and returns them: {'points', 'removed', 'removed_per_dimension'}.
+        """
+        stats, self._current = self._current, None
+        self.statistics.append(stats)
+        return stats
@@ -0,0 +1,315 @@
+"""
+Sharded, resumable computation of all-pairs NPHT distance matrices.
+
+A job lives in a directory on a (shared) filesystem:
+
+    job_dir/job.json          collection of transform files, distance and block size
+    job_dir/shards/<id>.npy   partial results, one file per shard
+    job_dir/distance_matrix.npy   merged symmetric matrix (numpy memmap), written by merge
+
+The upper triangle is split into deterministic block shards. Every shard can be computed independently
+on any machine which sees job_dir, finished shards are never recomputed. Appending transforms to the collection
+opens a new generation whose shards only cover the pairs involving a new transform.
+
+Example:
+
+    job = DistanceMatrixJob.create('job', transform_files, distance='lebedev26', block_size=32)
+    job.run(workers=16, machine=(k, K))     # on machine k of K
+    job.merge()                             # once all shards are done
+
+run packs the transforms into a SharedDiagramStore once, the worker processes read them from shared memory
+instead of unpickling the transform files for every shard.
+"""
+import os
+import json
+import pickle
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+
+from .pht_metric import distance_npht2D, distance_npht3D_lebedev_26
+from .pipeline import _recorded
+from .shared_store import SharedDiagramStore, creator_worker_initializer
+from ._software_backends import instrumentation
+
+
+_job_file_name = 'job.json'
+_shard_dir_name = 'shards'
+_matrix_file_name = 'distance_matrix.npy'
+
+_distances = {'2d': distance_npht2D,
+              'lebedev26': distance_npht3D_lebedev_26}
+
+
+# region helpers
+
+
+def _block_ranges(start: int, stop: int, block_size: int)->[(int, int)]:
+    return [(i, min(i + block_size, stop)) for i in range(start, stop, block_size)]
+
+
+def _load_transform(path: str):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _compute_shard(job_dir: str, shard_id: str, store_name: str=None):
+    store = None if store_name is None else SharedDiagramStore.attach(store_name)
+    DistanceMatrixJob(job_dir).compute_shard(shard_id, store=store)
+
+
+# endregion
+
+
+class DistanceMatrixJob:
+    def __init__(self, job_dir: str):
+        """
+        Opens an existing job, see DistanceMatrixJob.create.
+        """
+        self.job_dir = job_dir
+
+        with open(os.path.join(job_dir, _job_file_name)) as f:
+            state = json.load(f)
+
+        self.collection = state['collection']
+        self.generations = state['generations']
+        self.distance = state['distance']
+        self.distance_kwargs = state['distance_kwargs']
+        self.block_size = state['block_size']
+
+        self._transform_cache = {}
+
+    @classmethod
+    def create(cls, job_dir: str, transform_files: [str], distance: str='lebedev26', block_size: int=32,
+               **distance_kwargs):
+        """
+        Creates a new job.
+
+        Parameters
+        ----------
+        job_dir: str. Must not contain a job yet.
+
+        transform_files: list of str. Pickled transforms, e.g., the outputs of npht_directory. Row/column i of
+            the distance matrix corresponds to transform_files[i].
+
+        distance: str. '2d' -> distance_npht2D, 'lebedev26' -> distance_npht3D_lebedev_26.
+
+        block_size: int. Shards are block_size x block_size blocks of the upper triangle.
+
+        distance_kwargs: Passed to the distance, must be json serializable.
+        """
+        if distance not in _distances:
+            raise ValueError("distance is expected to be one of {} given was {}".format(
+                tuple(_distances.keys()), distance))
+
+        if int(block_size) < 1:
+            raise ValueError('Value range of parameter block_size is [1, inf) given was {}'.format(block_size))
+
+        os.makedirs(os.path.join(job_dir, _shard_dir_name), exist_ok=True)
+        job_file_path = os.path.join(job_dir, _job_file_name)
+
+        if os.path.exists(job_file_path):
+            raise ValueError('{} already contains a job.'.format(job_dir))
+
+        transform_files = [os.path.abspath(p) for p in transform_files]
+        state = {'collection': transform_files,
+                 'generations': [len(transform_files)],
+                 'distance': distance,
+                 'distance_kwargs': distance_kwargs,
+                 'block_size': int(block_size)}
+
+        cls._write_state(job_dir, state)
+        return cls(job_dir)
+
+    @staticmethod
+    def _write_state(job_dir, state):
+        job_file_path = os.path.join(job_dir, _job_file_name)
+        tmp_path = job_file_path + '.tmp{}'.format(os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=1)
+
+        os.replace(tmp_path, job_file_path)
+
+    def append(self, transform_files: [str]):
+        """
+        Appends transform_files to the collection. Only the distances involving the new transforms are
+        calculated by the shards of the new generation.
+        """
+        transform_files = [os.path.abspath(p) for p in transform_files]
+        if len(transform_files) == 0:
+            return
+
+        self.collection += transform_files
+        self.generations.append(len(self.collection))
+
+        self._write_state(self.job_dir, {'collection': self.collection,
+                                         'generations': self.generations,
+                                         'distance': self.distance,
+                                         'distance_kwargs': self.distance_kwargs,
+                                         'block_size': self.block_size})
+
+    def __len__(self):
+        return len(self.collection)
+
+    # region shards
+
+    def _shard_ranges(self)->dict:
+        """
+        shard_ranges[shard_id] = ((row_start, row_stop), (column_start, column_stop)).
+        Generation g covers the columns added by it and all rows above them.
+        """
+        shard_ranges = {}
+        previous = 0
+
+        for g, size in enumerate(self.generations):
+            for c, (column_start, column_stop) in enumerate(_block_ranges(previous, size, self.block_size)):
+                for r, (row_start, row_stop) in enumerate(_block_ranges(0, column_stop, self.block_size)):
+                    if row_start < column_stop - 1:
+                        shard_id = 'g{}_r{}_c{}'.format(g, r, c)
+                        shard_ranges[shard_id] = ((row_start, row_stop), (column_start, column_stop))
+
+            previous = size
+
+        return shard_ranges
+
+    def shards(self)->[str]:
+        """
+        All shard ids of the job, in a deterministic order.
+        """
+        return list(self._shard_ranges().keys())
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.job_dir, _shard_dir_name, shard_id + '.npy')
+
+    def pending_shards(self)->[str]:
+        return [s for s in self.shards() if not os.path.isfile(self._shard_path(s))]
+
+    def _transform(self, i):
+        if i not in self._transform_cache:
+            self._transform_cache[i] = _load_transform(self.collection[i])
+
+        return self._transform_cache[i]
+
+    def compute_shard(self, shard_id: str, store: SharedDiagramStore=None):
+        """
+        Calculates the distances of shard_id and writes them to its shard file, unless it exists.
+
+        If given, the transforms are read from store (the collection packed in this order) instead of the
+        transform files.
+        """
+        path = self._shard_path(shard_id)
+        if os.path.isfile(path):
+            return
+
+        (row_start, row_stop), (column_start, column_stop) = self._shard_ranges()[shard_id]
+        distance = _distances[self.distance]
+
+        transform = self._transform if store is None else store.__getitem__
+
+        block = numpy.full((row_stop - row_start, column_stop - column_start), numpy.nan)
+        for i in range(row_start, row_stop):
+            for j in range(max(column_start, i + 1), column_stop):
+                block[i - row_start, j - column_start] = distance(transform(i), transform(j),
+                                                                  **self.distance_kwargs)
+
+        tmp_path = path + '.tmp{}.npy'.format(os.getpid())
+        numpy.save(tmp_path, block)
+        os.replace(tmp_path, path)
+
+    def run(self, workers: int=None, machine: (int, int)=(0, 1), shared_memory: bool=True):
+        """
+        Calculates the pending shards assigned to this machine.
+
+        Parameters
+        ----------
+        workers: int. Number of worker processes, defaults to os.cpu_count(). 0 computes in the calling process.
+
+        machine: (k, K). Shard number s (in the order of shards()) is assigned to machine s % K. Pass a distinct
+            k on each of K machines sharing job_dir.
+
+        shared_memory: bool. If True (and workers > 0), the transforms are loaded once and shared with the
+            workers through a SharedDiagramStore.
+
+        If instrumentation recording is enabled, the stages recorded by the workers are merged into the
+        statistics of the calling process.
+        """
+        k, number_of_machines = machine
+        if not 0 <= k < number_of_machines:
+            raise ValueError('machine is expected to be (k, K) with 0 <= k < K given was {}'.format(machine))
+
+        assigned = [s for n, s in enumerate(self.shards()) if n % number_of_machines == k]
+        pending = [s for s in assigned if not os.path.isfile(self._shard_path(s))]
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers == 0:
+            for s in pending:
+                self.compute_shard(s)
+            return
+
+        if len(pending) == 0:
+            return
+
+        record_workers = instrumentation.is_enabled()
+        store = None
+        if shared_memory:
+            with instrumentation.stage('distance_matrix', 'pack'):
+                store = SharedDiagramStore.create(_load_transform(p) for p in self.collection)
+
+        try:
+            store_name = None if store is None else store.name
+
+            with ProcessPoolExecutor(workers, initializer=creator_worker_initializer) as executor:
+                if record_workers:
+                    futures = [executor.submit(_recorded, _compute_shard, self.job_dir, s, store_name)
+                               for s in pending]
+                else:
+                    futures = [executor.submit(_compute_shard, self.job_dir, s, store_name) for s in pending]
+
+                for future in futures:
+                    worker_stats = future.result()
+                    if record_workers:
+                        instrumentation.merge(worker_stats)
+
+        finally:
+            if store is not None:
+                store.close()
+
+    # endregion
+
+    def merge(self, path: str=None)->numpy.memmap:
+        """
+        Assembles the symmetric distance matrix from all shards.
+
+        Parameters
+        ----------
+        path: str. Target .npy file, defaults to job_dir/distance_matrix.npy.
+
+        Returns
+        -------
+            numpy.memmap. The len(self) x len(self) matrix, opened read only.
+        """
+        pending = self.pending_shards()
+        if len(pending) > 0:
+            raise ValueError('{} shards are not computed yet, e.g., {}.'.format(len(pending), pending[0]))
+
+        if path is None:
+            path = os.path.join(self.job_dir, _matrix_file_name)
+
+        n = len(self)
+        matrix = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float64, shape=(n, n))
+        matrix[numpy.diag_indices(n)] = 0
+
+        for shard_id, ((row_start, row_stop), (column_start, column_stop)) in self._shard_ranges().items():
+            block = numpy.load(self._shard_path(shard_id))
+            computed = ~numpy.isnan(block)
+            rows, columns = numpy.nonzero(computed)
+
+            matrix[rows + row_start, columns + column_start] = block[computed]
+            matrix[columns + column_start, rows + row_start] = block[computed]
+
+        matrix.flush()
+        del matrix
+
+        return numpy.load(path, mmap_mode='r')
@@ -0,0 +1,265 @@
+"""
+Approximate nearest neighbor search over collections of NPHTs.
+
+Each stored transform is embedded as a fixed-length vector (one persistence image per direction and
+homology dimension). A query is compared against all stored embeddings in one vectorized scan, taking the
+minimum over the rotations the NPHT distance minimizes over (cyclic shifts of the directions in 2D,
+the octahedral rotation group in 3D). The exact NPHT distance is then only evaluated for the resulting
+shortlist.
+"""
+import numpy
+
+from .lebedev import LebedevGrid26, _Lebedev26Integrator
+from .pht_metric import distance_npht2D, distance_npht3D_lebedev_26
+from .vectorization import persistence_images, _flatten, _diagram_ranges, \
+    _cyclic_direction_permutations, _octahedral_direction_permutations
+
+
+class _NPHTIndexBase:
+    def __init__(self,
+                 included_dimensions: tuple,
+                 resolution: int=10,
+                 sigma: float=None,
+                 birth_range: tuple=None,
+                 persistence_range: tuple=None,
+                 distance_kwargs: dict=None):
+        """
+        Parameters
+        ----------
+        included_dimensions:
+            tuple. Homology dimensions which are embedded.
+
+        resolution:
+            int. The persistence images are resolution x resolution.
+
+        sigma:
+            float. Bandwidth of the gaussians. Defaults to a tenth of the larger of both ranges.
+
+        birth_range, persistence_range:
+            (float, float). Support of the persistence images. If None, they are fitted to the transforms of the
+            first call of add and fixed afterwards.
+
+        distance_kwargs:
+            dict. Passed to the exact npht distance used by search and recall.
+        """
+        self.included_dimensions = tuple(included_dimensions)
+        self.resolution = int(resolution)
+        self.sigma = sigma
+        self.birth_range = birth_range
+        self.persistence_range = persistence_range
+        self.distance_kwargs = dict(distance_kwargs) if distance_kwargs is not None else {}
+
+        self._transforms = []
+        self._embeddings = None
+        self._permutations = None
+        self._weights = None
+
+    # region abstract
+
+    def _direction_permutations(self, number_of_directions)->numpy.ndarray:
+        """
+        number_of_rotations x number_of_directions array. Row g lists for each direction the direction
+        whose diagrams are used after rotating by g.
+        """
+        raise NotImplementedError("Abstract method.")
+
+    def _direction_weights(self, number_of_directions)->numpy.ndarray:
+        raise NotImplementedError("Abstract method.")
+
+    def _exact_distance(self, t_1, t_2)->float:
+        raise NotImplementedError("Abstract method.")
+
+    # endregion
+
+    def _fit_ranges(self, transforms):
+        points, _, _ = _flatten(list(transforms), self.included_dimensions)
+        birth_range, persistence_range, _ = _diagram_ranges(points)
+
+        if self.birth_range is None:
+            self.birth_range = birth_range
+
+        if self.persistence_range is None:
+            self.persistence_range = persistence_range
+
+        if self.sigma is None:
+            self.sigma = 0.1 * max(self.birth_range[1] - self.birth_range[0],
+                                   self.persistence_range[1] - self.persistence_range[0])
+
+    def embed(self, transform)->numpy.ndarray:
+        """
+        Embedding of transform.
+
+        Returns
+        -------
+            numpy.ndarray. number_of_directions x (len(included_dimensions) * resolution**2).
+        """
+        if self.sigma is None:
+            self._fit_ranges([transform])
+
+        images = persistence_images([transform],
+                                    included_dimensions=self.included_dimensions,
+                                    resolution=self.resolution,
+                                    sigma=self.sigma,
+                                    birth_range=self.birth_range,
+                                    persistence_range=self.persistence_range)[0]
+
+        return images.reshape(images.shape[0], -1)
+
+    def add(self, transforms: list):
+        """
+        Adds transforms to the index. Their position in the index is their position in the order of adding.
+        """
+        transforms = list(transforms)
+        if len(transforms) == 0:
+            return
+
+        if self.sigma is None:
+            self._fit_ranges(transforms)
+
+        embeddings = numpy.stack([self.embed(t) for t in transforms])
+
+        if self._embeddings is None:
+            self._embeddings = embeddings
+            self._permutations = self._direction_permutations(embeddings.shape[1])
+            self._weights = self._direction_weights(embeddings.shape[1])
+        else:
+            if embeddings.shape[1:] != self._embeddings.shape[1:]:
+                raise ValueError('Transforms are not compatible with the transforms already in the index.')
+            self._embeddings = numpy.concatenate([self._embeddings, embeddings])
+
+        self._transforms += transforms
+
+    def __len__(self):
+        return len(self._transforms)
+
+    def approximate_distances(self, transform, chunk_size: int=1024)->numpy.ndarray:
+        """
+        Approximate distances of transform to all stored transforms.
+
+        Returns
+        -------
+            numpy.ndarray. Entry i is min over the rotations of the weighted sum over directions of the euclidean
+            distances of the embeddings.
+        """
+        if self._embeddings is None:
+            return numpy.empty(0)
+
+        query = self.embed(transform)
+        rotated_queries = query[self._permutations]  # rotations x directions x features
+
+        distances = numpy.empty(len(self._embeddings))
+        for start in range(0, len(self._embeddings), chunk_size):
+            chunk = self._embeddings[start:start + chunk_size]
+            best = numpy.full(len(chunk), numpy.inf)
+
+            for rotated_query in rotated_queries:
+                d = numpy.sqrt(((chunk - rotated_query[None]) ** 2).sum(axis=2)) @ self._weights
+                numpy.minimum(best, d, out=best)
+
+            distances[start:start + chunk_size] = best
+
+        return distances
+
+    def query(self, transform, k: int)->(numpy.ndarray, numpy.ndarray):
+        """
+        Approximate k nearest neighbors of transform.
+
+        Returns
+        -------
+            (indices, approximate distances), both sorted by approximate distance.
+        """
+        distances = self.approximate_distances(transform)
+        k = min(int(k), len(distances))
+
+        if k == 0:
+            return numpy.empty(0, dtype=int), numpy.empty(0)
+
+        candidates = numpy.argpartition(distances, k - 1)[:k]
+        candidates = candidates[numpy.argsort(distances[candidates], kind='stable')]
+
+        return candidates, distances[candidates]
+
+    def search(self, transform, k: int, shortlist_size: int=None)->(numpy.ndarray, numpy.ndarray):
+        """
+        k nearest neighbors of transform w.r.t. the exact npht distance among the shortlist_size approximate
+        nearest neighbors.
+
+        Returns
+        -------
+            (indices, exact distances), both sorted by exact distance.
+        """
+        if shortlist_size is None:
+            shortlist_size = 4 * k
+
+        shortlist, _ = self.query(transform, max(int(shortlist_size), int(k)))
+        exact = numpy.array([self._exact_distance(transform, self._transforms[i]) for i in shortlist])
+
+        order = numpy.argsort(exact, kind='stable')[:k]
+        return shortlist[order], exact[order]
+
+    def recall(self, queries: list, k: int, shortlist_size: int=None)->float:
+        """
+        Fraction of the exact k nearest neighbors (brute force over the whole index) which search returns,
+        averaged over queries. This evaluates the exact distance of every query to every stored transform.
+        """
+        k = min(int(k), len(self))
+        hits = []
+        for q in queries:
+            brute_force = numpy.array([self._exact_distance(q, t) for t in self._transforms])
+            truth = set(numpy.argsort(brute_force, kind='stable')[:k].tolist())
+
+            found, _ = self.search(q, k, shortlist_size)
+            hits.append(len(truth.intersection(found.tolist())) / k if k > 0 else 1.0)
+
+        return float(numpy.mean(hits)) if len(hits) > 0 else 1.0
+
+
+class NPHTIndex2D(_NPHTIndexBase):
+    """
+    Index over npht's as computed by calculate_discrete_NPHT_2d. Cyclic shifts of the directions are
+    treated as rotations, consistent with distance_npht2D.
+    """
+    def __init__(self, included_dimensions=(0, 1), minimize_over_rotations=True, **kwargs):
+        super().__init__(included_dimensions, **kwargs)
+        self.minimize_over_rotations = bool(minimize_over_rotations)
+
+    def _direction_permutations(self, number_of_directions):
+        if not self.minimize_over_rotations:
+            return numpy.arange(number_of_directions)[None, :]
+
+        return _cyclic_direction_permutations(number_of_directions)
+
+    def _direction_weights(self, number_of_directions):
+        return numpy.full(number_of_directions, 2 * numpy.pi / number_of_directions)
+
+    def _exact_distance(self, t_1, t_2):
+        kwargs = dict(included_dimensions=self.included_dimensions,
+                      minimize_over_rotations=self.minimize_over_rotations)
+        kwargs.update(self.distance_kwargs)
+        return distance_npht2D(t_1, t_2, **kwargs)
+
+
+class NPHTIndex3DLebedev26(_NPHTIndexBase):
+    """
+    Index over npht's as computed by calculate_discrete_NPHT_3d_Lebedev26. The octahedral rotation group acts
+    on the directions, consistent with distance_npht3D_lebedev_26.
+    """
+    def __init__(self, included_dimensions=(0, 1, 2), minimize_over_rotations=True, **kwargs):
+        super().__init__(included_dimensions, **kwargs)
+        self.minimize_over_rotations = bool(minimize_over_rotations)
+        self._grid_points = list(LebedevGrid26())
+
+    def _direction_permutations(self, number_of_directions):
+        if not self.minimize_over_rotations:
+            return numpy.arange(number_of_directions)[None, :]
+
+        return _octahedral_direction_permutations()
+
+    def _direction_weights(self, number_of_directions):
+        return numpy.array([4 * numpy.pi * _Lebedev26Integrator.weight(p) for p in self._grid_points])
+
+    def _exact_distance(self, t_1, t_2):
+        kwargs = dict(included_dimensions=self.included_dimensions,
+                      minimize_over_rotations=self.minimize_over_rotations)
+        kwargs.update(self.distance_kwargs)
+        return distance_npht3D_lebedev_26(t_1, t_2, **kwargs)
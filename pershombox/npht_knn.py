@@ -0,0 +1,265 @@
+"""
+Exact k nearest neighbor queries over collections of NPHTs.
+
+Most candidates are excluded by lower bounds of the npht distance, the exact distance is only evaluated for
+the others. Two bounds are used:
+
+    summaries  For each direction and dimension the distance of the diagram to the empty diagram (its total
+               persistence w.r.t. the metric) and its largest distance to the diagonal. By the triangle inequality
+               d(A, B) >= |d(A, {}) - d(B, {})|, and for Wasserstein distances d(A, B) >= |max_A - max_B|
+               (bottleneck distance).
+
+    pivots     Exact distances of some stored transforms (pivots) to all others, computed once. By the triangle
+               inequality of the npht distance D(q, s) >= |D(q, p) - D(p, s)|. This needs D to be a (pseudo)
+               metric, which holds if the integration weights are invariant under the rotations, i.e., for
+               the 3D transform (without pre_alignment_top_k) and for the 2D transform without minimization over
+               rotations.
+
+Hera's approximation error is accounted for: it returns the cost of a matching d' with d <= d' <= (1 + e) d.
+Hence the returned neighbors and distances are the same as those of a brute force search.
+"""
+import numpy
+
+from .lebedev import lebedev_26_integration
+from .pht_metric import Distance_NPHT_2d, DistanceNPHT3D_Lebedev26, _diagram_distances
+from .vectorization import _directions_of, _lebedev_26_points, \
+    _cyclic_direction_permutations, _octahedral_direction_permutations
+from ._software_backends import instrumentation
+
+
+# Relative slack of the pruning bounds against floating point round off.
+_bound_slack = 1e-9
+
+
+class _ExactNPHTSearchBase:
+    def __init__(self, transforms: list, number_of_pivots: int=0, seed: int=0, chunk_size: int=1024,
+                 **distance_kwargs):
+        """
+        Parameters
+        ----------
+        transforms:
+            list. The searched collection.
+
+        number_of_pivots:
+            int. Number of stored transforms whose exact distances to all others are calculated up front
+            (number_of_pivots * len(transforms) evaluations of the npht distance).
+
+        seed:
+            int. Seed of the random choice of the pivots.
+
+        chunk_size:
+            int. Number of transforms whose summary bounds are computed at once.
+
+        distance_kwargs:
+            Passed to the npht distance, e.g., wasserstein_degree, included_dimensions, metric.
+        """
+        self._distance = self._distance_type(**distance_kwargs)
+        self.chunk_size = int(chunk_size)
+
+        metric = self._distance.metric
+        self._relative_error = self._distance.relative_error if metric == 'wasserstein' else 0.0
+
+        self._transforms = list(transforms)
+        self._number_of_directions = len(_directions_of(self._transforms[0])) if len(self._transforms) > 0 else 0
+        self._permutations = self._direction_permutations(self._number_of_directions)
+        self._weights = self._direction_weights(self._number_of_directions)
+
+        self._summaries = numpy.stack([self._summary(t) for t in self._transforms]) \
+            if len(self._transforms) > 0 else None
+
+        number_of_pivots = min(int(number_of_pivots), len(self._transforms))
+        if number_of_pivots > 0 and not self._pivots_valid():
+            raise ValueError('Pivots need a metric npht distance, see the module documentation.')
+
+        rng = numpy.random.RandomState(seed)
+        self._pivots = numpy.sort(rng.choice(len(self._transforms), number_of_pivots, replace=False)) \
+            if number_of_pivots > 0 else numpy.empty(0, dtype=int)
+        self._pivot_distances = numpy.empty((len(self._pivots), len(self._transforms)))
+        for i, p in enumerate(self._pivots):
+            self._pivot_distances[i] = [self._distance(self._transforms[p], t) for t in self._transforms]
+
+    # region abstract
+
+    _distance_type = None
+
+    def _direction_permutations(self, number_of_directions)->numpy.ndarray:
+        """
+        number_of_rotations x number_of_directions array, row r lists for each direction of the first argument
+        the direction of the second argument it is compared with under rotation r.
+        """
+        raise NotImplementedError("Abstract method.")
+
+    def _direction_weights(self, number_of_directions)->numpy.ndarray:
+        """
+        Weights of the per-direction distances in the npht distance (zero for directions not used).
+        """
+        raise NotImplementedError("Abstract method.")
+
+    def _pivots_valid(self)->bool:
+        raise NotImplementedError("Abstract method.")
+
+    # endregion
+
+    def __len__(self):
+        return len(self._transforms)
+
+    def _summary(self, transform)->numpy.ndarray:
+        """
+        2 x directions x dimensions. [0] distances to the empty diagram, [1] largest distances to the diagonal.
+        """
+        directions = _directions_of(transform)
+        dimensions = list(self._distance.included_dimensions)
+
+        # Distances to the empty diagram are calculated in closed form, i.e., exactly.
+        pairs = [(dgms[dim], []) for dgms in directions for dim in dimensions]
+        to_empty = _diagram_distances(pairs, self._distance.metric, self._distance.p, self._distance.q,
+                                      self._distance.number_of_slices, 0.0)
+
+        largest = []
+        for dgms in directions:
+            for dim in dimensions:
+                points = numpy.asarray(dgms[dim], dtype=numpy.float64).reshape(-1, 2)
+                largest.append(((points[:, 1] - points[:, 0]) / 2).max(initial=0))
+
+        shape = (len(directions), len(dimensions))
+        return numpy.stack([numpy.reshape(to_empty, shape), numpy.reshape(largest, shape)])
+
+    def _summary_lower_bounds(self, query_summary: numpy.ndarray)->numpy.ndarray:
+        """
+        Lower bound of the (computed) npht distance of the query to every stored transform.
+        """
+        positive = numpy.clip(self._weights, 0, None)
+        negative = numpy.clip(self._weights, None, 0)
+        use_largest = self._distance.metric == 'wasserstein'
+
+        bounds = numpy.empty(len(self._transforms))
+        for start in range(0, len(self._transforms), self.chunk_size):
+            # chunk x rotations x directions x dimensions
+            rotated = self._summaries[start:start + self.chunk_size][:, :, self._permutations]
+
+            lower = numpy.abs(query_summary[0][None, None] - rotated[:, 0])
+            if use_largest:
+                lower = numpy.maximum(lower, numpy.abs(query_summary[1][None, None] - rotated[:, 1]))
+
+            # Directions with negative weight need an upper bound: d(A, B) <= d(A, {}) + d({}, B).
+            upper = (query_summary[0][None, None] + rotated[:, 0]) * (1 + self._relative_error)
+
+            per_rotation = lower.sum(axis=3) @ positive + upper.sum(axis=3) @ negative
+            bounds[start:start + self.chunk_size] = per_rotation.min(axis=1)
+
+        return bounds
+
+    def query(self, transform, k: int)->(numpy.ndarray, numpy.ndarray, dict):
+        """
+        Exact k nearest neighbors of transform.
+
+        Returns
+        -------
+            (indices, distances, statistics). indices and distances are sorted by distance. statistics has the keys
+            'candidates' (stored transforms), 'evaluated' (exact distance evaluations, including pivots),
+            'avoided', 'pruned_by_summaries' and 'pruned_by_pivots'.
+        """
+        k = min(int(k), len(self._transforms))
+        statistics = {'candidates': len(self._transforms), 'evaluated': 0, 'avoided': 0,
+                      'pruned_by_summaries': 0, 'pruned_by_pivots': 0}
+
+        if k == 0:
+            statistics['avoided'] = len(self._transforms)
+            return numpy.empty(0, dtype=int), numpy.empty(0), statistics
+
+        exact = numpy.full(len(self._transforms), numpy.nan)
+
+        summary_bounds = self._summary_lower_bounds(self._summary(transform))
+        bounds = summary_bounds.copy()
+
+        if len(self._pivots) > 0:
+            to_pivots = numpy.array([self._distance(transform, self._transforms[p]) for p in self._pivots])
+            exact[self._pivots] = to_pivots
+
+            e = self._relative_error
+            pivot_bounds = numpy.maximum(to_pivots[:, None] / (1 + e) - self._pivot_distances,
+                                         self._pivot_distances / (1 + e) - to_pivots[:, None]).max(axis=0)
+            bounds = numpy.maximum(bounds, pivot_bounds)
+
+        def kth_best():
+            known = exact[~numpy.isnan(exact)]
+            return numpy.partition(known, k - 1)[k - 1] if len(known) >= k else numpy.inf
+
+        threshold = kth_best()
+        for s in numpy.argsort(bounds, kind='stable'):
+            if bounds[s] > threshold * (1 + _bound_slack):
+                break
+
+            if numpy.isnan(exact[s]):
+                exact[s] = self._distance(transform, self._transforms[s])
+                threshold = kth_best()
+
+        evaluated = ~numpy.isnan(exact)
+        pruned = ~evaluated
+        statistics['evaluated'] = int(evaluated.sum())
+        statistics['avoided'] = int(pruned.sum())
+        statistics['pruned_by_summaries'] = int((pruned & (summary_bounds > threshold)).sum())
+        statistics['pruned_by_pivots'] = statistics['avoided'] - statistics['pruned_by_summaries']
+
+        instrumentation.count('npht_knn', 'evaluated', statistics['evaluated'])
+        instrumentation.count('npht_knn', 'avoided', statistics['avoided'])
+
+        candidates = numpy.flatnonzero(evaluated)
+        order = numpy.lexsort((candidates, exact[candidates]))[:k]
+
+        return candidates[order], exact[candidates[order]], statistics
+
+
+class ExactNPHTSearch2D(_ExactNPHTSearchBase):
+    """
+    Exact k nearest neighbor search w.r.t. distance_npht2D. Pivots are only supported with
+    minimize_over_rotations=False.
+    """
+    _distance_type = Distance_NPHT_2d
+
+    def _used_directions(self, number_of_directions):
+        # Distance_NPHT_2d only compares the first direction if it does not minimize over rotations.
+        return number_of_directions if self._distance.minimize_over_rotations else 1
+
+    def _direction_permutations(self, number_of_directions):
+        return _cyclic_direction_permutations(number_of_directions, self._used_directions(number_of_directions))
+
+    def _direction_weights(self, number_of_directions):
+        import scipy.integrate
+
+        n = self._used_directions(number_of_directions)
+        abscissa = numpy.linspace(0, 2 * numpy.pi, n + 1)
+
+        weights = numpy.zeros(number_of_directions)
+        for i in range(n):
+            unit = numpy.eye(n)[i]
+            weights[i] = scipy.integrate.simps(list(unit) + [unit[0]], abscissa)
+
+        return weights
+
+    def _pivots_valid(self):
+        return not self._distance.minimize_over_rotations
+
+
+class ExactNPHTSearch3DLebedev26(_ExactNPHTSearchBase):
+    """
+    Exact k nearest neighbor search w.r.t. distance_npht3D_lebedev_26.
+    """
+    _distance_type = DistanceNPHT3D_Lebedev26
+
+    # order of the directions, see _directions_of
+    _grid_points = list(_lebedev_26_points)
+
+    def _direction_permutations(self, number_of_directions):
+        if not self._distance.minimize_over_rotations:
+            return numpy.arange(number_of_directions)[None, :]
+
+        return _octahedral_direction_permutations()
+
+    def _direction_weights(self, number_of_directions):
+        return numpy.array([lebedev_26_integration({q: float(q == p) for q in self._grid_points})
+                            for p in self._grid_points])
+
+    def _pivots_valid(self):
+        # the minimum over a subset of the rotations is no metric
+        return self._distance.pre_alignment_top_k is None
@@ -1,11 +1,43 @@
+import os
+import itertools
 import numpy
-from ._software_backends.dipha_adapter import persistence_diagrams_of_filtrated_cubical_complex
-from .dgm_util import de_essentialize
+from collections import namedtuple
+from .cubical_backends import cubical_persistence_diagrams, cubical_persistence_diagrams_batch
+from ._software_backends import instrumentation
+from .dgm_util import de_essentialize, DiagramCompaction
 from .lebedev import LebedevGrid26
+from .toplex import _ToplexStructure, _map_in_order
 
 
 # region helpers
 
+def _upper_dimension(dimensions, ambient_dimension)->int:
+    """
+    limit_dimensions passed to DIPHA such that all requested dimensions are calculated.
+    """
+    if dimensions is None:
+        return None
+
+    dimensions = tuple(dimensions)
+    if len(dimensions) == 0 or not all(0 <= d < ambient_dimension for d in dimensions):
+        raise ValueError('Value range of parameter dimensions is a non empty subset of {} given was {}'.format(
+            tuple(range(ambient_dimension)), dimensions))
+
+    return max(dimensions) + 1
+
+
+def _requested(dgms, dimensions, ambient_dimension)->list:
+    """
+    One entry per dimension < ambient_dimension, diagrams of not requested dimensions are empty.
+    """
+    dgms = list(dgms) + [[] for _ in range(ambient_dimension - len(dgms))]
+
+    if dimensions is None:
+        return dgms
+
+    return [dgm if dim in dimensions else [] for dim, dgm in enumerate(dgms)]
+
+
 def _snap_zero_one(value):
     if numpy.isclose([value], [1]):
         return 1
@@ -56,12 +88,24 @@ class BarycentricHeightFiltration:
 
 
 def calculate_discrete_NPHT_2d(binary_cubical_complex: numpy.array,
-                               number_of_directions)->list:
+                               number_of_directions,
+                               compaction: DiagramCompaction=None,
+                               dimensions: tuple=None,
+                               backend: str='dipha',
+                               max_cells_per_call: int=None)->list:
     """
     Calculates NPHT for 2d cubical complexes with equidistant directions.
 
     :param binary_cubical_complex:
     :param number_of_directions:
+    :param compaction: optional, applied to each diagram, see DiagramCompaction. Its statistics of this
+        transform are appended to compaction.statistics.
+    :param dimensions: optional, homology dimensions to calculate, e.g., (0,). DIPHA only calculates the
+        dimensions up to max(dimensions), the diagrams of the other dimensions are empty.
+    :param backend: backend of the cubical persistence computations, e.g., 'dipha_dual' or 'auto',
+        see cubical_backends.
+    :param max_cells_per_call: the filtrated complexes of several directions are packed into one backend call
+        of at most this many cells, see cubical_persistence_diagrams_batch. 1 -> one call per direction.
     :return:
     """
 
@@ -70,6 +114,8 @@ def calculate_discrete_NPHT_2d(binary_cubical_complex: numpy.array,
     if binary_cubical_complex.ndim != 2:
         raise ValueError("binary_cubical_complex must have dimension 2.")
 
+    limit_dimensions = _upper_dimension(dimensions, 2)
+
     vertices = [v for v, b in numpy.ndenumerate(binary_cubical_complex) if b]
 
     return_value = []
@@ -80,74 +126,257 @@ def calculate_discrete_NPHT_2d(binary_cubical_complex: numpy.array,
                               _snap_zero_one(numpy.sin(t*numpy.pi)))
                              for t in spherical_coordinates]
 
+    if compaction is not None:
+        compaction.begin_transform()
+
+    filtrated_complexes = []
+    f_maxima = []
     for v_cart in cartesian_coordinates:
+        with instrumentation.stage('pht_2d', 'filtration'):
+            filtration = NormalizedBarycentricHeightFiltration(vertices, v_cart)
+
+            filtrated_complex = numpy.empty(binary_cubical_complex.shape)
+            filtrated_complex.fill(float('inf'))
 
-        filtration = NormalizedBarycentricHeightFiltration(vertices, v_cart)
+            f_values = []
+            for v in vertices:
+                f_v = filtration(v)
+                f_values.append(f_v)
+                filtrated_complex[v] = f_v
 
-        filtrated_complex = numpy.empty(binary_cubical_complex.shape)
-        filtrated_complex.fill(float('inf'))
+            filtrated_complexes.append(filtrated_complex)
+            f_maxima.append(max(f_values))
 
-        f_values = []
-        for v in vertices:
-            f_v = filtration(v)
-            f_values.append(f_v)
-            filtrated_complex[v] = f_v
+    with instrumentation.stage('pht_2d', 'persistence'):
+        dgms_by_direction = cubical_persistence_diagrams_batch(filtrated_complexes,
+                                                               limit_dimensions=limit_dimensions,
+                                                               backend=backend,
+                                                               max_cells_per_call=max_cells_per_call)
 
-        f_max = max(f_values)
+    for dgms, f_max in zip(dgms_by_direction, f_maxima):
+        dgms = [de_essentialize(dgm, f_max) for dgm in _requested(dgms, dimensions, 2)]
 
-        dgms = persistence_diagrams_of_filtrated_cubical_complex(filtrated_complex)
-        dgms = [de_essentialize(dgm, f_max) for dgm in dgms]
+        if compaction is not None:
+            dgms = [compaction(dgm, dim) for dim, dgm in enumerate(dgms)]
 
         return_value.append(dgms)
+
+    if compaction is not None:
+        compaction.end_transform()
+
     return return_value
 
 
+# region principal axes
+
+
+class PrincipalAxes(namedtuple('PrincipalAxes', ['eigenvalues', 'axes'])):
+    """
+    eigenvalues: the eigenvalues of the covariance of the voxel coordinates, descending.
+    axes: 3 x 3 array, axes[i] is the (unit) eigenvector of eigenvalues[i]. Its sign is arbitrary.
+    """
+    pass
+
+
+def principal_axes(binary_cubical_complex: numpy.array)->PrincipalAxes:
+    """
+    Principal axes of the foreground voxels of binary_cubical_complex, in the coordinates of the transforms,
+    i.e., of the voxel indices.
+    """
+    coordinates = numpy.argwhere(numpy.asarray(binary_cubical_complex).astype(bool)).astype(numpy.float64)
+    if len(coordinates) == 0:
+        raise ValueError('binary_cubical_complex has no foreground voxel.')
+
+    coordinates -= coordinates.mean(axis=0)
+    eigenvalues, eigenvectors = numpy.linalg.eigh(coordinates.T @ coordinates / len(coordinates))
+    order = numpy.argsort(eigenvalues)[::-1]
+
+    return PrincipalAxes(eigenvalues[order], eigenvectors[:, order].T)
+
+
+class TransformWithPrincipalAxes(dict):
+    """
+    A 3d transform (dict, lebedev point -> diagrams) together with the principal axes of its volume, see
+    DistanceNPHT3D_Lebedev26 (pre_alignment_top_k).
+    """
+    def __init__(self, transform: dict, principal_axes: PrincipalAxes):
+        super().__init__(transform)
+        self.principal_axes = principal_axes
+
+
+# endregion
+
+
 class GeneralPersistentHomologyTransform3d:
     def __init__(self, heigt_function_type: type, grid_type: type):
         self._height_function_type = heigt_function_type
         self._grid_type = grid_type
 
-    def __call__(self, binary_cubical_complex: numpy.array, de_essentialized=True)->dict:
+    def __call__(self, binary_cubical_complex: numpy.array, de_essentialized=True,
+                 compaction: DiagramCompaction=None, dimensions: tuple=None, backend: str='dipha')->dict:
         binary_cubical_complex = binary_cubical_complex.astype(bool)
 
         if binary_cubical_complex.ndim != 3:
             raise ValueError("simplicial_complex must have dimension 3.")
 
+        limit_dimensions = _upper_dimension(dimensions, 3)
+
         vertices = [v for v, b in numpy.ndenumerate(binary_cubical_complex) if b]
         grid = self._grid_type()
         return_value = {}
 
+        if compaction is not None:
+            compaction.begin_transform()
+
         for direction in grid:
-            filtrated_complex = numpy.empty(binary_cubical_complex.shape)
-            filtrated_complex.fill(float('inf'))
+            with instrumentation.stage('pht_3d', 'direction'):
 
-            filtration = self._height_function_type(vertices,
-                                                    grid.to_cartesian(direction))
+                with instrumentation.stage('pht_3d', 'filtration'):
+                    filtrated_complex = numpy.empty(binary_cubical_complex.shape)
+                    filtrated_complex.fill(float('inf'))
 
-            f_values = []
-            for v in vertices:
-                f_v = filtration(v)
-                f_values.append(f_v)
-                filtrated_complex[v] = f_v
+                    filtration = self._height_function_type(vertices,
+                                                            grid.to_cartesian(direction))
+
+                    f_values = []
+                    for v in vertices:
+                        f_v = filtration(v)
+                        f_values.append(f_v)
+                        filtrated_complex[v] = f_v
+
+                    f_max = max(f_values)
+
+                dgms = cubical_persistence_diagrams(filtrated_complex, limit_dimensions=limit_dimensions,
+                                                    backend=backend)
+                dgms = [de_essentialize(dgm, f_max) for dgm in _requested(dgms, dimensions, 3)]
 
-            f_max = max(f_values)
+                if compaction is not None:
+                    dgms = [compaction(dgm, dim) for dim, dgm in enumerate(dgms)]
 
-            dgms = persistence_diagrams_of_filtrated_cubical_complex(filtrated_complex)
-            dgms = [de_essentialize(dgm, f_max) for dgm in dgms]
+                return_value[direction] = dgms
 
-            return_value[direction] = dgms
+        if compaction is not None:
+            compaction.end_transform()
 
         return return_value
 
 
-def calculate_discrete_NPHT_3d_Lebedev26(binary_cubical_complex: numpy.array):
+def calculate_discrete_NPHT_3d_Lebedev26(binary_cubical_complex: numpy.array,
+                                         compaction: DiagramCompaction=None,
+                                         dimensions: tuple=None,
+                                         backend: str='dipha',
+                                         with_principal_axes: bool=False):
     """
     Calculates NPHT for 3d binary complexes with respect to the Lebedev grid with 26 directions.
 
     :param binary_cubical_complex:
+    :param compaction: optional, see calculate_discrete_NPHT_2d.
+    :param dimensions: optional, see calculate_discrete_NPHT_2d. E.g. (0, 1) skips the calculation of H2.
+    :param backend: see calculate_discrete_NPHT_2d.
+    :param with_principal_axes: if True a TransformWithPrincipalAxes is returned, which lets
+        DistanceNPHT3D_Lebedev26 skip rotations which do not align the principal axes.
     :return:
     """
     f = GeneralPersistentHomologyTransform3d(BarycentricHeightFiltration,
                                              LebedevGrid26)
 
-    return f(binary_cubical_complex)
+    transform = f(binary_cubical_complex, compaction=compaction, dimensions=dimensions, backend=backend)
+
+    if with_principal_axes:
+        return TransformWithPrincipalAxes(transform, principal_axes(binary_cubical_complex))
+
+    return transform
+
+
+# region meshes
+
+
+def _lower_star_simplices(number_of_vertices: int, toplices: numpy.ndarray)->[numpy.ndarray]:
+    """
+    All simplices of the complex spanned by toplices (and all vertices), grouped by dimension.
+    """
+    simplices = [numpy.arange(number_of_vertices)[:, None]]
+    toplices = numpy.sort(toplices, axis=1)
+
+    for k in range(2, toplices.shape[1] + 1):
+        faces = numpy.concatenate([toplices[:, c] for c in itertools.combinations(range(toplices.shape[1]), k)])
+        simplices.append(numpy.unique(faces, axis=0))
+
+    return simplices
+
+
+def calculate_discrete_NPHT_mesh(vertices: numpy.array,
+                                 toplices: numpy.array,
+                                 directions: numpy.array,
+                                 normalized: bool=True,
+                                 workers: int=None,
+                                 scratch_dir: str=None)->list:
+    """
+    Calculates the (normalized) barycentric persistent homology transform of a simplicial mesh by Perseus.
+
+    The heights of all vertices in all directions are one matrix product, the filtration value of each simplex
+    is the maximum over its vertices (lower-star filtration). The simplices are only serialized once, the
+    directions are calculated concurrently.
+
+    :param vertices: number_of_vertices x d array.
+    :param toplices: number_of_toplices x (k + 1) array of vertex indices, e.g., the triangles of a mesh.
+    :param directions: number_of_directions x d array.
+    :param normalized: if True heights are normalized to [0, 1] as by NormalizedBarycentricHeightFiltration,
+        else as by BarycentricHeightFiltration.
+    :param workers: number of concurrent Perseus processes, defaults to os.cpu_count().
+    :param scratch_dir: see toplex_persistence_diagrams_batch.
+    :return: [[[]]], return_value[i][j] persistence diagram of dimension j in direction i (de-essentialized).
+    """
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    toplices = numpy.asarray(toplices, dtype=numpy.int64)
+    directions = numpy.asarray(directions, dtype=numpy.float64)
+
+    if vertices.ndim != 2 or directions.ndim != 2 or vertices.shape[1] != directions.shape[1]:
+        raise ValueError('shape of vertices and directions do not comply!')
+
+    if toplices.ndim != 2 or len(toplices) == 0:
+        raise ValueError('toplices are expected to be a non empty number_of_toplices x (k + 1) array.')
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with instrumentation.stage('pht_mesh', 'filtration'):
+        centered = vertices - vertices.mean(axis=0)
+        heights = centered @ (directions / numpy.linalg.norm(directions, axis=1)[:, None]).T
+
+        if normalized:
+            radius = numpy.linalg.norm(centered, axis=1).max()
+            heights = (heights + radius) / (2 * radius)
+
+        simplices = _lower_star_simplices(len(vertices), toplices)
+        # number_of_simplices x number_of_directions
+        filtrations = numpy.concatenate([heights[s].max(axis=1) for s in simplices])
+        f_max = heights.max(axis=0)
+
+        structure = _ToplexStructure([tuple(s) for group in simplices for s in (group + 1).tolist()])
+
+    def calculate(i, worker_scratch_dir):
+        with instrumentation.stage('pht_mesh', 'direction'):
+            dgms = structure.calculate_persistence_diagrams(filtrations[:, i], scratch_dir=worker_scratch_dir)
+            return [de_essentialize(dgm, f_max[i]) for dgm in dgms]
+
+    return list(_map_in_order(calculate, range(len(directions)), workers, 4 * workers, scratch_dir))
+
+
+def calculate_discrete_NPHT_mesh_Lebedev26(vertices: numpy.array, toplices: numpy.array, **kwargs)->dict:
+    """
+    calculate_discrete_NPHT_mesh of a 3d mesh w.r.t. the Lebedev grid with 26 directions, with barycentric
+    heights as calculate_discrete_NPHT_3d_Lebedev26. Comparable by distance_npht3D_lebedev_26.
+
+    :param kwargs: see calculate_discrete_NPHT_mesh.
+    :return: dict, return_value[lebedev_point][j] persistence diagram of dimension j.
+    """
+    grid = LebedevGrid26()
+    points = list(grid)
+    kwargs.setdefault('normalized', False)
+
+    dgms = calculate_discrete_NPHT_mesh(vertices, toplices, [grid.to_cartesian(p) for p in points], **kwargs)
+    return dict(zip(points, dgms))
+
+
+# endregion
@@ -8,6 +8,78 @@ from .lebedev import lebedev_26_integration, \
 
 
 from ._software_backends.hera_adapter import wasserstein_distance
+from ._software_backends import instrumentation
+from .dgm_metric import sliced_wasserstein_distances, bottleneck_distance
+
+
+_metrics = ('wasserstein', 'sliced_wasserstein', 'bottleneck')
+
+
+def _check_metric(metric):
+    if metric not in _metrics:
+        raise ValueError("metric is expected to be one of {} given was {}".format(_metrics, metric))
+
+
+def _diagram_distances(pairs: [tuple], metric: str, p, q, number_of_slices: int,
+                       relative_error: float=0.01)->[float]:
+    """
+    Distance of each pair of persistence diagrams in pairs w.r.t. metric.
+    """
+    if metric == 'sliced_wasserstein':
+        return sliced_wasserstein_distances(pairs, number_of_slices).tolist()
+
+    if metric == 'bottleneck':
+        return [bottleneck_distance(dgm_1, dgm_2) for dgm_1, dgm_2 in pairs]
+
+    return [wasserstein_distance(dgm_1, dgm_2, degree=p, internal_norm=q, relative_error=relative_error)
+            for dgm_1, dgm_2 in pairs]
+
+
+# Relative slack of the pruning bound against floating point round off.
+_bound_slack = 1e-9
+
+
+def _coarse_to_fine_minimum(coarse_ordinates: [[float]],
+                            weights: numpy.ndarray,
+                            coarse_relative_error: float,
+                            relative_error: float,
+                            fine_distance)->float:
+    """
+    min_r fine_distance(r) over all candidates r (rotations or shifts), evaluating fine_distance only for the
+    candidates which can attain the minimum.
+
+    coarse_ordinates[r] are the per-direction distances of candidate r calculated with coarse_relative_error,
+    fine_distance(r) is the integral (with weights) of the per-direction distances calculated with relative_error.
+
+    hera returns the cost of a matching, i.e., the exact distance f and the approximation g with relative
+    error e satisfy f <= g <= (1 + e) f. Hence the coarse ordinates c give
+
+        fine_distance(r) >= sum_{w_i > 0} w_i c_i / (1 + coarse_relative_error)
+                            + sum_{w_i < 0} w_i c_i (1 + relative_error)
+
+    Candidates are refined in the order of this lower bound, and the search stops as soon as the bound exceeds
+    the best refined distance. The result equals min_r fine_distance(r).
+    """
+    coarse_ordinates = numpy.asarray(coarse_ordinates, dtype=numpy.float64)
+    positive = numpy.clip(weights, 0, None)
+    negative = numpy.clip(weights, None, 0)
+
+    lower_bounds = coarse_ordinates @ positive / (1 + coarse_relative_error) + \
+        (1 + relative_error) * (coarse_ordinates @ negative)
+
+    best = float('inf')
+    refined = 0
+    for r in numpy.argsort(lower_bounds, kind='stable'):
+        if lower_bounds[r] > best * (1 + _bound_slack):
+            break
+
+        best = min(best, fine_distance(int(r)))
+        refined += 1
+
+    instrumentation.count('npht_distance', 'candidates_refined', refined)
+    instrumentation.count('npht_distance', 'candidates_pruned', len(lower_bounds) - refined)
+
+    return best
 
 
 class Distance_NPHT_2d:
@@ -15,7 +87,11 @@ class Distance_NPHT_2d:
                  wasserstein_degree=2,
                  wasserstein_internal_norm=2,
                  included_dimensions=(0, 1),
-                 minimize_over_rotations=True):
+                 minimize_over_rotations=True,
+                 metric='wasserstein',
+                 number_of_slices=50,
+                 relative_error=0.01,
+                 coarse_relative_error=None):
         """
 
         Parameters
@@ -33,11 +109,37 @@ class Distance_NPHT_2d:
             (1)   -> dimension 1
         minimize_over_rotations:
             bool. If false the min over the rotation group is not searched.
+
+        metric:
+            str. Distance of the persistence diagrams of one direction.
+            'wasserstein' -> Wasserstein distance calculated by hera.
+            'sliced_wasserstein' -> sliced Wasserstein distance (in-process), wasserstein_* parameters are ignored.
+            'bottleneck' -> bottleneck distance (in-process), wasserstein_* parameters are ignored.
+
+        number_of_slices:
+            int. Number of slices of the sliced Wasserstein distance.
+
+        relative_error:
+            float. Relative error of the Wasserstein distances calculated by hera.
+
+        coarse_relative_error:
+            float. If given (and metric is 'wasserstein'), the minimum over the rotations is searched in two
+            phases: all rotations are scored with coarse_relative_error, and only those which can still attain the
+            minimum are recalculated with relative_error. The result is the same as without this phase.
         """
+        _check_metric(metric)
+
         self.p = wasserstein_degree
         self.q = wasserstein_internal_norm
         self.included_dimensions = included_dimensions
         self.minimize_over_rotations = bool(minimize_over_rotations)
+        self.metric = metric
+        self.number_of_slices = int(number_of_slices)
+        self.relative_error = float(relative_error)
+        self.coarse_relative_error = None if coarse_relative_error is None else float(coarse_relative_error)
+
+    def _two_phase(self)->bool:
+        return self.metric == 'wasserstein' and self.coarse_relative_error is not None
 
     def __call__(self, t_1: [[[]]], t_2: [[[]]]):
         """
@@ -65,25 +167,33 @@ class Distance_NPHT_2d:
 
         abscissa = numpy.linspace(0, 2 * numpy.pi, n + 1)
 
-        integration_results = []
-        for shift in range(n):
-            ordinates_shifted = []
-            for i in range(n):
-                dgm_t_1_dir = [t_1[i][dim] for dim in self.included_dimensions]
-                dgm_t_2_dir = [t_2[(i + shift) % n][dim] for dim in self.included_dimensions]
+        def integrate(ordinates):
+            # Last point twice to emulate closed curve integral
+            return scipy.integrate.simps(list(ordinates) + [ordinates[0]], abscissa)
 
-                y = sum(
-                    [wasserstein_distance(dgm_c_1, dgm_c_2, degree=self.p, internal_norm=self.q)
-                     for dgm_c_1, dgm_c_2
-                     in zip(dgm_t_1_dir, dgm_t_2_dir)])
-                ordinates_shifted.append(y)
+        def distance(shift, relative_error):
+            return integrate(self._ordinates(t_1, t_2, n, shift, relative_error))
 
-            # Last point twice to emulate closed curve integral
-            ordinates_shifted.append(ordinates_shifted[0])
+        if not self._two_phase() or n == 1:
+            return min(distance(shift, self.relative_error) for shift in range(n))
 
-            integration_results.append(scipy.integrate.simps(ordinates_shifted, abscissa))
+        coarse_ordinates = [self._ordinates(t_1, t_2, n, shift, self.coarse_relative_error) for shift in range(n)]
+        weights = numpy.array([integrate(numpy.eye(n)[i]) for i in range(n)])
 
-        return min(integration_results)
+        return _coarse_to_fine_minimum(coarse_ordinates, weights, self.coarse_relative_error, self.relative_error,
+                                       lambda shift: distance(shift, self.relative_error))
+
+    def _ordinates(self, t_1, t_2, n, shift, relative_error)->[float]:
+        """
+        Sum over the included dimensions of the distances of direction i of t_1 and direction i + shift of t_2,
+        for i < n.
+        """
+        dimensions = list(self.included_dimensions)
+
+        pairs = [(t_1[i][dim], t_2[(i + shift) % n][dim]) for i in range(n) for dim in dimensions]
+        distances = _diagram_distances(pairs, self.metric, self.p, self.q, self.number_of_slices, relative_error)
+
+        return [sum(distances[i * len(dimensions):(i + 1) * len(dimensions)]) for i in range(n)]
 
     @staticmethod
     def _check_parameters(t_1, t_2):
@@ -91,12 +201,71 @@ class Distance_NPHT_2d:
             raise ValueError("Expected len(t_1) == len(t_2)")
 
 
+# region pre-alignment
+
+
+# word -> 3 x 3 matrix M_w of the octahedral rotation w, see _octahedral_rotation_matrices
+_rotation_matrices = {}
+
+
+def _octahedral_rotation_matrices()->dict:
+    """
+    Rotating a transform by the word w (ActionOctahedralRotationGroupOnLebedevGridFunctions) gives
+    sigma(t, w)[q] = t[M_w q] in cartesian coordinates. If volume_2 = M_w volume_1, sigma(t_2, w) = t_1.
+    """
+    if len(_rotation_matrices) == 0:
+        grid = LebedevGrid26()
+        sigma = ActionOctahedralRotationGroupOnLebedevGridFunctions(LebedevGrid26,
+                                                                    OctahedralMatrixRotationGroup2Generators)
+        points = list(grid.points)
+        cartesian = numpy.array([grid.to_cartesian(p) for p in points], dtype=numpy.float64)
+
+        for word in OctahedralMatrixRotationGroup2Generators():
+            image = sigma({p: p for p in points}, word)
+            rotated = numpy.array([grid.to_cartesian(image[p]) for p in points], dtype=numpy.float64)
+
+            # rotated = cartesian M_w^T
+            solution = numpy.linalg.lstsq(cartesian, rotated, rcond=None)[0]
+            _rotation_matrices[word] = numpy.rint(solution.T)
+
+    return _rotation_matrices
+
+
+def _unambiguous(principal_axes, tolerance: float)->bool:
+    eigenvalues = numpy.asarray(principal_axes.eigenvalues, dtype=numpy.float64)
+    if eigenvalues[0] <= 0:
+        return False
+
+    return bool(numpy.all(-numpy.diff(eigenvalues) / eigenvalues[0] >= tolerance))
+
+
+def _axis_agreement(principal_axes_1, principal_axes_2)->dict:
+    """
+    agreement[w] = mean over the principal axes i of |<M_w e_1i, e_2i>|, 1 if M_w maps the axes of volume_1
+    onto the axes of volume_2 (up to their sign).
+    """
+    axes_1 = numpy.asarray(principal_axes_1.axes, dtype=numpy.float64)
+    axes_2 = numpy.asarray(principal_axes_2.axes, dtype=numpy.float64)
+
+    return {word: float(numpy.abs(numpy.sum((axes_1 @ matrix.T) * axes_2, axis=1)).mean())
+            for word, matrix in _octahedral_rotation_matrices().items()}
+
+
+# endregion
+
+
 class DistanceNPHT3D_Lebedev26:
     def __init__(self,
                  wasserstein_degree: int=2,
                  wasserstein_internal_norm=2,
                  included_dimensions: tuple=(0, 1, 2),
-                 minimize_over_rotations=True):
+                 minimize_over_rotations=True,
+                 metric='wasserstein',
+                 number_of_slices=50,
+                 relative_error=0.01,
+                 coarse_relative_error=None,
+                 pre_alignment_top_k=None,
+                 pre_alignment_tolerance=0.1):
         """
         Parameters
         ----------
@@ -113,11 +282,82 @@ class DistanceNPHT3D_Lebedev26:
             (0, 2)   -> dimension 0, 2
         minimize_over_rotations:
             bool. If false the min over the rotation group is not searched.
+
+        metric:
+            str. Distance of the persistence diagrams of one direction.
+            'wasserstein' -> Wasserstein distance calculated by hera.
+            'sliced_wasserstein' -> sliced Wasserstein distance (in-process), wasserstein_* parameters are ignored.
+            'bottleneck' -> bottleneck distance (in-process), wasserstein_* parameters are ignored.
+
+        number_of_slices:
+            int. Number of slices of the sliced Wasserstein distance.
+
+        relative_error:
+            float. Relative error of the Wasserstein distances calculated by hera.
+
+        coarse_relative_error:
+            float. If given (and metric is 'wasserstein'), the minimum over the rotations is searched in two
+            phases: all rotations are scored with coarse_relative_error, and only those which can still attain the
+            minimum are recalculated with relative_error. The result is the same as without this phase.
+
+        pre_alignment_top_k:
+            int. If given and both transforms carry principal axes (calculate_discrete_NPHT_3d_Lebedev26 with
+            with_principal_axes=True), the rotations are ranked by how well they map the principal axes of the
+            first volume onto those of the second and the minimum is only searched over the pre_alignment_top_k
+            best ones. 4 covers the sign ambiguity of the axes. This is a heuristic, the result is an upper bound
+            of the minimum over all rotations.
+
+        pre_alignment_tolerance:
+            float. All rotations are searched if the axes of a volume are ambiguous, i.e., the gap between two
+            consecutive eigenvalues is less than pre_alignment_tolerance times the largest one, or if the best
+            rotation does not align the axes up to a mean |cos| of 1 - pre_alignment_tolerance.
         """
+        _check_metric(metric)
+
+        if pre_alignment_top_k is not None and not 1 <= pre_alignment_top_k <= 24:
+            raise ValueError('Value range of parameter pre_alignment_top_k is [1, 24] given was {}'.format(
+                pre_alignment_top_k))
+
         self.p = wasserstein_degree
         self.q = wasserstein_internal_norm
         self.included_dimensions = tuple(included_dimensions)
         self.minimize_over_rotations = bool(minimize_over_rotations)
+        self.metric = metric
+        self.number_of_slices = int(number_of_slices)
+        self.relative_error = float(relative_error)
+        self.coarse_relative_error = None if coarse_relative_error is None else float(coarse_relative_error)
+        self.pre_alignment_top_k = None if pre_alignment_top_k is None else int(pre_alignment_top_k)
+        self.pre_alignment_tolerance = float(pre_alignment_tolerance)
+
+    def _two_phase(self)->bool:
+        return self.metric == 'wasserstein' and self.coarse_relative_error is not None
+
+    def _rotation_candidates(self, t_1, t_2)->list:
+        """
+        The words of the rotations over which the minimum is searched, see pre_alignment_top_k.
+        """
+        words = list(OctahedralMatrixRotationGroup2Generators())
+        if self.pre_alignment_top_k is None:
+            return words
+
+        axes_1 = getattr(t_1, 'principal_axes', None)
+        axes_2 = getattr(t_2, 'principal_axes', None)
+
+        if axes_1 is None or axes_2 is None or \
+                not _unambiguous(axes_1, self.pre_alignment_tolerance) or \
+                not _unambiguous(axes_2, self.pre_alignment_tolerance):
+            instrumentation.count('npht_distance', 'pre_alignment_fallback')
+            return words
+
+        agreement = _axis_agreement(axes_1, axes_2)
+        ranked = sorted(words, key=lambda word: -agreement[word])
+
+        if agreement[ranked[0]] < 1 - self.pre_alignment_tolerance:
+            instrumentation.count('npht_distance', 'pre_alignment_fallback')
+            return words
+
+        instrumentation.count('npht_distance', 'pre_alignment_used')
+        return ranked[:self.pre_alignment_top_k]
 
     def __call__(self, t_1: [[[]]], t_2: [[[]]]):
         """
@@ -142,35 +382,50 @@ class DistanceNPHT3D_Lebedev26:
         else:
             return self._calculate_distance(t_1, t_2)
 
-    def _calculate_distance(self, t_1, t_2):
-        function = {}
+    def _function(self, t_1, t_2, relative_error)->dict:
+        """
+        function[lebedev_point] = sum over the included dimensions of the distances in direction lebedev_point.
+        """
+        lebedev_points = list(t_1.keys())
+        dimensions = [dim for dim in range(3) if dim in self.included_dimensions]
+
+        pairs = [(t_1[lebedev_point][dim], t_2[lebedev_point][dim])
+                 for lebedev_point in lebedev_points for dim in dimensions]
+        distances = _diagram_distances(pairs, self.metric, self.p, self.q, self.number_of_slices, relative_error)
 
-        for lebedev_point in t_1.keys():
-            diagrams_t_1 = t_1[lebedev_point]
-            diagrams_t_2 = t_2[lebedev_point]
+        function = {}
+        for i, lebedev_point in enumerate(lebedev_points):
+            function[lebedev_point] = sum(distances[i * len(dimensions):(i + 1) * len(dimensions)])
 
-            value = sum([
-                            wasserstein_distance(diagrams_t_1[dim], diagrams_t_2[dim],
-                                                 degree=self.p, internal_norm=self.q)
-                            for dim in range(3) if dim in self.included_dimensions
-                            ])
+        return function
 
-            function[lebedev_point] = value
+    def _calculate_distance(self, t_1, t_2, relative_error=None):
+        if relative_error is None:
+            relative_error = self.relative_error
 
-        return lebedev_26_integration(function)
+        return lebedev_26_integration(self._function(t_1, t_2, relative_error))
 
     def _calculate_rotation_optimized_distance(self, t_1, t_2):
 
-        distances = []
-        O = OctahedralMatrixRotationGroup2Generators()
         sigma = ActionOctahedralRotationGroupOnLebedevGridFunctions(LebedevGrid26,
                                                                     OctahedralMatrixRotationGroup2Generators)
 
-        for element in O:
-            t_2_rotated = sigma(t_2, element)
-            distances.append(self._calculate_distance(t_1, t_2_rotated))
+        rotated = [sigma(t_2, element) for element in self._rotation_candidates(t_1, t_2)]
+
+        if not self._two_phase():
+            return min(self._calculate_distance(t_1, t_2_rotated) for t_2_rotated in rotated)
+
+        lebedev_points = list(t_1.keys())
+        coarse_ordinates = []
+        for t_2_rotated in rotated:
+            function = self._function(t_1, t_2_rotated, self.coarse_relative_error)
+            coarse_ordinates.append([function[lebedev_point] for lebedev_point in lebedev_points])
 
-        return min(distances)
+        weights = numpy.array([lebedev_26_integration({q: float(q == lebedev_point) for q in lebedev_points})
+                               for lebedev_point in lebedev_points])
+
+        return _coarse_to_fine_minimum(coarse_ordinates, weights, self.coarse_relative_error, self.relative_error,
+                                       lambda r: self._calculate_distance(t_1, rotated[r]))
 
     @staticmethod
     def _check_parameters(t_1, t_2):
@@ -186,7 +441,11 @@ def distance_npht2D(npht_1: [[[]]],
                     wasserstein_degree=2,
                     wasserstein_internal_norm=2,
                     included_dimensions=(0, 1),
-                    minimize_over_rotations=True)->float:
+                    minimize_over_rotations=True,
+                    metric='wasserstein',
+                    number_of_slices=50,
+                    relative_error=0.01,
+                    coarse_relative_error=None)->float:
     """
     Calculate the approximated npht distance between npht_1 and npht_2.
 
@@ -210,13 +469,32 @@ def distance_npht2D(npht_1: [[[]]],
 
     minimize_over_rotations : bool. If false the min over the rotation group is not searched.
 
+    metric : str. Distance of the persistence diagrams of one direction.
+            'wasserstein' -> Wasserstein distance calculated by hera.
+            'sliced_wasserstein' -> sliced Wasserstein distance (in-process), wasserstein_* parameters are ignored.
+            It is metrically equivalent to, but on a different scale than the 1-Wasserstein distance. Run
+            benchmarks/run_benchmarks.py --cases metric_error to measure the deviation on test shapes.
+            'bottleneck' -> bottleneck distance (in-process), wasserstein_* parameters are ignored.
+
+    number_of_slices : int. Number of slices of the sliced Wasserstein distance.
+
+    relative_error : float. Relative error of the Wasserstein distances calculated by hera.
+
+    coarse_relative_error : float. If given, rotations are first scored with this (looser) relative error and
+            only those which can still attain the minimum are recalculated with relative_error. Same result
+            as the exhaustive search, see _coarse_to_fine_minimum.
+
     Returns
     -------
     """
     f = Distance_NPHT_2d(wasserstein_degree=wasserstein_degree,
                          wasserstein_internal_norm=wasserstein_internal_norm,
                          included_dimensions=included_dimensions,
-                         minimize_over_rotations=minimize_over_rotations)
+                         minimize_over_rotations=minimize_over_rotations,
+                         metric=metric,
+                         number_of_slices=number_of_slices,
+                         relative_error=relative_error,
+                         coarse_relative_error=coarse_relative_error)
 
     return f(npht_1, npht_2)
 
@@ -226,7 +504,13 @@ def distance_npht3D_lebedev_26(npht_1: [[[]]],
                                wasserstein_degree: int=2,
                                wasserstein_internal_norm=2,
                                included_dimensions: tuple = (0, 1, 2),
-                               minimize_over_rotations=True)->float:
+                               minimize_over_rotations=True,
+                               metric='wasserstein',
+                               number_of_slices=50,
+                               relative_error=0.01,
+                               coarse_relative_error=None,
+                               pre_alignment_top_k=None,
+                               pre_alignment_tolerance=0.1)->float:
     """
     Calculate the approximated npht distance between npht_1 and npht_2.
 
@@ -250,13 +534,39 @@ def distance_npht3D_lebedev_26(npht_1: [[[]]],
 
     minimize_over_rotations : bool. If false the min over the rotation group is not searched.
 
+    metric : str. Distance of the persistence diagrams of one direction.
+            'wasserstein' -> Wasserstein distance calculated by hera.
+            'sliced_wasserstein' -> sliced Wasserstein distance (in-process), wasserstein_* parameters are ignored.
+            It is metrically equivalent to, but on a different scale than the 1-Wasserstein distance. Run
+            benchmarks/run_benchmarks.py --cases metric_error to measure the deviation on test shapes.
+            'bottleneck' -> bottleneck distance (in-process), wasserstein_* parameters are ignored.
+
+    number_of_slices : int. Number of slices of the sliced Wasserstein distance.
+
+    relative_error : float. Relative error of the Wasserstein distances calculated by hera.
+
+    coarse_relative_error : float. If given, rotations are first scored with this (looser) relative error and
+            only those which can still attain the minimum are recalculated with relative_error. Same result
+            as the exhaustive search, see _coarse_to_fine_minimum.
+
+    pre_alignment_top_k : int. If given, only the rotations which align the principal axes best are searched,
+            see DistanceNPHT3D_Lebedev26. The result is an upper bound of the minimum over all rotations.
+
+    pre_alignment_tolerance : float. See DistanceNPHT3D_Lebedev26.
+
     Returns
     -------
     """
     f = DistanceNPHT3D_Lebedev26(wasserstein_degree=wasserstein_degree,
                                  wasserstein_internal_norm=wasserstein_internal_norm,
                                  included_dimensions=included_dimensions,
-                                 minimize_over_rotations=minimize_over_rotations)
+                                 minimize_over_rotations=minimize_over_rotations,
+                                 metric=metric,
+                                 number_of_slices=number_of_slices,
+                                 relative_error=relative_error,
+                                 coarse_relative_error=coarse_relative_error,
+                                 pre_alignment_top_k=pre_alignment_top_k,
+                                 pre_alignment_tolerance=pre_alignment_tolerance)
 
     return f(npht_1, npht_2)
 
@@ -0,0 +1,296 @@
+"""
+Streaming, resumable computation of NPHTs over a directory of binary volumes stored as .npy files.
+
+Results are written to an output directory, one pickle per input (same relative path, suffix .pkl).
+After an output is written, its input is appended to the checkpoint manifest (manifest.jsonl in the output
+directory). A restarted run skips all inputs listed in the manifest whose size and modification time did not
+change.
+"""
+import os
+import json
+import pickle
+import numpy
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .pht import calculate_discrete_NPHT_2d, calculate_discrete_NPHT_3d_Lebedev26
+from ._software_backends import instrumentation
+from .cubical_backends import cubical_persistence_diagrams
+
+
+_manifest_file_name = 'manifest.jsonl'
+_output_suffix = '.pkl'
+
+_transforms = ('2d', 'lebedev26', 'cubical')
+
+
+# region helpers
+
+
+def iter_input_files(input_dir: str, suffix: str='.npy'):
+    """
+    Lazily walks input_dir (sorted within each directory) and yields the paths, relative to input_dir, of all
+    files ending with suffix.
+    """
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(suffix):
+                yield os.path.relpath(os.path.join(root, name), input_dir)
+
+
+def _fingerprint(path: str)->(int, int):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _read_manifest(output_dir: str)->dict:
+    """
+    manifest[input relative path] = entry of the last completed computation of this input.
+    """
+    manifest = {}
+    path = os.path.join(output_dir, _manifest_file_name)
+
+    if not os.path.isfile(path):
+        return manifest
+
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partially written last line of a run which died.
+                continue
+
+            manifest[entry['input']] = entry
+
+    return manifest
+
+
+def _truncate_partial_line(path: str):
+    """
+    Removes the partially written last line of a run which died. Appending to it would merge it with the next
+    entry, which _read_manifest then drops.
+    """
+    if not os.path.isfile(path):
+        return
+
+    with open(path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+
+        while position > 0:
+            start = max(position - 4096, 0)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+
+            position = start
+
+        if position < end:
+            f.truncate(position)
+
+
+def _write_atomically(path: str, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp{}'.format(os.getpid())
+
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, path)
+
+
+def _compute_and_store(input_path: str, output_path: str, transform: str, transform_kwargs: dict):
+    array = numpy.load(input_path)
+
+    if transform == '2d':
+        result = calculate_discrete_NPHT_2d(array, **transform_kwargs)
+    elif transform == 'lebedev26':
+        result = calculate_discrete_NPHT_3d_Lebedev26(array, **transform_kwargs)
+    else:
+        result = cubical_persistence_diagrams(array, **transform_kwargs)
+
+    _write_atomically(output_path, result)
+
+
+def _recorded(fn, *args)->dict:
+    """
+    Runs fn(*args) in a worker process with recording enabled and returns the recorded statistics,
+    which the calling process merges into its own, see instrumentation.merge.
+    """
+    with instrumentation.recording():
+        fn(*args)
+        return instrumentation.snapshot()
+
+
+class _SequentialExecutor:
+    """
+    Stand in for ProcessPoolExecutor with workers=0, runs each task on submit.
+    """
+    class _Done:
+        def __init__(self, fn, args):
+            self._exception = None
+            try:
+                self._result = fn(*args)
+            except Exception as ex:
+                self._exception = ex
+
+        def result(self):
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+    def submit(self, fn, *args):
+        return self._Done(fn, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+# endregion
+
+
+# region public functional interface
+
+
+def npht_directory(input_dir: str,
+                   output_dir: str,
+                   transform: str='2d',
+                   workers: int=None,
+                   max_pending: int=None,
+                   suffix: str='.npy',
+                   progress_callback=None,
+                   **transform_kwargs)->dict:
+    """
+    Calculates the npht of every binary volume in input_dir and stores it in output_dir.
+
+    Parameters
+    ----------
+    input_dir: str. Walked recursively, every file ending with suffix is expected to be a numpy array.
+
+    output_dir: str. input_dir/a/b.npy is stored as output_dir/a/b.npy.pkl.
+
+    transform: str. '2d' -> calculate_discrete_NPHT_2d, 'lebedev26' -> calculate_discrete_NPHT_3d_Lebedev26,
+        'cubical' -> cubical_backends.cubical_persistence_diagrams (input is a filtrated cubical complex).
+
+    workers: int. Number of worker processes, defaults to os.cpu_count(). 0 computes in the calling process.
+
+    max_pending: int. Maximal number of submitted but not finished inputs, defaults to 2 * workers. Bounds
+        the memory used for queued tasks, the input directory is only walked as far as needed.
+
+    progress_callback: Called with (input relative path, status) for each input, where status is one of
+        'computed', 'skipped', 'failed'.
+
+    transform_kwargs: Passed to the transform, e.g., number_of_directions=32 for '2d'.
+
+    If instrumentation recording is enabled in the calling process, the stages recorded by the workers are
+    merged into its statistics.
+
+    Returns
+    -------
+        dict. {'computed': int, 'skipped': int, 'failed': [(input relative path, error message)]}.
+        Failed inputs are not added to the manifest and are retried by the next run.
+    """
+    if transform not in _transforms:
+        raise ValueError("transform is expected to be one of {} given was {}".format(_transforms, transform))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if max_pending is None:
+        max_pending = 2 * max(workers, 1)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _read_manifest(output_dir)
+    summary = {'computed': 0, 'skipped': 0, 'failed': []}
+
+    def notify(relative_path, status):
+        if progress_callback is not None:
+            progress_callback(relative_path, status)
+
+    executor = ProcessPoolExecutor(workers) if workers > 0 else _SequentialExecutor()
+    record_workers = workers > 0 and instrumentation.is_enabled()
+
+    manifest_path = os.path.join(output_dir, _manifest_file_name)
+    _truncate_partial_line(manifest_path)
+
+    with executor, open(manifest_path, 'a') as manifest_file:
+        pending = {}
+
+        def collect(futures):
+            for future in futures:
+                relative_path, fingerprint = pending.pop(future)
+                try:
+                    worker_stats = future.result()
+                    if record_workers:
+                        instrumentation.merge(worker_stats)
+
+                except Exception as ex:
+                    summary['failed'].append((relative_path, repr(ex)))
+                    notify(relative_path, 'failed')
+
+                else:
+                    entry = {'input': relative_path,
+                             'size': fingerprint[0],
+                             'mtime_ns': fingerprint[1],
+                             'output': relative_path + _output_suffix}
+                    manifest_file.write(json.dumps(entry) + '\n')
+                    manifest_file.flush()
+
+                    summary['computed'] += 1
+                    notify(relative_path, 'computed')
+
+        for relative_path in iter_input_files(input_dir, suffix):
+            input_path = os.path.join(input_dir, relative_path)
+            output_path = os.path.join(output_dir, relative_path + _output_suffix)
+            fingerprint = _fingerprint(input_path)
+
+            entry = manifest.get(relative_path)
+            if entry is not None and (entry['size'], entry['mtime_ns']) == fingerprint \
+                    and os.path.isfile(output_path):
+                summary['skipped'] += 1
+                notify(relative_path, 'skipped')
+                continue
+
+            if len(pending) >= max_pending and workers > 0:
+                done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                collect(done)
+
+            if record_workers:
+                future = executor.submit(_recorded, _compute_and_store,
+                                         input_path, output_path, transform, transform_kwargs)
+            else:
+                future = executor.submit(_compute_and_store, input_path, output_path, transform, transform_kwargs)
+            pending[future] = (relative_path, fingerprint)
+
+            if workers == 0:
+                collect([future])
+
+        collect(list(pending.keys()))
+
+    return summary
+
+
+def iter_npht_store(output_dir: str):
+    """
+    Yields (input relative path, npht) for every completed input of output_dir, in the order of completion.
+    """
+    for relative_path, entry in _read_manifest(output_dir).items():
+        with open(os.path.join(output_dir, entry['output']), 'rb') as f:
+            yield relative_path, pickle.load(f)
+
+
+def npht_store_files(output_dir: str)->[str]:
+    """
+    Paths of the stored transforms of all completed inputs of output_dir, in the order of completion.
+    Can be passed to DistanceMatrixJob.create/append.
+    """
+    return [os.path.join(output_dir, entry['output']) for entry in _read_manifest(output_dir).values()]
+
+
+# endregion
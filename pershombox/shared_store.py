@@ -0,0 +1,288 @@
+"""
+Collections of transforms in shared memory (multiprocessing.shared_memory), read by worker processes without
+pickling or copying.
+
+Layout of the shared memory block:
+
+    [0, 8)              length h of the header (little endian uint64)
+    [8, 8 + h)          json header: number of transforms, directions and dimensions, the lebedev points
+                        (for dict transforms), the principal axes (if the transforms carry them) and the byte
+                        offsets of the following arrays
+    offsets             int64, number_of_transforms * number_of_directions * number_of_dimensions + 1 entries.
+                        Diagram (t, i, j) are the rows offsets[n]:offsets[n + 1] of points,
+                        n = (t * number_of_directions + i) * number_of_dimensions + j
+    points              float64, number_of_points x 2
+
+Example:
+
+    with SharedDiagramStore.create(transforms) as store:        # parent, owns the block
+        with ProcessPoolExecutor(initializer=creator_worker_initializer) as executor:
+            ... executor.submit(worker, store.name, i, j) ...
+
+    def worker(name, i, j):
+        store = SharedDiagramStore.attach(name)                  # cached per process
+        return distance_npht3D_lebedev_26(store[i], store[j])
+
+store[i] is a transform of read only numpy views into the block, accepted by distance_npht2D,
+distance_npht3D_lebedev_26 and the diagram metrics as is.
+"""
+import os
+import json
+import atexit
+import numpy
+from multiprocessing import shared_memory, resource_tracker
+
+from .vectorization import _directions_of, _lebedev_26_points
+from .pht import PrincipalAxes, TransformWithPrincipalAxes
+
+
+_header_size_bytes = 8
+_alignment = 64
+
+# name -> SharedDiagramStore, stores attached by this process
+_attached = {}
+
+# True in the worker processes started by the creator of the stores, see creator_worker_initializer
+_shares_creator_tracker = False
+
+
+def _aligned(offset: int)->int:
+    return -(-offset // _alignment) * _alignment
+
+
+def creator_worker_initializer():
+    """
+    Initializer (e.g. of ProcessPoolExecutor) of worker processes started by the process which creates the
+    stores. Workers of multiprocessing share the resource tracker of their parent, see _attach_shared_memory.
+    """
+    global _shares_creator_tracker
+    _shares_creator_tracker = True
+
+
+class _SharedMemory(shared_memory.SharedMemory):
+    def __del__(self):
+        try:
+            super().__del__()
+        except BufferError:
+            # views are still referenced, they keep the mapping alive
+            pass
+
+
+def _attach_shared_memory(name: str, shares_creator_tracker: bool)->shared_memory.SharedMemory:
+    try:
+        return _SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # Python < 3.13 registers attached blocks with the resource tracker, which unlinks them when it shuts down.
+    # In a worker of the creator the tracker is the creator's one (registering again is a no-op) and the
+    # registration must be kept for the creator's unlink. Any other process starts its own tracker, which
+    # must not unlink the block of the creator.
+    shm = _SharedMemory(name=name)
+    if not shares_creator_tracker and os.name == 'posix':
+        # the tracker knows the block by its POSIX name, i.e. with the leading slash which shm.name omits
+        resource_tracker.unregister('/' + shm.name, 'shared_memory')
+
+    return shm
+
+
+@atexit.register
+def _detach_all():
+    for store in list(_attached.values()):
+        store.close()
+
+
+class SharedDiagramStore:
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        """
+        Use SharedDiagramStore.create or SharedDiagramStore.attach.
+        """
+        self._shm = shm
+        self._owner = owner
+
+        header_size = int(numpy.frombuffer(shm.buf, dtype='<u8', count=1)[0])
+        header = json.loads(bytes(shm.buf[_header_size_bytes:_header_size_bytes + header_size]).decode('utf-8'))
+
+        self.number_of_transforms = header['number_of_transforms']
+        self.number_of_directions = header['number_of_directions']
+        self.number_of_dimensions = header['number_of_dimensions']
+        self.lebedev_points = None if header['lebedev_points'] is None else \
+            [tuple(p) for p in header['lebedev_points']]
+        self._principal_axes = [None if a is None else PrincipalAxes(numpy.array(a[0]), numpy.array(a[1]))
+                                for a in header.get('principal_axes') or []]
+
+        number_of_diagrams = self.number_of_transforms * self.number_of_directions * self.number_of_dimensions
+        self._offsets = numpy.frombuffer(shm.buf, dtype=numpy.int64, count=number_of_diagrams + 1,
+                                         offset=header['offsets'])
+        self._points = numpy.frombuffer(shm.buf, dtype=numpy.float64, count=2 * header['number_of_points'],
+                                        offset=header['points']).reshape(-1, 2)
+        self._points.flags.writeable = False
+
+    @classmethod
+    def create(cls, transforms: list, name: str=None):
+        """
+        Packs transforms into a new shared memory block.
+
+        Parameters
+        ----------
+        transforms: list. Outputs of calculate_discrete_NPHT_2d (all with the same number of directions) or of
+            calculate_discrete_NPHT_3d_Lebedev26. Diagrams may be lists or numpy arrays, e.g., compacted ones.
+            Principal axes (TransformWithPrincipalAxes) are kept.
+
+        name: str. Name of the block, a unique one is generated if None.
+
+        Returns
+        -------
+            SharedDiagramStore. Owns the block, i.e., close unlinks it.
+        """
+        transforms = list(transforms)
+        lebedev_points = None
+        if len(transforms) > 0 and isinstance(transforms[0], dict):
+            lebedev_points = list(_lebedev_26_points)
+
+        directions = [_directions_of(t) for t in transforms]
+        number_of_directions = len(directions[0]) if len(directions) > 0 else 0
+        if any(len(d) != number_of_directions for d in directions):
+            raise ValueError('All transforms are expected to have the same number of directions.')
+
+        number_of_dimensions = max((len(dgms) for d in directions for dgms in d), default=0)
+
+        diagrams = []
+        for d in directions:
+            for dgms in d:
+                for dim in range(number_of_dimensions):
+                    dgm = dgms[dim] if dim < len(dgms) else []
+                    diagrams.append(numpy.asarray(dgm, dtype=numpy.float64).reshape(-1, 2))
+
+        offsets = numpy.zeros(len(diagrams) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(dgm) for dgm in diagrams], out=offsets[1:])
+        number_of_points = int(offsets[-1])
+
+        principal_axes = [getattr(t, 'principal_axes', None) for t in transforms]
+        if all(a is None for a in principal_axes):
+            principal_axes = None
+        else:
+            principal_axes = [None if a is None else
+                              [numpy.asarray(a.eigenvalues).tolist(), numpy.asarray(a.axes).tolist()]
+                              for a in principal_axes]
+
+        header = {'number_of_transforms': len(transforms),
+                  'number_of_directions': number_of_directions,
+                  'number_of_dimensions': number_of_dimensions,
+                  'lebedev_points': lebedev_points,
+                  'principal_axes': principal_axes,
+                  'number_of_points': number_of_points}
+
+        # The offsets of the arrays are part of the header, reserve room for them before encoding.
+        header_bytes = json.dumps(dict(header, offsets=2 ** 62, points=2 ** 62)).encode('utf-8')
+        header['offsets'] = _aligned(_header_size_bytes + len(header_bytes))
+        header['points'] = _aligned(header['offsets'] + offsets.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        size = max(header['points'] + 16 * number_of_points, 1)
+        shm = _SharedMemory(name=name, create=True, size=size)
+
+        try:
+            numpy.frombuffer(shm.buf, dtype='<u8', count=1)[0] = len(header_bytes)
+            shm.buf[_header_size_bytes:_header_size_bytes + len(header_bytes)] = header_bytes
+            numpy.frombuffer(shm.buf, dtype=numpy.int64, count=len(offsets), offset=header['offsets'])[:] = offsets
+
+            points = numpy.frombuffer(shm.buf, dtype=numpy.float64, count=2 * number_of_points,
+                                      offset=header['points']).reshape(-1, 2)
+            for dgm, start in zip(diagrams, offsets[:-1]):
+                points[start:start + len(dgm)] = dgm
+            del points
+
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str, shares_creator_tracker: bool=None):
+        """
+        Attaches to the block name, created by another process. Stores are cached per process, attaching twice
+        returns the same store.
+
+        shares_creator_tracker: bool. True if this process is a multiprocessing worker started by the creator.
+            Defaults to True in processes initialized by creator_worker_initializer, False otherwise.
+        """
+        if shares_creator_tracker is None:
+            shares_creator_tracker = _shares_creator_tracker
+
+        if name not in _attached:
+            _attached[name] = cls(_attach_shared_memory(name, shares_creator_tracker), owner=False)
+
+        return _attached[name]
+
+    @property
+    def name(self)->str:
+        return self._shm.name
+
+    def __len__(self):
+        return self.number_of_transforms
+
+    def diagram(self, t: int, i: int, j: int)->numpy.ndarray:
+        """
+        Persistence diagram of dimension j in direction i of transform t, a read only view into the block.
+        """
+        n = (t * self.number_of_directions + i) * self.number_of_dimensions + j
+        return self._points[self._offsets[n]:self._offsets[n + 1]]
+
+    def __getitem__(self, t: int):
+        """
+        Transform t, with the structure of the packed transform (list of directions or dict over the lebedev
+        points), made of views.
+        """
+        t = int(t)
+        if t < 0:
+            t += self.number_of_transforms
+
+        if not 0 <= t < self.number_of_transforms:
+            raise IndexError('transform index out of range')
+
+        directions = [[self.diagram(t, i, j) for j in range(self.number_of_dimensions)]
+                      for i in range(self.number_of_directions)]
+
+        if self.lebedev_points is not None:
+            transform = dict(zip(self.lebedev_points, directions))
+
+            if len(self._principal_axes) > 0 and self._principal_axes[t] is not None:
+                return TransformWithPrincipalAxes(transform, self._principal_axes[t])
+
+            return transform
+
+        return directions
+
+    def close(self):
+        """
+        Detaches this process. The owner (the creating store) also unlinks the block. Views obtained from the
+        store stay valid as long as they are referenced.
+        """
+        if self._shm is None:
+            return
+
+        # The views into the buffer have to be released first.
+        self._offsets = None
+        self._points = None
+
+        shm, self._shm = self._shm, None
+        _attached.pop(shm.name, None)
+
+        try:
+            if self._owner:
+                shm.unlink()
+        finally:
+            try:
+                shm.close()
+            except BufferError:
+                # views are still referenced, the mapping is released with the last of them
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
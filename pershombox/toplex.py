@@ -1,3 +1,10 @@
+import os
+import numpy
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory, mkdtemp
+
 from ._software_backends.perseus_adapter import _call_perseus
 
 
@@ -57,10 +64,10 @@ class Toplex:
         # return points + essential_points
         return points
 
-    def calculate_persistence_diagrams(self):
+    def calculate_persistence_diagrams(self, scratch_dir: str=None):
 
         complex_string = self._get_complex_string()
-        dgms = _call_perseus('nmfsimtop', complex_string)
+        dgms = _call_perseus('nmfsimtop', complex_string, scratch_dir=scratch_dir)
 
         return_value = []
 
@@ -97,5 +104,110 @@ def toplex_persistence_diagrams(toplices: [tuple], filtration_values: [], deesse
     return toplex.calculate_persistence_diagrams()
 
 
+def toplex_persistence_diagrams_batch(complexes, workers: int=None, deessentialize=False,
+                                      max_pending: int=None, scratch_dir: str=None):
+    """
+    Calculates the persistence diagrams of many toplices concurrently, see toplex_persistence_diagrams.
+
+    Perseus is run by a pool of worker threads, each with its own scratch directory. Results are yielded in
+    input order as soon as they are available. Empty complexes yield [] without running Perseus.
+
+    :param complexes: iterable of (toplices, filtration_values), both of them iterables. Consumed lazily.
+
+    :param workers: number of concurrent Perseus processes, defaults to os.cpu_count().
+
+    :param deessentialize: see toplex_persistence_diagrams.
+
+    :param max_pending: maximal number of submitted but not yielded complexes, defaults to 4 * workers.
+
+    :param scratch_dir: directory in which the scratch directories of the workers are created,
+        defaults to the system's temporary directory.
+
+    :return: generator of [[[]]], one item per complex.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers < 1:
+        raise ValueError('Value range of parameter workers is [1, inf) given was {}'.format(workers))
+
+    if max_pending is None:
+        max_pending = 4 * workers
+
+    def calculate(item, worker_scratch_dir):
+        toplex = Toplex(*item, deessentialize=deessentialize)
+        return toplex.calculate_persistence_diagrams(scratch_dir=worker_scratch_dir)
+
+    def iter_items():
+        for toplices, filtration_values in complexes:
+            # toplices and filtration_values may be any iterables, e.g., generators
+            toplices, filtration_values = list(toplices), list(filtration_values)
+            yield None if len(toplices) == 0 else (toplices, filtration_values)
+
+    for result in _map_in_order(calculate, iter_items(), workers, max_pending, scratch_dir):
+        yield [] if result is None else result
+
+
+def _map_in_order(fn, items, workers: int, max_pending: int, scratch_dir: str=None):
+    """
+    Yields fn(item, worker_scratch_dir) for each item of items in input order. The calls run on a pool of
+    worker threads, each with its own scratch directory. Items which are None yield None without a call.
+    """
+    with TemporaryDirectory(dir=scratch_dir) as batch_dir:
+        local = threading.local()
+
+        def call(item):
+            if not hasattr(local, 'scratch_dir'):
+                local.scratch_dir = mkdtemp(dir=batch_dir)
+
+            return fn(item, local.scratch_dir)
+
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque()
+
+            for item in items:
+                pending.append(None if item is None else executor.submit(call, item))
+
+                while len(pending) > max_pending or (len(pending) > 0 and pending[0] is None):
+                    future = pending.popleft()
+                    yield None if future is None else future.result()
+
+            while len(pending) > 0:
+                future = pending.popleft()
+                yield None if future is None else future.result()
+
+
+class _ToplexStructure:
+    """
+    Fixed simplices with changing filtrations, e.g., the lower-star filtrations of a mesh w.r.t. many directions.
+    The simplex part of the Perseus input is only built once.
+    """
+    def __init__(self, simplices: [tuple]):
+        self._prefixes = ['{} {}'.format(len(s) - 1, ' '.join(str(v) for v in s)) for s in simplices]
+        self.homology_dimension_upper_bound = max(len(s) for s in simplices)
+
+    def calculate_persistence_diagrams(self, filtration_values: numpy.ndarray, deessentialize=False,
+                                       scratch_dir: str=None)->[[[]]]:
+        # Perseus expects integer birth times, the filtration values are replaced by their ranks 1, 2, ...
+        values, ranks = numpy.unique(filtration_values, return_inverse=True)
+
+        complex_string = '1\n' + '\n'.join(prefix + ' ' + str(r + 1) for prefix, r in zip(self._prefixes,
+                                                                                         ranks.tolist()))
+        dgms = _call_perseus('nmfsimtop', complex_string, scratch_dir=scratch_dir)
+
+        # rank -> value, rank -1 (Perseus' death time of essential classes) -> last entry
+        lookup = numpy.concatenate([values, [values[-1] if deessentialize else float('inf')]])
+
+        return_value = []
+        for dim in range(self.homology_dimension_upper_bound):
+            points = numpy.asarray(dgms.get(dim, []), dtype=numpy.float64).reshape(-1, 2)
+            indices = numpy.rint(points).astype(numpy.int64) - 1
+            indices[indices < 0] = len(values)
+
+            return_value.append(lookup[indices].tolist())
+
+        return return_value
+
+
 class ToplexException(Exception):
     pass
\ No newline at end of file
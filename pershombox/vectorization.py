@@ -0,0 +1,481 @@
+"""
+Fixed-size vectorizations of whole NPHTs, e.g., as input features for learning methods.
+
+All functions accept a single npht (as returned by calculate_discrete_NPHT_2d or
+calculate_discrete_NPHT_3d_Lebedev26) or a batch (list) of nphts with equal number of directions, and
+return one dense array
+
+    result[shape, direction, dimension, feature]
+
+(with a leading shape axis of length 1 for a single npht). Directions of 3D nphts are ordered as
+LebedevGrid26 iterates them. All points of the batch are processed at once, chunk_size bounds the number of
+points (persistence images) or diagram entries (landscapes) held in memory at the same time.
+
+export_padded_diagrams keeps the points instead: the diagrams are written once, padded to a fixed number of
+points, to .npy files which are read back as memory maps, e.g., by the data loader of a model training on the
+diagrams as in [2] of the README.
+"""
+import os
+import json
+import numpy
+from collections import namedtuple
+
+from .lebedev import LebedevGrid26, \
+    OctahedralMatrixRotationGroup2Generators, \
+    ActionOctahedralRotationGroupOnLebedevGridFunctions
+
+
+# region helpers
+
+
+_lebedev_26_points = list(LebedevGrid26())
+
+
+def _directions_of(npht)->list:
+    """
+    Diagrams of npht as list ordered by direction.
+    """
+    if isinstance(npht, dict):
+        if set(npht.keys()) == set(_lebedev_26_points):
+            return [npht[p] for p in _lebedev_26_points]
+
+        return list(npht.values())
+
+    return list(npht)
+
+
+def _cyclic_direction_permutations(number_of_directions: int, number_of_used_directions: int=None)->numpy.ndarray:
+    """
+    The cyclic shifts of the first number_of_used_directions (default: all) directions, the others stay in place.
+    permutations[r][i] is the direction which is compared to direction i under rotation r.
+    """
+    n = number_of_directions if number_of_used_directions is None else number_of_used_directions
+    directions = numpy.arange(number_of_directions)
+
+    return numpy.stack([numpy.concatenate([numpy.roll(directions[:n], -shift), directions[n:]])
+                        for shift in range(n)])
+
+
+def _octahedral_direction_permutations()->numpy.ndarray:
+    """
+    24 x 26 array, the octahedral rotations as permutations of the directions ordered as _lebedev_26_points,
+    consistent with ActionOctahedralRotationGroupOnLebedevGridFunctions.
+    """
+    position = {p: i for i, p in enumerate(_lebedev_26_points)}
+    sigma = ActionOctahedralRotationGroupOnLebedevGridFunctions(LebedevGrid26,
+                                                                OctahedralMatrixRotationGroup2Generators)
+    identity = {p: p for p in _lebedev_26_points}
+
+    permutations = []
+    for element in OctahedralMatrixRotationGroup2Generators():
+        rotated = sigma(identity, element)
+        permutations.append([position[rotated[p]] for p in _lebedev_26_points])
+
+    return numpy.array(permutations)
+
+
+def _is_single_npht(nphts)->bool:
+    if isinstance(nphts, dict):
+        return True
+
+    for x in nphts:
+        if isinstance(x, dict):
+            return False
+
+        for y in x:
+            for z in y:
+                # z is a point of a single 2D npht or a diagram of a batch of 2D nphts.
+                return len(z) > 0 and numpy.isscalar(z[0])
+
+    # No diagram with points found, a batch would at least contain lists of diagrams.
+    return True
+
+
+def _as_batch(nphts)->list:
+    if _is_single_npht(nphts):
+        return [nphts]
+
+    return list(nphts)
+
+
+def _flatten(batch: list, included_dimensions: tuple)->(numpy.ndarray, numpy.ndarray, tuple):
+    """
+    Concatenates the points of all selected diagrams of batch.
+
+    :return: (points, lengths, shape) where points is a P x 2 array ordered by diagram, lengths[s] the number of
+    points of diagram s and shape = (shapes, directions, dimensions). Diagram s corresponds to the
+    multi-index numpy.unravel_index(s, shape).
+    """
+    diagrams = []
+    number_of_directions = None
+
+    for npht in batch:
+        directions = _directions_of(npht)
+
+        if number_of_directions is None:
+            number_of_directions = len(directions)
+        elif number_of_directions != len(directions):
+            raise ValueError('All nphts are expected to have the same number of directions.')
+
+        for dgms in directions:
+            for dim in included_dimensions:
+                diagrams.append(numpy.asarray(dgms[dim], dtype=numpy.float64).reshape(-1, 2))
+
+    lengths = numpy.array([len(dgm) for dgm in diagrams], dtype=numpy.int64)
+    points = numpy.concatenate(diagrams) if len(diagrams) > 0 else numpy.empty((0, 2))
+
+    if not numpy.isfinite(points).all():
+        raise ValueError('Diagrams contain essential points. Use de_essentialize before vectorization.')
+
+    return points, lengths, (len(batch), number_of_directions or 0, len(included_dimensions))
+
+
+def _diagram_ranges(points: numpy.ndarray)->((float, float), (float, float), (float, float)):
+    """
+    (birth_range, persistence_range, filtration_range) covering points.
+    """
+    if len(points) == 0:
+        return (0.0, 1.0), (0.0, 1.0), (0.0, 1.0)
+
+    births, deaths = points[:, 0], points[:, 1]
+    persistence = deaths - births
+
+    def non_degenerate(lower, upper):
+        return float(lower), float(max(upper, lower + 1e-12))
+
+    return non_degenerate(births.min(), births.max()), \
+        non_degenerate(0.0, persistence.max()), \
+        non_degenerate(births.min(), deaths.max())
+
+
+def _segment_sums(values: numpy.ndarray, segment: numpy.ndarray, out: numpy.ndarray):
+    """
+    out[segment[i]] += values[i] for segment sorted ascending.
+    """
+    if len(segment) == 0:
+        return
+
+    starts = numpy.flatnonzero(numpy.r_[True, segment[1:] != segment[:-1]])
+    out[segment[starts]] += numpy.add.reduceat(values, starts, axis=0)
+
+
+# endregion
+
+
+# region public functional interface
+
+
+def persistence_images(nphts,
+                       included_dimensions: tuple=(0, 1),
+                       resolution: int=10,
+                       sigma: float=None,
+                       birth_range: tuple=None,
+                       persistence_range: tuple=None,
+                       weighted: bool=True,
+                       chunk_size: int=65536)->numpy.ndarray:
+    """
+    Persistence images of all diagrams of nphts.
+
+    Parameters
+    ----------
+    nphts: a npht or a list of nphts.
+
+    included_dimensions: tuple. Homology dimensions which are vectorized.
+
+    resolution: int. Each image has resolution x resolution pixels (birth x persistence).
+
+    sigma: float. Bandwidth of the gaussians. Defaults to a tenth of the larger of both ranges.
+
+    birth_range, persistence_range: (float, float). Support of the images. Fitted to the batch if None.
+        Fix them when vectorizing several batches which should be comparable.
+
+    weighted: bool. If True each gaussian is weighted by the persistence of its point.
+
+    chunk_size: int. Maximal number of points processed at once, i.e., memory is
+        O(chunk_size * resolution**2).
+
+    Returns
+    -------
+        numpy.ndarray. shapes x directions x len(included_dimensions) x resolution**2.
+    """
+    included_dimensions = tuple(included_dimensions)
+    resolution = int(resolution)
+    chunk_size = max(int(chunk_size), 1)
+
+    points, lengths, shape = _flatten(_as_batch(nphts), included_dimensions)
+
+    fitted_birth_range, fitted_persistence_range, _ = _diagram_ranges(points)
+    birth_range = fitted_birth_range if birth_range is None else birth_range
+    persistence_range = fitted_persistence_range if persistence_range is None else persistence_range
+
+    if sigma is None:
+        sigma = 0.1 * max(birth_range[1] - birth_range[0], persistence_range[1] - persistence_range[0])
+
+    grid_b = numpy.linspace(birth_range[0], birth_range[1], resolution)
+    grid_p = numpy.linspace(persistence_range[0], persistence_range[1], resolution)
+
+    segment = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    images = numpy.zeros((len(lengths), resolution * resolution))
+
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        births = chunk[:, 0]
+        persistence = chunk[:, 1] - chunk[:, 0]
+
+        # The gaussian is separable: points x resolution for each axis, then an outer product.
+        g_b = numpy.exp(-(births[:, None] - grid_b[None, :]) ** 2 / (2 * sigma ** 2))
+        g_p = numpy.exp(-(persistence[:, None] - grid_p[None, :]) ** 2 / (2 * sigma ** 2))
+
+        if weighted:
+            g_b *= persistence[:, None]
+
+        contribution = (g_b[:, :, None] * g_p[:, None, :]).reshape(len(chunk), -1)
+        _segment_sums(contribution, segment[start:start + chunk_size], images)
+
+    return images.reshape(*shape, resolution * resolution)
+
+
+def persistence_landscapes(nphts,
+                           included_dimensions: tuple=(0, 1),
+                           number_of_landscapes: int=5,
+                           resolution: int=100,
+                           filtration_range: tuple=None,
+                           chunk_size: int=1048576)->numpy.ndarray:
+    """
+    Persistence landscapes of all diagrams of nphts, sampled on an equidistant grid.
+
+    Parameters
+    ----------
+    nphts: a npht or a list of nphts.
+
+    included_dimensions: tuple. Homology dimensions which are vectorized.
+
+    number_of_landscapes: int. The first number_of_landscapes landscape functions are returned.
+
+    resolution: int. Number of samples of each landscape function.
+
+    filtration_range: (float, float). Sampling interval. Fitted to the batch if None.
+
+    chunk_size: int. Bounds the number of entries of the intermediate (diagrams x points x resolution) array.
+
+    Returns
+    -------
+        numpy.ndarray. shapes x directions x len(included_dimensions) x (number_of_landscapes * resolution).
+        Feature k * resolution + i is the k-th landscape function at the i-th sample.
+    """
+    included_dimensions = tuple(included_dimensions)
+    number_of_landscapes = int(number_of_landscapes)
+    resolution = int(resolution)
+
+    points, lengths, shape = _flatten(_as_batch(nphts), included_dimensions)
+
+    if filtration_range is None:
+        _, _, filtration_range = _diagram_ranges(points)
+
+    t = numpy.linspace(filtration_range[0], filtration_range[1], resolution)
+
+    number_of_diagrams = len(lengths)
+    landscapes = numpy.zeros((number_of_diagrams, number_of_landscapes, resolution))
+    offsets = numpy.r_[0, numpy.cumsum(lengths)]
+
+    max_length = int(lengths.max()) if number_of_diagrams > 0 else 0
+    if max_length == 0:
+        return landscapes.reshape(*shape, -1)
+
+    # Diagrams are padded to the longest one in the chunk, hence the chunks are built from the
+    # number of padded entries.
+    diagrams_per_chunk = max(1, int(chunk_size) // (max_length * resolution))
+
+    for first in range(0, number_of_diagrams, diagrams_per_chunk):
+        last = min(first + diagrams_per_chunk, number_of_diagrams)
+        chunk_lengths = lengths[first:last]
+        chunk_max_length = int(chunk_lengths.max())
+
+        if chunk_max_length == 0:
+            continue
+
+        chunk_points = points[offsets[first]:offsets[last]]
+        diagram = numpy.repeat(numpy.arange(last - first), chunk_lengths)
+        position = numpy.arange(len(chunk_points)) - numpy.repeat(offsets[first:last] - offsets[first], chunk_lengths)
+
+        # tents[d, j, i] = value of the tent function of point j of diagram d at t[i]
+        tents = numpy.zeros((last - first, chunk_max_length, resolution))
+        tents[diagram, position] = numpy.maximum(
+            0, numpy.minimum(t[None, :] - chunk_points[:, 0:1], chunk_points[:, 1:2] - t[None, :]))
+
+        k = min(number_of_landscapes, chunk_max_length)
+        top = -numpy.sort(-tents, axis=1)[:, :k]
+        landscapes[first:last, :k] = top
+
+    return landscapes.reshape(*shape, number_of_landscapes * resolution)
+
+
+# endregion
+
+
+# region padded tensors
+
+
+_padded_diagrams_file_name = 'diagrams.npy'
+_padded_lengths_file_name = 'lengths.npy'
+_padded_mask_file_name = 'mask.npy'
+_padded_meta_file_name = 'meta.json'
+
+
+class PaddedDiagrams(namedtuple('PaddedDiagrams', ['diagrams', 'lengths', 'mask', 'included_dimensions'])):
+    """
+    diagrams: shapes x directions x len(included_dimensions) x max_points x 2 float32 array, zero padded.
+    lengths: shapes x directions x len(included_dimensions) int32 array, number of points of each diagram.
+    mask: shapes x directions x len(included_dimensions) x max_points bool array, mask[..., k] = k < lengths.
+    included_dimensions: tuple, homology dimension of each entry of the third axis.
+    """
+    pass
+
+
+def _padding_caps(max_points, included_dimensions: tuple)->list:
+    """
+    Cap of each included dimension, None -> the longest diagram of this dimension.
+    """
+    if isinstance(max_points, dict):
+        caps = [max_points.get(dim) for dim in included_dimensions]
+    elif max_points is None or numpy.isscalar(max_points):
+        caps = [max_points] * len(included_dimensions)
+    else:
+        caps = list(max_points)
+        if len(caps) != len(included_dimensions):
+            raise ValueError('Expected one cap per included dimension, given were {}'.format(max_points))
+
+    for cap in caps:
+        if cap is not None and int(cap) < 0:
+            raise ValueError('Value range of parameter max_points is [0, inf) given was {}'.format(cap))
+
+    return [None if cap is None else int(cap) for cap in caps]
+
+
+def _most_persistent(points: numpy.ndarray, cap: int)->numpy.ndarray:
+    """
+    The cap points of largest persistence, in their order in points.
+    """
+    if len(points) <= cap:
+        return points
+
+    keep = numpy.argsort(points[:, 0] - points[:, 1], kind='stable')[:cap]
+    return points[numpy.sort(keep)]
+
+
+def export_padded_diagrams(nphts,
+                           path: str,
+                           included_dimensions: tuple=(0, 1),
+                           max_points=None)->PaddedDiagrams:
+    """
+    Writes the diagrams of nphts as one padded float32 tensor (plus lengths and mask) to the directory path.
+
+    The arrays are C-contiguous with the shapes as leading axis, hence a batch of consecutive shapes
+    result.diagrams[i:j] is a contiguous slice of the memory mapped file and is read without a copy.
+
+    Parameters
+    ----------
+    nphts: a npht or a list of nphts.
+
+    path: str. Output directory, created if it does not exist. Existing files of a previous export are
+        overwritten.
+
+    included_dimensions: tuple. Homology dimensions which are exported.
+
+    max_points: padding cap. int -> the same cap for all dimensions, a tuple with one cap per included dimension
+        or a dict dimension -> cap. A cap of None is the length of the longest diagram of this dimension.
+        Diagrams with more points keep their cap points of largest persistence. Fix the caps when exporting
+        several collections (e.g., training and test data) which should have the same shape.
+
+    Returns
+    -------
+        PaddedDiagrams. Opened read only from path, see load_padded_diagrams.
+    """
+    included_dimensions = tuple(included_dimensions)
+    batch = _as_batch(nphts)
+    directions = [_directions_of(npht) for npht in batch]
+
+    number_of_directions = len(directions[0]) if len(directions) > 0 else 0
+    if any(len(d) != number_of_directions for d in directions):
+        raise ValueError('All nphts are expected to have the same number of directions.')
+
+    caps = _padding_caps(max_points, included_dimensions)
+    for k, dim in enumerate(included_dimensions):
+        if caps[k] is None:
+            caps[k] = max((len(dgms[dim]) for d in directions for dgms in d), default=0)
+
+    shape = (len(batch), number_of_directions, len(included_dimensions))
+    max_length = max(caps, default=0)
+
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, _padded_meta_file_name)
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+
+    diagrams = numpy.lib.format.open_memmap(os.path.join(path, _padded_diagrams_file_name), mode='w+',
+                                            dtype=numpy.float32, shape=shape + (max_length, 2))
+    lengths = numpy.zeros(shape, dtype=numpy.int32)
+    truncated = [0] * len(included_dimensions)
+
+    # One shape at a time, the padded tensor of the whole batch is never held in memory.
+    for s, d in enumerate(directions):
+        block = numpy.zeros(shape[1:] + (max_length, 2), dtype=numpy.float32)
+
+        for i, dgms in enumerate(d):
+            for k, dim in enumerate(included_dimensions):
+                points = numpy.asarray(dgms[dim], dtype=numpy.float64).reshape(-1, 2)
+
+                if not numpy.isfinite(points).all():
+                    raise ValueError('Diagrams contain essential points. Use de_essentialize before export.')
+
+                kept = _most_persistent(points, caps[k])
+                truncated[k] += len(points) - len(kept)
+                block[i, k, :len(kept)] = kept
+                lengths[s, i, k] = len(kept)
+
+        diagrams[s] = block
+
+    diagrams.flush()
+    del diagrams
+
+    numpy.save(os.path.join(path, _padded_lengths_file_name), lengths)
+    numpy.save(os.path.join(path, _padded_mask_file_name),
+               numpy.arange(max_length)[None, None, None, :] < lengths[..., None])
+
+    # written last, a directory without it is an incomplete export
+    with open(meta_path, 'w') as f:
+        json.dump({'included_dimensions': list(included_dimensions),
+                   'max_points': caps,
+                   'truncated_points': truncated}, f)
+
+    return load_padded_diagrams(path)
+
+
+def load_padded_diagrams(path: str, mmap_mode: str='r')->PaddedDiagrams:
+    """
+    Opens an export of export_padded_diagrams.
+
+    Parameters
+    ----------
+    path: str. Directory written by export_padded_diagrams.
+
+    mmap_mode: str. Passed to numpy.load, None reads the arrays into memory.
+
+    Returns
+    -------
+        PaddedDiagrams.
+    """
+    meta_path = os.path.join(path, _padded_meta_file_name)
+    if not os.path.isfile(meta_path):
+        raise ValueError('{} is no complete export of export_padded_diagrams.'.format(path))
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    return PaddedDiagrams(numpy.load(os.path.join(path, _padded_diagrams_file_name), mmap_mode=mmap_mode),
+                          numpy.load(os.path.join(path, _padded_lengths_file_name), mmap_mode=mmap_mode),
+                          numpy.load(os.path.join(path, _padded_mask_file_name), mmap_mode=mmap_mode),
+                          tuple(meta['included_dimensions']))
+
+
+# endregion
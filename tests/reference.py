@@ -0,0 +1,70 @@
+"""
+Pure Python reference persistence (dimension 0) of cubical complexes, for tests which run without backends.
+"""
+import itertools
+import numpy
+
+
+def _h0(values: dict, neighbor_offsets: list)->[tuple]:
+    """
+    Union find with the elder rule over the cells (index -> value) of values, two cells are adjacent if
+    their indices differ by one of neighbor_offsets. Points of zero persistence are dropped, essential classes
+    die at inf.
+    """
+    edges = []
+    for cell, value in values.items():
+        for offset in neighbor_offsets:
+            neighbor = tuple(c + o for c, o in zip(cell, offset))
+            if neighbor in values and neighbor > cell:
+                edges.append((max(value, values[neighbor]), cell, neighbor))
+
+    parent = {cell: cell for cell in values}
+
+    def find(x):
+        while parent[x] != x:
+            x = parent[x]
+        return x
+
+    points = []
+    for weight, a, b in sorted(edges):
+        a, b = find(a), find(b)
+        if a == b:
+            continue
+
+        if (values[a], a) > (values[b], b):
+            a, b = b, a
+
+        if values[b] != weight:
+            points.append((values[b], weight))
+        parent[b] = a
+
+    for root in {find(cell) for cell in values}:
+        points.append((values[root], float('inf')))
+
+    return sorted(points)
+
+
+def vertex_construction_h0(image: numpy.ndarray)->[tuple]:
+    """
+    H0 of image with values on the vertices and cubes valued by the maximum of their vertices (DIPHA),
+    cells of value inf included.
+    """
+    image = numpy.asarray(image, dtype=numpy.float64)
+    offsets = [tuple(int(i == axis) for i in range(image.ndim)) for axis in range(image.ndim)]
+
+    return _h0({index: float(image[index]) for index in numpy.ndindex(image.shape)}, offsets)
+
+
+def top_cell_construction_h0(cells: dict)->[tuple]:
+    """
+    H0 of the top-dimensional cubes cells (anchor -> value) where faces get the minimum of their cofaces
+    (Perseus' cubical toplex), i.e., cubes sharing any face are adjacent.
+    """
+    dimension = len(next(iter(cells)))
+    offsets = [o for o in itertools.product((-1, 0, 1), repeat=dimension) if any(o)]
+
+    return _h0(cells, offsets)
+
+
+def sorted_diagram(dgm)->[tuple]:
+    return sorted(tuple(float(x) for x in p) for p in dgm)
@@ -0,0 +1,67 @@
+import os
+import numpy
+import pytest
+
+from pershombox import cubical_backends
+from pershombox.cubical_backends import CubicalConfiguration, CubicalCostModel, CubicalAutotuner, \
+    cubical_persistence_diagrams, default_autotuner
+
+
+@pytest.fixture
+def recording_backend(monkeypatch):
+    """
+    Replaces the backends, records the name of each configuration called.
+    """
+    calls = []
+
+    def call(self, filtrated_cubical_complex, limit_dimensions=None, set_inf_to_max_filt_val=False):
+        calls.append(self.name)
+        return [[] for _ in range(filtrated_cubical_complex.ndim)]
+
+    monkeypatch.setattr(CubicalConfiguration, '__call__', call)
+    return calls
+
+
+def _model(fastest: str)->CubicalCostModel:
+    """
+    Constant cost per configuration, fastest is the fastest one.
+    """
+    names = ['dipha', 'dipha_dual', 'dipha_mpi2', 'dipha_dual_mpi2', 'perseus']
+    return CubicalCostModel({name: {'2': [0.0 if name == fastest else 1.0 + i, 0.0, 0.0]}
+                             for i, name in enumerate(names)})
+
+
+def test_model_choice(recording_backend):
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend=CubicalAutotuner(_model('dipha_mpi2')))
+    assert recording_backend == ['dipha_mpi2']
+
+
+def test_dual_restricts_auto_to_dual_configurations(recording_backend):
+    tuner = CubicalAutotuner(_model('perseus'))
+
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend=tuner, dual=True)
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend=CubicalAutotuner(), dual=True)
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend=CubicalAutotuner(override='dipha_mpi2'), dual=True)
+
+    assert recording_backend == ['dipha_dual', 'dipha_dual', 'dipha_dual_mpi2']
+
+
+def test_default_autotuner_reloads_model(recording_backend, monkeypatch, tmp_path):
+    path = str(tmp_path / 'model.json')
+    monkeypatch.setenv('PERSHOMBOX_CUBICAL_AUTOTUNE_MODEL', path)
+    assert cubical_backends.default_model_path() == path
+
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend='auto')
+
+    _model('dipha_mpi2').save(path)
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend='auto')
+
+    _model('perseus').save(path)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend='auto')
+
+    os.remove(path)
+    cubical_persistence_diagrams(numpy.zeros((3, 3)), backend='auto')
+
+    assert recording_backend == ['dipha', 'dipha_mpi2', 'perseus', 'dipha']
+    assert default_autotuner().report().count('\n') > 0
@@ -0,0 +1,165 @@
+import itertools
+import numpy
+import pytest
+
+from pershombox._software_backends import perseus_adapter
+from pershombox._software_backends.perseus_adapter import _vertex_construction_cells, \
+    _sparse_cubical_toplex_string, persistence_diagrams_of_filtrated_cubical_complex
+from pershombox._software_backends.resource_handler import get_backend_cfg_errors, Backends
+
+from reference import vertex_construction_h0, top_cell_construction_h0, sorted_diagram
+
+
+def _parse_sparse_cubical_toplex(complex_string: str)->(int, dict):
+    lines = [l for l in complex_string.split('\n') if l.strip()]
+    dimension = int(lines[0])
+
+    cells = {}
+    for line in lines[1:]:
+        entries = [int(x) for x in line.split()]
+        cells[tuple(entries[:dimension])] = entries[dimension]
+
+    return dimension, cells
+
+
+@pytest.fixture
+def reference_perseus(monkeypatch):
+    """
+    Replaces the Perseus call by the H0 reference of the cubical toplex, in Perseus' output convention
+    (integer birth times, death -1 for essential classes).
+    """
+    def call(complex_type, complex_file_string, scratch_dir=None):
+        assert complex_type == 'scubtop'
+        _, cells = _parse_sparse_cubical_toplex(complex_file_string)
+        points = [(b, -1 if d == float('inf') else d) for b, d in top_cell_construction_h0(cells)]
+        return {0: [list(p) for p in points]}
+
+    monkeypatch.setattr(perseus_adapter, '_call_perseus', call)
+
+
+def _complex(rng, shape, number_of_values=None):
+    if number_of_values is None:
+        c = rng.rand(*shape)
+    else:
+        c = rng.randint(0, number_of_values, size=shape).astype(numpy.float64)
+
+    c[rng.rand(*shape) < 0.3] = float('inf')
+    c.flat[0] = 0.5
+    return c
+
+
+# region helpers
+
+
+@pytest.mark.parametrize('shape', [(4,), (3, 5), (2, 3, 4)])
+def test_vertex_construction_cells(shape):
+    values = numpy.random.RandomState(0).rand(*shape)
+    cells = _vertex_construction_cells(values)
+
+    assert cells.shape == tuple(2 * n - 1 for n in shape)
+
+    for index in numpy.ndindex(cells.shape):
+        vertices = itertools.product(*[sorted({i // 2, (i + 1) // 2}) for i in index])
+        assert cells[index] == max(values[v] for v in vertices)
+
+
+def test_vertex_construction_cells_propagates_inf():
+    values = numpy.array([[0.0, float('inf')], [1.0, 2.0]])
+    cells = _vertex_construction_cells(values)
+
+    assert numpy.isinf(cells[0, 1:]).all() and numpy.isinf(cells[1, 1:]).all()
+    assert cells[1, 0] == 1.0 and cells[2, 1] == 2.0
+
+
+def test_sparse_cubical_toplex_string_round_trip():
+    rng = numpy.random.RandomState(1)
+    cells = _complex(rng, (4, 5, 3), number_of_values=4)
+
+    complex_string, values = _sparse_cubical_toplex_string(cells)
+    dimension, ranks = _parse_sparse_cubical_toplex(complex_string)
+
+    assert dimension == 3
+    assert set(ranks) == {tuple(i) for i in numpy.argwhere(numpy.isfinite(cells))}
+    assert (numpy.diff(values) > 0).all()
+
+    for index, rank in ranks.items():
+        assert rank >= 1
+        assert values[rank - 1] == cells[index]
+
+
+@pytest.mark.parametrize('set_inf_to_max_filt_val, death', [(False, float('inf')), (True, 3.0)])
+def test_essential_death_is_mapped(monkeypatch, set_inf_to_max_filt_val, death):
+    monkeypatch.setattr(perseus_adapter, '_call_perseus',
+                        lambda complex_type, complex_file_string, scratch_dir=None: {0: [[1, -1], [2, 3]]})
+
+    dgms = persistence_diagrams_of_filtrated_cubical_complex(numpy.array([[1.0, 2.0, 3.0]]),
+                                                             set_inf_to_max_filt_val=set_inf_to_max_filt_val,
+                                                             construction='top_cell')
+
+    assert dgms == [[(1.0, death), (2.0, 3.0)], []]
+
+
+# endregion
+
+
+# region agreement with the vertex construction
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('shape', [(6, 7), (4, 3, 5)])
+def test_agrees_with_vertex_construction(reference_perseus, seed, shape):
+    filtrated_complex = _complex(numpy.random.RandomState(seed), shape)
+
+    dgms = persistence_diagrams_of_filtrated_cubical_complex(filtrated_complex)
+
+    assert len(dgms) == len(shape)
+    assert sorted_diagram(dgms[0]) == vertex_construction_h0(filtrated_complex)
+
+
+def test_agrees_with_vertex_construction_tied_values(reference_perseus):
+    filtrated_complex = _complex(numpy.random.RandomState(7), (7, 6), number_of_values=3)
+
+    dgms = persistence_diagrams_of_filtrated_cubical_complex(filtrated_complex)
+
+    assert sorted_diagram(dgms[0]) == vertex_construction_h0(filtrated_complex)
+
+
+def test_limit_dimensions(reference_perseus):
+    dgms = persistence_diagrams_of_filtrated_cubical_complex(_complex(numpy.random.RandomState(8), (4, 4)),
+                                                             limit_dimensions=0)
+    assert dgms == [[], []]
+
+
+def test_all_inf_complex_is_empty(reference_perseus):
+    assert persistence_diagrams_of_filtrated_cubical_complex(numpy.full((3, 3), float('inf'))) == [[], []]
+
+
+# endregion
+
+
+# region agreement with DIPHA
+
+
+_missing_backends = {name for name, _ in get_backend_cfg_errors()}
+
+
+@pytest.mark.skipif(Backends.dipha.value in _missing_backends or Backends.perseus.value in _missing_backends,
+                    reason='DIPHA and Perseus have to be configured')
+@pytest.mark.parametrize('shape', [(12, 10), (6, 5, 7)])
+def test_agrees_with_dipha(shape):
+    from pershombox._software_backends.dipha_adapter import persistence_diagrams_of_filtrated_cubical_complex \
+        as dipha_persistence_diagrams
+
+    filtrated_complex = _complex(numpy.random.RandomState(9), shape)
+
+    dipha = dipha_persistence_diagrams(filtrated_complex)
+    perseus = persistence_diagrams_of_filtrated_cubical_complex(filtrated_complex)
+
+    for dgm_dipha, dgm_perseus in zip(dipha, perseus):
+        # points of zero persistence are not reported by both backends alike
+        dgm_dipha = [p for p in sorted_diagram(dgm_dipha) if p[0] != p[1]]
+        dgm_perseus = [p for p in sorted_diagram(dgm_perseus) if p[0] != p[1]]
+        assert dgm_dipha == dgm_perseus
+
+
+# endregion
@@ -0,0 +1,41 @@
+import os
+import numpy
+
+from pershombox import pipeline
+from pershombox.pipeline import npht_directory, npht_store_files
+
+
+def _fake_transform(array, **kwargs):
+    return [[(0.0, float(array.sum()))]]
+
+
+def _inputs(input_dir, indices):
+    for i in indices:
+        numpy.save(str(input_dir / 'volume_{}.npy'.format(i)), numpy.full((2, 2), float(i)))
+
+
+def test_partial_manifest_line_is_not_merged_with_the_next_entry(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, 'cubical_persistence_diagrams', _fake_transform)
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_dir.mkdir()
+    _inputs(input_dir, range(2))
+
+    assert npht_directory(str(input_dir), str(output_dir), transform='cubical', workers=0)['computed'] == 2
+
+    # a run which died while writing the entry of a third input
+    manifest_path = os.path.join(str(output_dir), 'manifest.jsonl')
+    with open(manifest_path, 'a') as f:
+        f.write('{"input": "volume_2.npy", "si')
+
+    _inputs(input_dir, range(2, 4))
+    summary = npht_directory(str(input_dir), str(output_dir), transform='cubical', workers=0)
+    assert summary['computed'] == 2 and summary['skipped'] == 2
+
+    with open(manifest_path) as f:
+        assert f.read().endswith('\n')
+
+    assert sorted(os.path.basename(p) for p in npht_store_files(str(output_dir))) == \
+        ['volume_{}.npy.pkl'.format(i) for i in range(4)]
+
+    summary = npht_directory(str(input_dir), str(output_dir), transform='cubical', workers=0)
+    assert summary['computed'] == 0 and summary['skipped'] == 4
@@ -0,0 +1,33 @@
+import os
+import pytest
+
+from pershombox.shared_store import SharedDiagramStore
+
+
+def _transforms():
+    return [[[[(0.0, 1.0), (0.5, float('inf'))], [(1.0, 2.0)]],
+             [[(0.0, 3.0)], []]]]
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='POSIX shared memory is listed in /dev/shm')
+def test_close_with_live_views_unlinks():
+    store = SharedDiagramStore.create(_transforms())
+    name = store.name
+    view = store[0]
+
+    store.close()
+
+    assert not os.path.exists(os.path.join('/dev/shm', name))
+    assert view[0][0].tolist() == [[0.0, 1.0], [0.5, float('inf')]]
+
+    # closing again is a no-op
+    store.close()
+
+
+def test_attach_reads_the_transforms():
+    with SharedDiagramStore.create(_transforms()) as store:
+        # the creator shares its own resource tracker
+        attached = SharedDiagramStore.attach(store.name, shares_creator_tracker=True)
+        assert [[d.tolist() for d in dgms] for dgms in attached[0]] == \
+            [[[[0.0, 1.0], [0.5, float('inf')]], [[1.0, 2.0]]], [[[0.0, 3.0]], []]]
+        attached.close()
@@ -0,0 +1,144 @@
+import numpy
+import pytest
+
+from pershombox import cubical_backends
+from pershombox.cubical_backends import CubicalConfiguration, cubical_persistence_diagrams_batch, \
+    _pack_tiles, _unpack_tiles, TileUnpackingError
+from pershombox._software_backends import instrumentation
+
+from reference import vertex_construction_h0, sorted_diagram
+
+
+@pytest.fixture
+def reference_backend(monkeypatch):
+    """
+    Replaces the backends by the H0 reference, records the shapes of the complexes passed to it.
+    """
+    calls = []
+
+    def call(self, filtrated_cubical_complex, limit_dimensions=None, set_inf_to_max_filt_val=False):
+        calls.append(filtrated_cubical_complex.shape)
+        dgms = [[] for _ in range(filtrated_cubical_complex.ndim)]
+        dgms[0] = vertex_construction_h0(filtrated_cubical_complex)
+        return dgms
+
+    monkeypatch.setattr(CubicalConfiguration, '__call__', call)
+    return calls
+
+
+def _complex(rng, shape, number_of_values=None):
+    if number_of_values is None:
+        c = rng.rand(*shape)
+    else:
+        c = rng.randint(0, number_of_values, size=shape).astype(numpy.float64)
+
+    c[rng.rand(*shape) < 0.3] = float('inf')
+    return c
+
+
+def _assert_equals_single_calls(complexes, **kwargs):
+    packed = cubical_persistence_diagrams_batch(complexes, **kwargs)
+    single = [cubical_backends.cubical_persistence_diagrams(c) for c in complexes]
+
+    assert len(packed) == len(single)
+    for dgms_packed, dgms_single in zip(packed, single):
+        assert [sorted_diagram(d) for d in dgms_packed] == [sorted_diagram(d) for d in dgms_single]
+
+
+def test_mixed_tile_shapes(reference_backend):
+    rng = numpy.random.RandomState(0)
+    complexes = [_complex(rng, shape) for shape in [(5, 7), (3, 9), (8, 2), (1, 1), (6, 6)]]
+
+    _assert_equals_single_calls(complexes)
+    assert reference_backend[0] == (5 + 3 + 8 + 1 + 6 + 4, 9)
+
+
+def test_mixed_tile_shapes_3d(reference_backend):
+    rng = numpy.random.RandomState(1)
+    complexes = [_complex(rng, shape) for shape in [(3, 4, 2), (2, 2, 5), (4, 3, 3)]]
+
+    _assert_equals_single_calls(complexes)
+
+
+def test_tied_values(reference_backend):
+    rng = numpy.random.RandomState(2)
+    complexes = [_complex(rng, (6, 5), number_of_values=3) for _ in range(6)]
+
+    _assert_equals_single_calls(complexes)
+
+
+def test_all_inf_complexes(reference_backend):
+    rng = numpy.random.RandomState(3)
+    complexes = [_complex(rng, (4, 4)), numpy.full((3, 4), float('inf')), _complex(rng, (5, 2)),
+                 numpy.full((2, 2), float('inf'))]
+
+    _assert_equals_single_calls(complexes)
+
+    packed = cubical_persistence_diagrams_batch(complexes)
+    assert sorted_diagram(packed[1][0]) == [(float('inf'), float('inf'))]
+
+
+def test_max_cells_per_call_splitting(reference_backend):
+    rng = numpy.random.RandomState(4)
+    complexes = [_complex(rng, (4, 5)) for _ in range(7)]
+
+    with instrumentation.recording():
+        _assert_equals_single_calls(complexes, max_cells_per_call=45)
+        tiles = instrumentation.snapshot()['cubical_tiles']['tiles']['count']
+
+    # groups of two complexes (9 x 5 = 45 cells with the separating layer) and the remaining one alone, then the 7 single calls of the check
+    assert reference_backend[:4] == [(9, 5), (9, 5), (9, 5), (4, 5)]
+    assert tiles == 6
+
+
+def test_max_cells_per_call_counts_padding(reference_backend):
+    rng = numpy.random.RandomState(6)
+    complexes = [_complex(rng, (1, 10)), _complex(rng, (10, 1)), _complex(rng, (1, 10)), _complex(rng, (1, 10))]
+
+    # the first two have 20 cells, packed (12, 10) ones
+    _assert_equals_single_calls(complexes, max_cells_per_call=50)
+    assert reference_backend[:3] == [(1, 10), (10, 1), (3, 10)]
+
+
+def test_max_cells_per_call_one_disables_packing(reference_backend):
+    rng = numpy.random.RandomState(5)
+    complexes = [_complex(rng, (3, 3)) for _ in range(3)]
+
+    _assert_equals_single_calls(complexes, max_cells_per_call=1)
+    assert reference_backend[:3] == [(3, 3)] * 3
+
+
+def test_death_outside_of_tile_raises():
+    packed, offsets, values = _pack_tiles([numpy.array([[0.0, 1.0]]), numpy.array([[2.0, 3.0]])])
+
+    with pytest.raises(TileUnpackingError):
+        _unpack_tiles([[(0.0, 3.0)], []], offsets, values)
+
+
+def test_unpackable_output_falls_back_to_single_calls(monkeypatch):
+    def call(self, filtrated_cubical_complex, limit_dimensions=None, set_inf_to_max_filt_val=False):
+        # one point from the smallest to the largest finite value, across tiles if packed
+        finite = filtrated_cubical_complex[numpy.isfinite(filtrated_cubical_complex)]
+        return [[(finite.min(), finite.max())], []]
+
+    monkeypatch.setattr(CubicalConfiguration, '__call__', call)
+    complexes = [numpy.array([[0.0, 1.0]]), numpy.array([[2.0, 5.0]])]
+
+    with pytest.warns(RuntimeWarning):
+        result = cubical_persistence_diagrams_batch(complexes)
+
+    assert result == [[[(0.0, 1.0)], []], [[(2.0, 5.0)], []]]
+
+
+def test_npht_2d_equals_one_call_per_direction(reference_backend):
+    from pershombox import calculate_discrete_NPHT_2d
+
+    shape = numpy.zeros((9, 11), dtype=bool)
+    shape[1:8, 2:10] = True
+    shape[3:5, 4:7] = False
+
+    packed = calculate_discrete_NPHT_2d(shape, 8)
+    single = calculate_discrete_NPHT_2d(shape, 8, max_cells_per_call=1)
+
+    assert [[sorted_diagram(d) for d in dgms] for dgms in packed] == \
+        [[sorted_diagram(d) for d in dgms] for dgms in single]
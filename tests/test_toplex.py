@@ -0,0 +1,12 @@
+from pershombox import toplex
+from pershombox.toplex import toplex_persistence_diagrams_batch
+
+
+def test_batch_accepts_generators(monkeypatch):
+    monkeypatch.setattr(toplex, '_call_perseus', lambda complex_type, complex_string, scratch_dir=None:
+                        {0: [[1, 2], [1, -1]]})
+
+    complexes = ((((i, i + 1) for i in range(n)), (float(i) for i in range(n))) for n in [2, 0, 3])
+
+    assert list(toplex_persistence_diagrams_batch(complexes, workers=2)) == \
+        [[[[0.0, 1.0], [0.0, float('inf')]], []], [], [[[0.0, 1.0], [0.0, float('inf')]], []]]